@@ -0,0 +1,281 @@
+import csv
+import datetime
+import os
+
+from pymongo.collection import Collection
+
+from edge_store import iter_edges
+from similarity import read_similarity_file
+
+# Ficheros que se generan y sus cabeceras en el formato de neo4j-admin database import.
+# Las etiquetas y propiedades son las de los cargadores: User {user_id} en SIMILAR_TO
+# (4.1) y WROTE (4.3), y Reviewer {id} -> Product {id} en REVIEWED (4.2)
+NODE_FILES = {
+    "users.csv": ["user_id:ID(User)", "reviewer_name", ":LABEL"],
+    "reviewers.csv": ["id:ID(Reviewer)", ":LABEL"],
+    "products.csv": ["id:ID(Product)", ":LABEL"],
+    "product_types.csv": ["product_type:ID(ProductType)", ":LABEL"],
+}
+RELATIONSHIP_FILES = {
+    "similar_to.csv": [":START_ID(User)", ":END_ID(User)", "similarity:float", ":TYPE"],
+    "reviewed.csv": [
+        ":START_ID(Reviewer)",
+        ":END_ID(Product)",
+        "overall:float",
+        "reviewTime:datetime",
+        ":TYPE",
+    ],
+    "wrote.csv": [
+        ":START_ID(User)",
+        ":END_ID(ProductType)",
+        "number_of_articles:int",
+        ":TYPE",
+    ],
+}
+
+
+class BulkExporter:
+    """Escribe los CSV de nodos y relaciones para la importación offline de Neo4j
+
+    Los nodos se escriben la primera vez que aparecen en una relación, así que los ids
+    se deduplican sobre la marcha sin tener que recorrer los datos dos veces.
+    """
+
+    def __init__(self, directory: str, reviewer_names: dict = None) -> None:
+        """
+        Args:
+            directory (str): directorio de salida
+            reviewer_names (dict, optional): nombres de los reviewers por id. Defaults to None.
+        """
+        self.directory = directory
+        self.reviewer_names = reviewer_names or {}
+        self.seen = {
+            "User": set(),
+            "Reviewer": set(),
+            "Product": set(),
+            "ProductType": set(),
+        }
+        self.counts = {}
+        self.files = {}
+        self.writers = {}
+
+    def __enter__(self) -> "BulkExporter":
+        os.makedirs(self.directory, exist_ok=True)
+        for name, header in {**NODE_FILES, **RELATIONSHIP_FILES}.items():
+            fh = open(
+                os.path.join(self.directory, name), "w", newline="", encoding="utf-8"
+            )
+            self.files[name] = fh
+            self.writers[name] = csv.writer(fh)
+            self.writers[name].writerow(header)
+            self.counts[name] = 0
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        for fh in self.files.values():
+            fh.close()
+
+    def _write(self, name: str, row: list) -> None:
+        self.writers[name].writerow(row)
+        self.counts[name] += 1
+
+    def add_user(self, user_id: str) -> None:
+        if user_id not in self.seen["User"]:
+            self.seen["User"].add(user_id)
+            name = self.reviewer_names.get(user_id) or "NameDoesNotExist"
+            self._write("users.csv", [user_id, name, "User"])
+
+    def add_reviewer(self, reviewer_id: str) -> None:
+        if reviewer_id not in self.seen["Reviewer"]:
+            self.seen["Reviewer"].add(reviewer_id)
+            self._write("reviewers.csv", [reviewer_id, "Reviewer"])
+
+    def add_product(self, asin: str) -> None:
+        if asin not in self.seen["Product"]:
+            self.seen["Product"].add(asin)
+            self._write("products.csv", [asin, "Product"])
+
+    def add_product_type(self, product_type: str) -> None:
+        if product_type not in self.seen["ProductType"]:
+            self.seen["ProductType"].add(product_type)
+            self._write("product_types.csv", [product_type, "ProductType"])
+
+    def add_similarity(self, user1: str, user2: str, similarity: float) -> None:
+        self.add_user(user1)
+        self.add_user(user2)
+        self._write("similar_to.csv", [user1, user2, similarity, "SIMILAR_TO"])
+
+    def add_review(
+        self,
+        reviewer_id: str,
+        asin: str,
+        overall: float,
+        review_time: datetime.datetime,
+    ) -> None:
+        self.add_reviewer(reviewer_id)
+        self.add_product(asin)
+        self._write(
+            "reviewed.csv",
+            [reviewer_id, asin, overall, review_time.isoformat(), "REVIEWED"],
+        )
+
+    def add_wrote(self, user_id: str, product_type: str, count: int) -> None:
+        self.add_user(user_id)
+        self.add_product_type(product_type)
+        self._write("wrote.csv", [user_id, product_type, count, "WROTE"])
+
+
+def export_similarities(exporter: BulkExporter, similarity_file: str) -> None:
+    """Exporta las relaciones SIMILAR_TO del fichero de similitudes (ver store_similarity)"""
+    for ids1, ids2, block in iter_edges(read_similarity_file(similarity_file)):
+        for id1, id2, similarity in zip(
+            ids1.tolist(), ids2.tolist(), block["similarity"].tolist()
+        ):
+            exporter.add_similarity(id1, id2, similarity)
+
+
+def export_reviews(
+    exporter: BulkExporter, collection: Collection, batch_size: int = 10000
+) -> None:
+    """Exporta las relaciones REVIEWED de todas las reviews de MongoDB, como en query_4_2"""
+    docs = collection.aggregate(
+        [
+            {
+                "$project": {
+                    "_id": 0,
+                    "reviewerID": 1,
+                    "asin": 1,
+                    "overall": 1,
+                    "reviewTime": 1,
+                }
+            }
+        ],
+        allowDiskUse=True,
+        batchSize=batch_size,
+    )
+    for doc in docs:
+        exporter.add_review(
+            doc["reviewerID"], doc["asin"], float(doc["overall"]), doc["reviewTime"]
+        )
+
+
+def export_multi_category(
+    exporter: BulkExporter,
+    collection: Collection,
+    product_types: dict,
+    batch_size: int = 10000,
+) -> None:
+    """Exporta las relaciones WROTE de los reviewers que han escrito de al menos dos tipos de productos"""
+    docs = collection.aggregate(
+        [
+            {
+                "$group": {
+                    "_id": {"reviewerID": "$reviewerID", "type_id": "$type_id"},
+                    "count": {"$sum": 1},
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$_id.reviewerID",
+                    "types": {"$push": {"type_id": "$_id.type_id", "count": "$count"}},
+                }
+            },
+            {"$match": {"types.1": {"$exists": True}}},
+        ],
+        allowDiskUse=True,
+        batchSize=batch_size,
+    )
+    for doc in docs:
+        for type_doc in doc["types"]:
+            exporter.add_wrote(
+                doc["_id"], product_types[type_doc["type_id"]], type_doc["count"]
+            )
+
+
+def import_command(directory: str, database: str = "neo4j") -> str:
+    """Devuelve el comando de neo4j-admin para importar los ficheros exportados"""
+    nodes = " ".join(f"--nodes={os.path.join(directory, name)}" for name in NODE_FILES)
+    relationships = " ".join(
+        f"--relationships={os.path.join(directory, name)}"
+        for name in RELATIONSHIP_FILES
+    )
+    return f"neo4j-admin database import full {nodes} {relationships} --overwrite-destination {database}"
+
+
+def _parse_value(value: str, value_type: str) -> None:
+    if value_type == "float":
+        float(value)
+    elif value_type == "int":
+        int(value)
+    elif value_type == "datetime":
+        datetime.datetime.fromisoformat(value)
+
+
+def validate_import_files(directory: str) -> dict:
+    """Comprueba los ficheros exportados sin necesidad de un Neo4j
+
+    Comprueba las cabeceras, que los valores tengan el tipo declarado, que los ids de
+    los nodos no estén repetidos y que todas las relaciones apunten a nodos existentes.
+
+    Args:
+        directory (str): directorio con los CSV
+
+    Raises:
+        ValueError: si algún fichero no es válido
+
+    Returns:
+        dict: número de filas de cada fichero
+    """
+    ids = {}
+    counts = {}
+    errors = []
+
+    def read(name: str, expected_header: list):
+        with open(os.path.join(directory, name), newline="", encoding="utf-8") as fh:
+            reader = csv.reader(fh)
+            header = next(reader, None)
+            if header != expected_header:
+                errors.append(
+                    f"{name}: cabecera {header}, se esperaba {expected_header}"
+                )
+                return
+            types = [column.partition(":")[2] for column in header]
+            for line_number, row in enumerate(reader, start=2):
+                if len(row) != len(header):
+                    errors.append(f"{name}:{line_number}: {len(row)} columnas")
+                    continue
+                for value, value_type in zip(row, types):
+                    try:
+                        _parse_value(value, value_type)
+                    except ValueError:
+                        errors.append(
+                            f"{name}:{line_number}: '{value}' no es de tipo {value_type}"
+                        )
+                yield line_number, row
+
+    for name, header in NODE_FILES.items():
+        id_space = header[0].split("(")[1].rstrip(")")
+        space = ids.setdefault(id_space, set())
+        counts[name] = 0
+        for line_number, row in read(name, header):
+            if row[0] in space:
+                errors.append(f"{name}:{line_number}: id repetido {row[0]}")
+            space.add(row[0])
+            counts[name] += 1
+
+    for name, header in RELATIONSHIP_FILES.items():
+        start_space = header[0].split("(")[1].rstrip(")")
+        end_space = header[1].split("(")[1].rstrip(")")
+        counts[name] = 0
+        for line_number, row in read(name, header):
+            if row[0] not in ids[start_space]:
+                errors.append(f"{name}:{line_number}: no existe el nodo {row[0]}")
+            if row[1] not in ids[end_space]:
+                errors.append(f"{name}:{line_number}: no existe el nodo {row[1]}")
+            counts[name] += 1
+
+    if len(errors) > 0:
+        raise ValueError(
+            f"{len(errors)} errores en {directory}:\n" + "\n".join(errors[:20])
+        )
+    return counts
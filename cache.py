@@ -0,0 +1,161 @@
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class DiskCache:
+    """Caché en disco (SQLite) compartida entre procesos
+
+    Cada proceso y cada hilo abre su propia conexión, así que se puede usar desde
+    varios workers del servidor a la vez.
+    """
+
+    def __init__(
+        self, path: str, ttl: float = None, purge_interval: float = 600
+    ) -> None:
+        """
+        Args:
+            path (str): fichero de SQLite donde se guarda la caché
+            ttl (float, optional): segundos que dura una entrada, None para que no caduque. Defaults to None.
+            purge_interval (float, optional): cada cuántos segundos se borran, al guardar,
+                las entradas caducadas. Defaults to 600.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._last_purge = time.time()
+        self.lock_dir = path + ".locks"
+        self._local = threading.local()
+
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value BLOB)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # La conexión no se comparte tras un fork, por eso se guarda junto al pid
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Devuelve el valor guardado o default si no existe o ha caducado"""
+        row = (
+            self._connection()
+            .execute("SELECT expires, value FROM cache WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return default
+        if row[0] is not None and row[0] < time.time():
+            # Se borra solo si no la ha renovado otro worker mientras tanto
+            with self._connection() as connection:
+                connection.execute(
+                    "DELETE FROM cache WHERE key = ? AND expires < ?",
+                    (key, time.time()),
+                )
+            return default
+        return pickle.loads(row[1])
+
+    def set(self, key: str, value: Any, ttl: float = None) -> None:
+        """Guarda un valor en la caché
+
+        Args:
+            key (str): la clave
+            value (Any): el valor (tiene que poder serializarse con pickle)
+            ttl (float, optional): duración de la entrada; por defecto la de la caché. Defaults to None.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)",
+                (key, expires, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)),
+            )
+        if time.time() - self._last_purge >= self.purge_interval:
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        """Borra las entradas caducadas, que si no se quedarían en el fichero
+
+        Returns:
+            int: número de entradas borradas
+        """
+        self._last_purge = time.time()
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "DELETE FROM cache WHERE expires < ?", (self._last_purge,)
+            )
+        return cursor.rowcount
+
+    def clear(self) -> None:
+        """Borra todas las entradas"""
+        with self._connection() as connection:
+            connection.execute("DELETE FROM cache")
+
+    @contextmanager
+    def lock(self, key: str):
+        """Bloqueo entre procesos para que solo un worker calcule cada clave"""
+        if fcntl is None:
+            yield
+            return
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        with open(os.path.join(self.lock_dir, name), "w") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+_MISSING = object()
+
+
+def cached(cache: DiskCache, ttl: float = None) -> Callable:
+    """Decorador que guarda en la caché el resultado de una función según sus argumentos
+
+    Args:
+        cache (DiskCache): la caché
+        ttl (float, optional): duración de las entradas. Defaults to None.
+
+    Returns:
+        Callable: el decorador
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = f"{func.__module__}.{func.__qualname__}:{args!r}:{sorted(kwargs.items())!r}"
+
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+            # Si otro worker ya lo está calculando, se espera y se usa su resultado
+            with cache.lock(key):
+                value = cache.get(key, _MISSING)
+                if value is _MISSING:
+                    value = func(*args, **kwargs)
+                    cache.set(key, value, ttl)
+            return value
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,309 @@
+import argparse
+import time
+from typing import Iterator
+
+import numpy as np
+from pymongo.collection import Collection
+from scipy.sparse import csr_matrix
+
+from graph_writer import GraphWriter, create_schema
+from utils import IdMap
+
+# Parejas de reviewers con artículos en común sobre el grafo cargado en Neo4j
+CYPHER_SHARED_REVIEWS = """
+    MATCH (u1:User)-[:REVIEWED]->(a:Article)<-[:REVIEWED]-(u2:User)
+    WHERE id(u1) < id(u2)
+    WITH u1, u2, COUNT(a) AS sharedReviews
+    RETURN u1.reviewerID AS User1, u2.reviewerID AS User2, sharedReviews
+    ORDER BY sharedReviews DESC
+"""
+
+
+def select_articles(
+    collection: Collection,
+    min_reviews: int = 1,
+    max_reviews: int = None,
+    limit: int = None,
+    type_id: int = None,
+) -> list:
+    """Devuelve los artículos con más reviews dentro de un rango de número de reviews
+
+    Con max_reviews=39 y limit=5 son los artículos del apartado 4.4.
+
+    Args:
+        collection (Collection): colección de MongoDB
+        min_reviews (int, optional): mínimo de reviews del artículo. Defaults to 1.
+        max_reviews (int, optional): máximo de reviews del artículo (None sin máximo). Defaults to None.
+        limit (int, optional): número de artículos (None para todos). Defaults to None.
+        type_id (int, optional): solo artículos de este tipo. Defaults to None.
+
+    Returns:
+        list: asins ordenados de más a menos reviews
+    """
+    review_count = {"$gte": min_reviews}
+    if max_reviews is not None:
+        review_count["$lte"] = max_reviews
+
+    pipeline = [
+        {"$group": {"_id": "$asin", "reviewCount": {"$sum": 1}}},
+        {"$match": {"reviewCount": review_count}},
+        {"$sort": {"reviewCount": -1, "_id": 1}},
+    ]
+    if type_id is not None:
+        pipeline.insert(0, {"$match": {"type_id": type_id}})
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+
+    return [doc["_id"] for doc in collection.aggregate(pipeline, allowDiskUse=True)]
+
+
+def build_incidence_matrix(
+    collection: Collection, asins: list, chunk_size: int = 10000
+) -> tuple[csr_matrix, IdMap, IdMap]:
+    """Construye la matriz binaria reviewer x artículo de los artículos indicados
+
+    Args:
+        collection (Collection): colección de MongoDB
+        asins (list): artículos
+        chunk_size (int, optional): artículos por consulta $in. Defaults to 10000.
+
+    Returns:
+        tuple[csr_matrix, IdMap, IdMap]: matriz, mapa de reviewers a filas y de artículos a columnas
+    """
+    reviewers = IdMap()
+    articles = IdMap(asins)
+    rows = []
+    cols = []
+    for start in range(0, len(asins), chunk_size):
+        docs = collection.find(
+            {"asin": {"$in": asins[start : start + chunk_size]}},
+            {"_id": 0, "reviewerID": 1, "asin": 1},
+            batch_size=chunk_size,
+        )
+        for doc in docs:
+            rows.append(reviewers.add(doc["reviewerID"]))
+            cols.append(articles[doc["asin"]])
+
+    matrix = csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(reviewers), len(articles)),
+    )
+    # Varias reviews del mismo reviewer al mismo artículo cuentan una vez, como el MERGE de Neo4j
+    matrix.data[:] = 1
+    return matrix, reviewers, articles
+
+
+def shared_review_counts(
+    matrix: csr_matrix, min_shared: int = 1, block_size: int = 2000
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Cuenta los artículos en común de todas las parejas de reviewers con A·Aᵀ
+
+    El producto disperso solo genera las parejas que comparten algún artículo, así que
+    no hace falta recorrer todas las parejas que pasan por cada artículo popular.
+
+    Args:
+        matrix (csr_matrix): matriz binaria reviewer x artículo
+        min_shared (int, optional): mínimo de artículos en común. Defaults to 1.
+        block_size (int, optional): filas que se procesan a la vez (limita la memoria). Defaults to 2000.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: índices de fila i < j y sus artículos en común
+    """
+    matrix = csr_matrix(matrix, dtype=np.int32)
+    n = matrix.shape[0]
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        shared = (matrix[start:end] @ matrix[start:].T).tocoo()
+        rows = shared.row.astype(np.int64) + start
+        cols = shared.col.astype(np.int64) + start
+        keep = (cols > rows) & (shared.data >= min_shared)
+        yield rows[keep], cols[keep], shared.data[keep]
+
+
+def shared_reviews(
+    collection: Collection, asins: list, min_shared: int = 1, block_size: int = 2000
+) -> list[tuple[str, str, int]]:
+    """Devuelve las parejas de reviewers con artículos en común calculadas en memoria
+
+    Args:
+        collection (Collection): colección de MongoDB
+        asins (list): artículos que se tienen en cuenta
+        min_shared (int, optional): mínimo de artículos en común. Defaults to 1.
+        block_size (int, optional): filas que se procesan a la vez. Defaults to 2000.
+
+    Returns:
+        list[tuple[str, str, int]]: reviewers y artículos en común, de más a menos
+    """
+    matrix, reviewers, _ = build_incidence_matrix(collection, asins)
+    pairs = []
+    for rows, cols, counts in shared_review_counts(matrix, min_shared, block_size):
+        pairs.extend(
+            (reviewers.ids[i], reviewers.ids[j], count)
+            for i, j, count in zip(rows.tolist(), cols.tolist(), counts.tolist())
+        )
+    pairs.sort(key=lambda pair: pair[2], reverse=True)
+    return pairs
+
+
+def upload_shared_reviews(
+    driver, pairs: list[tuple[str, str, int]], batch_size: int = 10000
+) -> int:
+    """Sube a Neo4j solo las parejas resultantes, como relaciones SHARED_REVIEWS
+
+    Args:
+        driver: driver de la conexión a Neo4j
+        pairs (list[tuple[str, str, int]]): parejas de shared_reviews
+        batch_size (int, optional): relaciones por transacción. Defaults to 10000.
+
+    Returns:
+        int: número de relaciones escritas
+    """
+    query = """
+                UNWIND $rows AS row
+                MERGE (u1:User {reviewerID: row.user1})
+                MERGE (u2:User {reviewerID: row.user2})
+                MERGE (u1)-[shared:SHARED_REVIEWS]-(u2)
+                SET shared.sharedReviews = row.shared_reviews
+            """
+    create_schema(driver)
+    with GraphWriter(driver, query, batch_size, "SHARED_REVIEWS") as writer:
+        writer.add_many(
+            {"user1": user1, "user2": user2, "shared_reviews": count}
+            for user1, user2, count in pairs
+        )
+    return writer.written
+
+
+def load_review_links(
+    driver, collection: Collection, asins: list, batch_size: int = 10000
+) -> None:
+    """Carga en Neo4j las relaciones REVIEWED entre reviewers y artículos (ruta Cypher)"""
+    query = """
+                UNWIND $rows AS row
+                MERGE (a:Article {asin: row.asin})
+                MERGE (u:User {reviewerID: row.reviewer_id})
+                MERGE (u)-[:REVIEWED]->(a)
+                """
+    create_schema(driver)
+    with GraphWriter(driver, query, batch_size, "REVIEWED") as writer:
+        docs = collection.find(
+            {"asin": {"$in": asins}},
+            {"_id": 0, "reviewerID": 1, "asin": 1},
+            batch_size=batch_size,
+        )
+        writer.add_many(
+            {"asin": doc["asin"], "reviewer_id": doc["reviewerID"]} for doc in docs
+        )
+
+
+def cypher_shared_reviews(driver) -> list[tuple[str, str, int]]:
+    """Devuelve las parejas de reviewers con artículos en común calculadas por Neo4j"""
+    with driver.session() as session:
+        records = session.execute_read(lambda tx: list(tx.run(CYPHER_SHARED_REVIEWS)))
+    return [
+        (record["User1"], record["User2"], record["sharedReviews"])
+        for record in records
+    ]
+
+
+def benchmark(
+    collection: Collection, driver, asins: list, batch_size: int = 10000
+) -> dict:
+    """Compara el cálculo en memoria con la carga del grafo y la consulta Cypher
+
+    Borra los nodos de Neo4j antes de cargar los artículos.
+
+    Args:
+        collection (Collection): colección de MongoDB
+        driver: driver de la conexión a Neo4j
+        asins (list): artículos que se tienen en cuenta
+        batch_size (int, optional): relaciones por transacción. Defaults to 10000.
+
+    Returns:
+        dict: tiempos de cada ruta, número de parejas y si los resultados coinciden
+    """
+    start = time.perf_counter()
+    python_pairs = shared_reviews(collection, asins)
+    python_time = time.perf_counter() - start
+
+    with driver.session() as session:
+        session.run("MATCH (n) DETACH DELETE n").consume()
+
+    start = time.perf_counter()
+    load_review_links(driver, collection, asins, batch_size)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cypher_pairs = cypher_shared_reviews(driver)
+    query_time = time.perf_counter() - start
+
+    def normalize(pairs: list) -> set:
+        return {(*sorted((user1, user2)), count) for user1, user2, count in pairs}
+
+    return {
+        "articles": len(asins),
+        "pairs": len(python_pairs),
+        "python_s": python_time,
+        "cypher_load_s": load_time,
+        "cypher_query_s": query_time,
+        "cypher_total_s": load_time + query_time,
+        "speedup": (load_time + query_time) / python_time if python_time > 0 else 0.0,
+        "same_result": normalize(python_pairs) == normalize(cypher_pairs),
+    }
+
+
+if __name__ == "__main__":
+    from neo4j import GraphDatabase
+
+    from utils import get_collection, read_config
+
+    parser = argparse.ArgumentParser(
+        description="Reviewers con artículos en común calculados en memoria"
+    )
+    parser.add_argument("--min-reviews", type=int, default=1)
+    parser.add_argument("--max-reviews", type=int, default=39)
+    parser.add_argument("--articles", type=int, default=5)
+    parser.add_argument("--type-id", type=int, default=None)
+    parser.add_argument("--min-shared", type=int, default=1)
+    parser.add_argument(
+        "--upload", action="store_true", help="sube las parejas a Neo4j"
+    )
+    parser.add_argument(
+        "--benchmark", action="store_true", help="compara con la ruta de Cypher"
+    )
+    args = parser.parse_args()
+
+    config = read_config()
+    collection = get_collection(config)
+    batch_size = int(config["NEO4J"]["tamano_lote"])
+    asins = select_articles(
+        collection, args.min_reviews, args.max_reviews, args.articles, args.type_id
+    )
+    print(f"Artículos seleccionados: {len(asins)}")
+
+    if args.upload or args.benchmark:
+        driver = GraphDatabase.driver(
+            config["NEO4J"]["connection"],
+            auth=(config["NEO4J"]["usuario"], config["NEO4J"]["password"]),
+        )
+
+    if args.benchmark:
+        result = benchmark(collection, driver, asins, batch_size)
+        print(
+            f"{result['pairs']} parejas. Memoria: {result['python_s']:.3f} s, "
+            f"Cypher: {result['cypher_total_s']:.3f} s (carga {result['cypher_load_s']:.3f} s, "
+            f"consulta {result['cypher_query_s']:.3f} s), x{result['speedup']:.1f}. "
+            f"Mismo resultado: {result['same_result']}"
+        )
+    else:
+        pairs = shared_reviews(collection, asins, args.min_shared)
+        for user1, user2, count in pairs:
+            print(f"User {user1} and User {user2} have {count} shared reviews.")
+        print(
+            f"Se han encontrado {len(pairs)} parejas de reviewers que tienen reviews en común"
+        )
+        if args.upload:
+            upload_shared_reviews(driver, pairs, batch_size)
+
+    if args.upload or args.benchmark:
+        driver.close()
@@ -16,8 +16,24 @@ from queries import (
     get_product_asin_type,
     get_product_types,
 )
+from utils import read_config
+from cache import DiskCache, cached
 import pandas as pd
 
+# Se usa una caché en disco para que los workers del servidor de producción (serve.py)
+# no repitan las mismas agregaciones
+config = read_config()
+cache = DiskCache(config["SERVER"]["cache"], float(config["SERVER"]["ttl_cache"]))
+PRODUCTION = os.environ.get("DASHBOARD_PRODUCTION") == "1"
+
+Query_1_Evolucion_Reviews_Por_Año = cached(cache)(Query_1_Evolucion_Reviews_Por_Año)
+Query_2_Evolucion_Popularidad_Articulos = cached(cache)(
+    Query_2_Evolucion_Popularidad_Articulos
+)
+Query_3_Histograma_Por_Nota = cached(cache)(Query_3_Histograma_Por_Nota)
+get_product_asin_type = cached(cache)(get_product_asin_type)
+get_product_types = cached(cache)(get_product_types)
+
 
 tabs_styles = {"height": "44px"}
 tab_style = {
@@ -207,6 +223,7 @@ def update_reviews_por_nota(asin_type, labels):
     return graph
 
 
+@cached(cache)
 def get_evolucion_reviews_tiempo():
     result = Query_4_Evolucion_Reviews_Tiempo_Todas_Categorias()
     result_df = pd.DataFrame(result)
@@ -236,6 +253,7 @@ tab_4 = dcc.Tab(
 )
 
 
+@cached(cache)
 def get_reviews_por_usuario():
     result = Query_5_Reviews_Por_Usuario()
     result_df = pd.DataFrame(result)
@@ -295,12 +313,17 @@ tab_6_content = html.Div(
     Input(component_id="dropdown_wordcloud", component_property="value"),
 )
 def update_nube(tipo_review):
+    return html.Img(src=get_wordcloud_image(tipo_review))
+
+
+@cached(cache)
+def get_wordcloud_image(tipo_review):
     result = Query_6_Nube_Palabras_Por_Categoria(tipo_review)
 
     wc = wordcloud.WordCloud(background_color="white", width=800, height=400)
     wc.fit_words(result)
 
-    return html.Img(src=wc.to_image())
+    return wc.to_image()
 
 
 tab_6 = dcc.Tab(
@@ -312,6 +335,7 @@ tab_6 = dcc.Tab(
 )
 
 
+@cached(cache)
 def get_notas_medias():
     result = Query_7_Libre_Reviewers_Generosos()
     result_df = pd.DataFrame(result)
@@ -350,6 +374,9 @@ def apagar_servidor() -> None:
     prevent_initial_call=True,
 )
 def exit_button(n_clicks) -> None:
+    # En producción el servidor se apaga con SIGTERM al proceso principal (ver serve.py)
+    if PRODUCTION:
+        return "EL SERVIDOR DE PRODUCCIÓN NO SE PUEDE APAGAR DESDE AQUÍ"
     th = Thread(target=apagar_servidor, daemon=True)
     th.start()
     return "EL SERVIDOR SE HA APAGADO"
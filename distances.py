@@ -0,0 +1,163 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def _rated(matrix: csr_matrix) -> csr_matrix:
+    """Matriz con un 1 en cada rating que existe"""
+    rated = matrix.copy()
+    rated.data[:] = 1
+    return rated
+
+
+def _row_sums(matrix) -> np.ndarray:
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+
+def co_rated_statistics(
+    X: csr_matrix, a: np.ndarray, b: np.ndarray
+) -> tuple[np.ndarray, ...]:
+    """Calcula las sumas de los ratings de cada pareja de filas solo sobre los artículos
+    que han puntuado las dos
+
+    Se cogen las filas de las parejas y se multiplican elemento a elemento, así que el
+    coste depende de los ratings de las filas y no del número de artículos.
+
+    Args:
+        X (csr_matrix): matriz dispersa de ratings
+        a (np.ndarray): índices de la primera fila de cada pareja
+        b (np.ndarray): índices de la segunda fila de cada pareja
+
+    Returns:
+        tuple[np.ndarray, ...]: n, Σx, Σy, Σx², Σy² y Σxy de cada pareja
+    """
+    Xa = X[a].astype(np.float64)
+    Xb = X[b].astype(np.float64)
+    Ra = _rated(Xa)
+    Rb = _rated(Xb)
+
+    n = _row_sums(Ra.multiply(Rb))
+    sx = _row_sums(Xa.multiply(Rb))
+    sy = _row_sums(Ra.multiply(Xb))
+    sxx = _row_sums(Xa.multiply(Xa).multiply(Rb))
+    syy = _row_sums(Ra.multiply(Xb.multiply(Xb)))
+    sxy = _row_sums(Xa.multiply(Xb))
+    return n, sx, sy, sxx, syy, sxy
+
+
+def euclidean_distances(
+    X: csr_matrix, a: np.ndarray, b: np.ndarray, min_overlap: int = 0
+) -> np.ndarray:
+    """Distancia euclídea al cuadrado entre filas, contando como 0 los ratings que no existen
+
+    Args:
+        X (csr_matrix): matriz dispersa de ratings
+        a (np.ndarray): índices de la primera fila de cada pareja
+        b (np.ndarray): índices de la segunda fila de cada pareja
+        min_overlap (int, optional): mínimo de artículos en común (inf si no se llega). Defaults to 0.
+
+    Returns:
+        np.ndarray: distancia de cada pareja
+    """
+    Xa = X[a].astype(np.float64)
+    Xb = X[b].astype(np.float64)
+    distances = (
+        _row_sums(Xa.multiply(Xa))
+        + _row_sums(Xb.multiply(Xb))
+        - 2 * _row_sums(Xa.multiply(Xb))
+    )
+    if min_overlap > 0:
+        n = _row_sums(_rated(Xa).multiply(_rated(Xb)))
+        distances[n < min_overlap] = np.inf
+    return distances
+
+
+def msd_distances(
+    X: csr_matrix, a: np.ndarray, b: np.ndarray, min_overlap: int = 1
+) -> np.ndarray:
+    """Diferencia cuadrática media de los ratings de los artículos que han puntuado los dos
+
+    Args:
+        X (csr_matrix): matriz dispersa de ratings
+        a (np.ndarray): índices de la primera fila de cada pareja
+        b (np.ndarray): índices de la segunda fila de cada pareja
+        min_overlap (int, optional): mínimo de artículos en común (inf si no se llega). Defaults to 1.
+
+    Returns:
+        np.ndarray: distancia de cada pareja
+    """
+    n, _, _, sxx, syy, sxy = co_rated_statistics(X, a, b)
+    distances = np.full(len(n), np.inf)
+    valid = n >= max(min_overlap, 1)
+    distances[valid] = (sxx[valid] + syy[valid] - 2 * sxy[valid]) / n[valid]
+    return np.maximum(distances, 0)
+
+
+def pearson_distances(
+    X: csr_matrix, a: np.ndarray, b: np.ndarray, min_overlap: int = 2
+) -> np.ndarray:
+    """1 - correlación de Pearson de los ratings de los artículos que han puntuado los dos
+
+    Las medias son las de los artículos en común. Si alguno de los dos da siempre la
+    misma nota la correlación no está definida y la distancia es inf.
+
+    Args:
+        X (csr_matrix): matriz dispersa de ratings
+        a (np.ndarray): índices de la primera fila de cada pareja
+        b (np.ndarray): índices de la segunda fila de cada pareja
+        min_overlap (int, optional): mínimo de artículos en común (inf si no se llega). Defaults to 2.
+
+    Returns:
+        np.ndarray: distancia de cada pareja, entre 0 y 2
+    """
+    n, sx, sy, sxx, syy, sxy = co_rated_statistics(X, a, b)
+    distances = np.full(len(n), np.inf)
+
+    valid = n >= max(min_overlap, 2)
+    n, sx, sy = n[valid], sx[valid], sy[valid]
+    covariance = sxy[valid] - sx * sy / n
+    variance_x = sxx[valid] - sx**2 / n
+    variance_y = syy[valid] - sy**2 / n
+
+    # Se evita dividir entre 0 (y los errores de redondeo que dan varianzas negativas)
+    defined = (variance_x > 1e-9) & (variance_y > 1e-9)
+    correlation = np.full(len(n), np.nan)
+    correlation[defined] = covariance[defined] / np.sqrt(
+        variance_x[defined] * variance_y[defined]
+    )
+
+    valid_distances = np.where(defined, 1 - np.clip(correlation, -1, 1), np.inf)
+    distances[valid] = valid_distances
+    return distances
+
+
+DISTANCES = {
+    "euclidean": euclidean_distances,
+    "msd": msd_distances,
+    "pearson": pearson_distances,
+}
+
+
+def pair_distances(
+    metric: str,
+    X: csr_matrix,
+    a: np.ndarray,
+    b: np.ndarray,
+    min_overlap: int = 1,
+    chunk_size: int = 100000,
+) -> np.ndarray:
+    """Calcula la distancia elegida entre las parejas de filas (a[i], b[i])
+
+    Las parejas se procesan en trozos de chunk_size para que las filas copiadas de X
+    no dependan del número de parejas.
+
+    Raises:
+        ValueError: si la distancia no existe
+    """
+    if metric not in DISTANCES:
+        raise ValueError(f"Distancia desconocida: {metric}")
+    distance = DISTANCES[metric]
+    distances = np.empty(len(a), dtype=np.float64)
+    for start in range(0, len(a), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        distances[chunk] = distance(X, a[chunk], b[chunk], min_overlap)
+    return distances
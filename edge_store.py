@@ -0,0 +1,183 @@
+import datetime
+import json
+import os
+from typing import NamedTuple
+
+import numpy as np
+
+from utils import IdMap
+
+FORMAT_VERSION = 1
+
+# Registros de ancho fijo (little-endian) de cada tipo de fichero intermedio
+SIMILARITY_DTYPE = np.dtype([("src", "<i4"), ("dst", "<i4"), ("similarity", "<f4")])
+REVIEW_DTYPE = np.dtype(
+    [("src", "<i4"), ("dst", "<i4"), ("overall", "<f4"), ("review_time", "<i8")]
+)
+LINK_DTYPE = np.dtype([("src", "<i4"), ("dst", "<i4")])
+
+# Las fechas de MongoDB son UTC sin zona horaria y se guardan en segundos desde EPOCH
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_timestamp(date: datetime.datetime) -> int:
+    return int((date - EPOCH).total_seconds())
+
+
+def from_timestamp(timestamp: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(seconds=timestamp)
+
+
+class EdgeStore(NamedTuple):
+    """Aristas cargadas de un fichero binario
+
+    sources y targets son las listas de ids (targets es sources si comparten espacio de
+    ids) y edges el array estructurado de registros, mapeado en memoria.
+    """
+
+    sources: list
+    targets: list
+    edges: np.ndarray
+
+
+def _ids_path(path: str) -> str:
+    return path + ".ids.json"
+
+
+class EdgeWriter:
+    """Escribe aristas en formato binario: un fichero de registros de ancho fijo y otro
+    JSON con el diccionario de ids internados (se escribe al cerrar)
+
+    Se usa como gestor de contexto. Los ids en el JSON no tienen problemas con ningún
+    carácter, a diferencia de los ficheros de texto separados por delimitadores.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dtype: np.dtype,
+        sources: IdMap = None,
+        targets: IdMap = None,
+        shared_ids: bool = False,
+        buffer_size: int = 65536,
+    ) -> None:
+        """
+        Args:
+            path (str): fichero de registros (los ids van en path + ".ids.json")
+            dtype (np.dtype): tipo de los registros, con campos src y dst
+            sources (IdMap, optional): ids de origen ya conocidos. Defaults to None.
+            targets (IdMap, optional): ids de destino ya conocidos. Defaults to None.
+            shared_ids (bool, optional): origen y destino comparten los ids. Defaults to False.
+            buffer_size (int, optional): registros que se acumulan antes de escribir. Defaults to 65536.
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.sources = sources if sources is not None else IdMap()
+        self.shared_ids = shared_ids
+        if shared_ids:
+            self.targets = self.sources
+        else:
+            self.targets = targets if targets is not None else IdMap()
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.count = 0
+        self.fh = None
+
+    def __enter__(self) -> "EdgeWriter":
+        self.fh = open(self.path, "wb")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.fh.close()
+        if exc_type is not None:
+            return
+
+        with open(_ids_path(self.path), "w", encoding="utf-8") as fh:
+            json.dump(
+                {
+                    "version": FORMAT_VERSION,
+                    "dtype": self.dtype.descr,
+                    "count": self.count,
+                    "sources": self.sources.ids,
+                    "targets": None if self.shared_ids else self.targets.ids,
+                },
+                fh,
+            )
+
+    def add(self, source_id, target_id, *values) -> None:
+        """Añade una arista a partir de los ids originales"""
+        self.buffer.append(
+            (self.sources.add(source_id), self.targets.add(target_id), *values)
+        )
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.buffer) > 0:
+            self.write(np.array(self.buffer, dtype=self.dtype))
+            self.buffer = []
+
+    def write(self, records: np.ndarray) -> None:
+        """Escribe un bloque de registros cuyos src y dst ya son índices de los IdMap"""
+        np.ascontiguousarray(records, dtype=self.dtype).tofile(self.fh)
+        self.count += len(records)
+
+
+def load_edges(path: str, mmap: bool = True) -> EdgeStore:
+    """Carga un fichero de aristas sin copiarlo (memmap)
+
+    Args:
+        path (str): fichero de registros
+        mmap (bool, optional): mapear el fichero en memoria en vez de leerlo. Defaults to True.
+
+    Raises:
+        ValueError: si la versión del formato no es compatible
+
+    Returns:
+        EdgeStore: los ids y los registros
+    """
+    with open(_ids_path(path), "r", encoding="utf-8") as fh:
+        header = json.load(fh)
+    if header["version"] != FORMAT_VERSION:
+        raise ValueError(
+            f"Versión de formato {header['version']} no compatible en {path}"
+        )
+
+    dtype = np.dtype([tuple(field) for field in header["dtype"]])
+    if header["count"] == 0:
+        edges = np.empty(0, dtype=dtype)
+    elif mmap:
+        edges = np.memmap(path, dtype=dtype, mode="r", shape=(header["count"],))
+    else:
+        edges = np.fromfile(path, dtype=dtype, count=header["count"])
+
+    sources = header["sources"]
+    targets = sources if header["targets"] is None else header["targets"]
+    return EdgeStore(sources, targets, edges)
+
+
+def iter_edges(store: EdgeStore, block_size: int = 65536):
+    """Recorre las aristas por bloques traduciendo los índices a los ids originales
+
+    Yields:
+        tuple: array de ids de origen, array de ids de destino y el bloque de registros
+    """
+    sources = np.array(store.sources, dtype=object)
+    targets = (
+        sources
+        if store.targets is store.sources
+        else np.array(store.targets, dtype=object)
+    )
+    for start in range(0, len(store.edges), block_size):
+        block = store.edges[start : start + block_size]
+        yield sources[block["src"]], targets[block["dst"]], block
+
+
+def replace_edges(source_path: str, target_path: str) -> None:
+    """Sustituye un fichero de aristas (y sus ids) por otro"""
+    os.replace(_ids_path(source_path), _ids_path(target_path))
+    os.replace(source_path, target_path)
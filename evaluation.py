@@ -0,0 +1,373 @@
+import argparse
+import datetime
+import json
+import tracemalloc
+from typing import Iterator
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from item_knn import ItemKNN
+from matrix_factorization import ALS
+from profiling import StageTimer
+from recommender import KNN, split_ratings, to_csr
+
+# Rating a partir del cual un artículo se considera relevante para precision@k y recall@k
+RELEVANT_RATING = 4
+
+
+def kfold_splits(
+    X: csr_matrix, n_folds: int = 5, seed: int = 33
+) -> Iterator[tuple[csr_matrix, np.ndarray, np.ndarray, np.ndarray]]:
+    """Reparte los ratings al azar en n_folds partes y usa cada una como test
+
+    Args:
+        X (csr_matrix): matriz dispersa de ratings
+        n_folds (int, optional): número de partes. Defaults to 5.
+        seed (int, optional): semilla, para reproducibilidad. Defaults to 33.
+
+    Yields:
+        tuple: matriz de train y filas, columnas y ratings de test de cada parte
+    """
+    X_coo = X.tocoo()
+    folds = np.random.default_rng(seed).permutation(X.nnz) % n_folds
+    for fold in range(n_folds):
+        test = folds == fold
+        X_train = to_csr(X_coo.row[~test], X_coo.col[~test], X_coo.data[~test], X.shape)
+        yield X_train, X_coo.row[test], X_coo.col[test], X_coo.data[test]
+
+
+def error_metrics(predicted: np.ndarray, ratings: np.ndarray) -> dict:
+    """MAE y RMSE de los ratings predichos (los nan no cuentan) y cobertura
+
+    Returns:
+        dict: mae, rmse y fracción de ratings de test con predicción
+    """
+    predicted_mask = ~np.isnan(predicted)
+    errors = predicted[predicted_mask].astype(np.float64) - ratings[predicted_mask]
+    return {
+        "mae": float(np.mean(np.abs(errors))) if len(errors) > 0 else None,
+        "rmse": float(np.sqrt(np.mean(errors**2))) if len(errors) > 0 else None,
+        "coverage": float(predicted_mask.mean()) if len(ratings) > 0 else 0.0,
+    }
+
+
+def ranking_metrics(
+    rows: np.ndarray,
+    predicted: np.ndarray,
+    ratings: np.ndarray,
+    k: int = 10,
+    threshold: float = RELEVANT_RATING,
+) -> dict:
+    """Precision@k y recall@k medios de los reviewers con ratings de test
+
+    Para cada reviewer se ordenan sus artículos de test por rating predicho. Son
+    relevantes los que tienen un rating real >= threshold y recomendados los del top-k
+    con rating predicho >= threshold (sin predicción no se recomiendan).
+
+    Args:
+        rows (np.ndarray): reviewer de cada rating de test
+        predicted (np.ndarray): ratings predichos
+        ratings (np.ndarray): ratings reales
+        k (int, optional): número de recomendaciones. Defaults to 10.
+        threshold (float, optional): rating mínimo de un artículo relevante. Defaults to RELEVANT_RATING.
+
+    Returns:
+        dict: precision@k y recall@k (None si ningún reviewer tiene recomendados o relevantes)
+    """
+    scores = np.where(np.isnan(predicted), -np.inf, predicted)
+
+    # Se ordena por reviewer y, dentro de cada reviewer, por rating predicho
+    order = np.lexsort((-scores, rows))
+    rows, scores, ratings = rows[order], scores[order], ratings[order]
+    users, starts, counts = np.unique(rows, return_index=True, return_counts=True)
+    rank = np.arange(len(rows)) - np.repeat(starts, counts)
+
+    relevant = ratings >= threshold
+    recommended = (rank < k) & (scores >= threshold)
+    user_index = np.repeat(np.arange(len(users)), counts)
+    n_relevant = np.bincount(user_index, relevant, len(users))
+    n_recommended = np.bincount(user_index, recommended, len(users))
+    hits = np.bincount(user_index, relevant & recommended, len(users))
+
+    with_recommended = n_recommended > 0
+    with_relevant = n_relevant > 0
+    return {
+        f"precision@{k}": (
+            float(np.mean(hits[with_recommended] / n_recommended[with_recommended]))
+            if with_recommended.any()
+            else None
+        ),
+        f"recall@{k}": (
+            float(np.mean(hits[with_relevant] / n_relevant[with_relevant]))
+            if with_relevant.any()
+            else None
+        ),
+    }
+
+
+def make_engine(name: str, n_neighbors: int = None, config=None):
+    """Crea un modelo sin entrenar
+
+    Args:
+        name (str): "knn", "item_knn" o "als"
+        n_neighbors (int, optional): vecinos de knn e item_knn. Defaults to None.
+        config (optional): configuración con la sección RECOMMENDER. Defaults to None.
+
+    Raises:
+        ValueError: si el modelo no existe
+    """
+    recommender_config = config["RECOMMENDER"] if config is not None else {}
+    if name == "knn":
+        return KNN(
+            n_neighbors,
+            metric=recommender_config.get("distancia", "msd"),
+            min_overlap=int(recommender_config.get("min_articulos_comunes", 1)),
+        )
+    if name == "item_knn":
+        return ItemKNN(
+            n_neighbors, int(recommender_config.get("min_reviewers_comunes", 2))
+        )
+    if name == "als":
+        return ALS(
+            int(recommender_config.get("factores", 20)),
+            float(recommender_config.get("regularizacion", 0.1)),
+            int(recommender_config.get("iteraciones", 10)),
+            n_threads=int(recommender_config.get("hilos", 1)),
+            seed=33,
+        )
+    raise ValueError(f"Modelo desconocido: {name}")
+
+
+def evaluate(
+    model,
+    X_train: csr_matrix,
+    rows: np.ndarray,
+    cols: np.ndarray,
+    ratings: np.ndarray,
+    similarity_matrix: csr_matrix = None,
+    reviewers: dict = None,
+    items: dict = None,
+    k: int = 10,
+    trace_memory: bool = True,
+) -> dict:
+    """Entrena un modelo y mide sus errores, su ranking, sus tiempos y su memoria
+
+    Args:
+        model: KNN, ItemKNN o ALS sin entrenar
+        X_train (csr_matrix): ratings de entrenamiento
+        rows (np.ndarray): reviewer de cada rating de test
+        cols (np.ndarray): artículo de cada rating de test
+        ratings (np.ndarray): ratings de test
+        similarity_matrix (csr_matrix, optional): similitudes entre reviewers (KNN). Defaults to None.
+        reviewers (dict, optional): diccionario de reviewer a fila. Defaults to None.
+        items (dict, optional): diccionario de artículo a columna. Defaults to None.
+        k (int, optional): k de precision@k y recall@k. Defaults to 10.
+        trace_memory (bool, optional): medir el pico de memoria con tracemalloc. Defaults to True.
+
+    Returns:
+        dict: métricas de la evaluación
+    """
+    timer = StageTimer(type(model).__name__, trace_memory)
+    with timer.stage("fit") as stage:
+        model.fit(X_train, similarity_matrix, reviewers, items)
+        stage["rows"] = X_train.nnz
+    with timer.stage("predict") as stage:
+        predicted = model.predict_pairs(rows, cols)
+        stage["rows"] = len(rows)
+    if trace_memory:
+        # Se para tracemalloc para que no ralentice lo que se ejecute después
+        tracemalloc.stop()
+
+    fit, predict = timer.stages
+    return {
+        "train_ratings": X_train.nnz,
+        "test_ratings": len(ratings),
+        **error_metrics(predicted, ratings),
+        **ranking_metrics(rows, predicted, ratings, k),
+        "fit_s": fit["seconds"],
+        "predict_s": predict["seconds"],
+        "predictions_per_second": predict.get("rows_per_second"),
+        "fit_peak_mb": fit.get("peak_traced_mb"),
+        "predict_peak_mb": predict.get("peak_traced_mb"),
+        "max_rss_mb": predict["max_rss_mb"],
+    }
+
+
+def subsample(
+    X: csr_matrix,
+    similarity_matrix: csr_matrix,
+    reviewers: dict,
+    size: int,
+    seed: int = 33,
+) -> tuple[csr_matrix, csr_matrix, dict]:
+    """Se queda con size reviewers al azar (con sus ratings y sus similitudes)"""
+    if size is None or size >= X.shape[0]:
+        return X, similarity_matrix, reviewers
+    selected = np.sort(np.random.default_rng(seed).choice(X.shape[0], size, False))
+    ids = {i: reviewer_id for reviewer_id, i in reviewers.items()}
+    return (
+        X[selected],
+        similarity_matrix[selected][:, selected],
+        {ids[i]: new_i for new_i, i in enumerate(selected.tolist())},
+    )
+
+
+def sweep(
+    X: csr_matrix,
+    similarity_matrix: csr_matrix,
+    reviewers: dict,
+    items: dict = None,
+    engines: list = ("knn",),
+    neighbors: list = (20,),
+    sizes: list = (None,),
+    n_folds: int = 0,
+    test_fraction: float = 0.1,
+    k: int = 10,
+    seed: int = 33,
+    config=None,
+    trace_memory: bool = True,
+) -> list[dict]:
+    """Evalúa los modelos con cada número de vecinos y cada tamaño de datos
+
+    ALS no tiene vecinos, así que se evalúa una vez por tamaño.
+
+    Args:
+        X (csr_matrix): matriz dispersa de ratings
+        similarity_matrix (csr_matrix): similitudes entre reviewers (KNN)
+        reviewers (dict): diccionario de reviewer a fila
+        items (dict, optional): diccionario de artículo a columna. Defaults to None.
+        engines (list, optional): modelos ("knn", "item_knn", "als"). Defaults to ("knn",).
+        neighbors (list, optional): valores de n_neighbors. Defaults to (20,).
+        sizes (list, optional): número de reviewers (None para todos). Defaults to (None,).
+        n_folds (int, optional): partes de la validación cruzada; con 0 se usa una sola
+            partición de test_fraction. Defaults to 0.
+        test_fraction (float, optional): fracción de test sin validación cruzada. Defaults to 0.1.
+        k (int, optional): k de precision@k y recall@k. Defaults to 10.
+        seed (int, optional): semilla de las particiones y del muestreo. Defaults to 33.
+        config (optional): configuración con la sección RECOMMENDER. Defaults to None.
+        trace_memory (bool, optional): medir el pico de memoria con tracemalloc. Defaults to True.
+
+    Returns:
+        list[dict]: una evaluación por modelo, vecinos, tamaño y parte
+    """
+    results = []
+    for size in sizes:
+        X_size, similarity_size, reviewers_size = subsample(
+            X, similarity_matrix, reviewers, size, seed
+        )
+        if n_folds > 1:
+            splits = list(kfold_splits(X_size, n_folds, seed))
+        else:
+            splits = [split_ratings(X_size, test_fraction, seed)]
+
+        for engine in engines:
+            for n_neighbors in neighbors if engine != "als" else (None,):
+                for fold, (X_train, rows, cols, ratings) in enumerate(splits):
+                    model = make_engine(engine, n_neighbors, config)
+                    result = evaluate(
+                        model,
+                        X_train,
+                        rows,
+                        cols,
+                        ratings,
+                        similarity_size,
+                        reviewers_size,
+                        items,
+                        k,
+                        trace_memory,
+                    )
+                    results.append(
+                        {
+                            "engine": engine,
+                            "n_neighbors": n_neighbors,
+                            "reviewers": X_size.shape[0],
+                            "fold": fold,
+                            **result,
+                        }
+                    )
+    return results
+
+
+def write_results(results: list[dict], parameters: dict, path: str) -> None:
+    """Guarda las evaluaciones en JSON con los parámetros y la fecha"""
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(
+            {
+                "created_at": datetime.datetime.now().isoformat(),
+                "parameters": parameters,
+                "results": results,
+            },
+            fh,
+            indent=2,
+            default=str,
+        )
+
+
+if __name__ == "__main__":
+    from queries import obtener_tuplas_items
+    from recommender import load_ratings_matrix, load_similarity_matrix
+    from utils import get_collection, read_config
+
+    config = read_config()
+
+    parser = argparse.ArgumentParser(
+        description="Evalúa los modelos de recomendación y guarda los resultados en JSON"
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=["knn", "item_knn", "als"],
+        default=["knn", "item_knn", "als"],
+    )
+    parser.add_argument("--neighbors", nargs="+", type=int, default=[5, 10, 20, 40])
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=None,
+        help="número de reviewers de cada evaluación (por defecto, todos)",
+    )
+    parser.add_argument(
+        "--folds", type=int, default=0, help="validación cruzada (0 para holdout)"
+    )
+    parser.add_argument("--test-fraction", type=float, default=0.1)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=33)
+    parser.add_argument(
+        "--no-trace-memory",
+        action="store_true",
+        help="no mide el pico de memoria (tracemalloc ralentiza el entrenamiento)",
+    )
+    parser.add_argument("--output", default="evaluacion.json")
+    args = parser.parse_args()
+
+    items = {item: i for i, item in enumerate(obtener_tuplas_items())}
+    reviewers, similarity_matrix = load_similarity_matrix(
+        config["NEO4J"]["fichero_similitud"]
+    )
+    X = load_ratings_matrix(get_collection(config), reviewers, items)
+
+    results = sweep(
+        X,
+        similarity_matrix,
+        reviewers,
+        items,
+        args.engines,
+        args.neighbors,
+        args.sizes or [None],
+        args.folds,
+        args.test_fraction,
+        args.k,
+        args.seed,
+        config,
+        not args.no_trace_memory,
+    )
+    write_results(results, vars(args), args.output)
+    for result in results:
+        print(
+            f"{result['engine']} (vecinos={result['n_neighbors']}, reviewers={result['reviewers']}, "
+            f"parte={result['fold']}): MAE {result['mae']}, RMSE {result['rmse']}, "
+            f"cobertura {result['coverage']:.02%}, fit {result['fit_s']:.3f} s"
+        )
+    print(f"Resultados guardados en {args.output}")
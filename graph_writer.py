@@ -0,0 +1,97 @@
+import time
+
+# Restricciones de unicidad (que también crean el índice) y los índices de las
+# propiedades que se usan en los MERGE de las cargas
+SCHEMA_QUERIES = [
+    "CREATE CONSTRAINT user_user_id IF NOT EXISTS FOR (u:User) REQUIRE u.user_id IS UNIQUE",
+    "CREATE CONSTRAINT product_id IF NOT EXISTS FOR (p:Product) REQUIRE p.id IS UNIQUE",
+    "CREATE CONSTRAINT article_asin IF NOT EXISTS FOR (a:Article) REQUIRE a.asin IS UNIQUE",
+    "CREATE CONSTRAINT product_type IF NOT EXISTS FOR (t:ProductType) REQUIRE t.product_type IS UNIQUE",
+    "CREATE CONSTRAINT reviewer_id IF NOT EXISTS FOR (r:Reviewer) REQUIRE r.id IS UNIQUE",
+    "CREATE INDEX user_reviewer_id IF NOT EXISTS FOR (u:User) ON (u.reviewerID)",
+]
+
+
+def create_schema(driver) -> None:
+    """Crea las restricciones e índices de Neo4j si no existen
+
+    Sin ellos cada MERGE tiene que recorrer todos los nodos de la etiqueta.
+
+    Args:
+        driver: driver de la conexión a Neo4j
+    """
+    with driver.session() as session:
+        for query in SCHEMA_QUERIES:
+            session.run(query).consume()
+        session.run("CALL db.awaitIndexes()").consume()
+
+
+class GraphWriter:
+    """Escribe en Neo4j por lotes: acumula filas y las manda con UNWIND en una transacción
+
+    La query tiene que empezar por "UNWIND $rows AS row". Se usa como gestor de
+    contexto para que al salir se escriba el último lote y se muestre el informe.
+    """
+
+    def __init__(
+        self, driver, query: str, batch_size: int = 10000, name: str = "Neo4j"
+    ) -> None:
+        """
+        Args:
+            driver: driver de la conexión a Neo4j
+            query (str): query con UNWIND $rows AS row
+            batch_size (int, optional): filas por transacción. Defaults to 10000.
+            name (str, optional): nombre que aparece en el informe. Defaults to "Neo4j".
+        """
+        self.driver = driver
+        self.query = query
+        self.batch_size = batch_size
+        self.name = name
+        self.rows = []
+        self.written = 0
+        self.elapsed = 0.0
+        self.session = None
+
+    def __enter__(self) -> "GraphWriter":
+        self.session = self.driver.session()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.flush()
+                self.report()
+        finally:
+            self.session.close()
+
+    def add(self, row: dict) -> None:
+        """Añade una fila al lote y lo escribe si está lleno"""
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows) -> None:
+        for row in rows:
+            self.add(row)
+
+    def flush(self) -> None:
+        """Escribe el lote actual en una transacción explícita"""
+        if len(self.rows) == 0:
+            return
+
+        rows = self.rows
+        self.rows = []
+
+        start = time.perf_counter()
+        self.session.execute_write(lambda tx: tx.run(self.query, rows=rows).consume())
+        self.elapsed += time.perf_counter() - start
+        self.written += len(rows)
+
+    def rate(self) -> float:
+        """Filas (aristas) escritas por segundo"""
+        return self.written / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self) -> None:
+        print(
+            f"{self.name}: {self.written} filas en {self.elapsed:.2f} s ({self.rate():.0f} aristas/s)"
+        )
@@ -0,0 +1,602 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from bson import ObjectId
+from pymongo.collection import Collection
+from scipy.sparse import coo_matrix, csr_matrix, vstack
+
+from matrix_factorization import load_all_ratings_matrix
+from parallel_predict import parallel_predict, parallel_predict_pairs
+from recommender import (
+    LOAD_BATCH_SIZE,
+    RATING_PROJECTION,
+    CooArrays,
+    read_ratings,
+    split_ratings,
+)
+from similarity import load_shared_matrix, save_shared_matrix
+from utils import IdMap, get_ingest_watermark, ingested_between
+
+# Versión del formato de los índices guardados con ItemKNN.save
+ITEM_INDEX_VERSION = 1
+
+
+class ItemKNN:
+    """Predice el rating de un artículo con los ratings del propio reviewer a los k
+    artículos más parecidos
+
+    Las similitudes entre artículos (coseno ajustado: ratings centrados en la media de
+    cada reviewer) se calculan por bloques con productos de matrices dispersas y se
+    guardan solo las positivas con al menos min_overlap reviewers en común. De cada
+    artículo se guardan sus k vecinos en un índice como el de KNN. Cuando cambian los
+    ratings de algunos reviewers, update recalcula solo los artículos afectados.
+    """
+
+    def __init__(self, k=20, min_overlap=2, block_size=1000) -> None:
+        """
+        Args:
+            k (int, optional): número de artículos vecinos. Defaults to 20.
+            min_overlap (int, optional): reviewers en común que tienen que tener dos
+                artículos para ser vecinos. Defaults to 2.
+            block_size (int, optional): artículos o reviewers que se procesan a la vez. Defaults to 1000.
+        """
+        self.k = k
+        self.min_overlap = min_overlap
+        self.block_size = block_size
+        # Directorio del índice guardado o cargado (lo usan los workers de predict)
+        self.directory = None
+
+    def fit(self, X, similarity_matrix=None, reviewers=None, items=None) -> None:
+        """Calcula las similitudes entre todos los artículos y el índice de vecinos
+
+        Args:
+            X: matriz dispersa de ratings reviewer x artículo
+            similarity_matrix (optional): no se usa, está para poder cambiar KNN por ItemKNN. Defaults to None.
+            reviewers (dict, optional): diccionario de reviewer a fila. Defaults to None.
+            items (dict, optional): diccionario de (asin, type_id) a columna. Defaults to None.
+        """
+        self.reviewers = reviewers
+        self.items = items
+        self._set_ratings(X)
+
+        m = self.X.shape[1]
+        self.similarities = self._similarity_rows(np.arange(m))
+        self.neighbor_index = np.full((m, self.k), -1, dtype=np.int32)
+        self.neighbor_weights = np.zeros((m, self.k), dtype=np.float32)
+        self._update_index(np.arange(m))
+
+    def update(self, X, changed_rows, reviewers=None, items=None) -> int:
+        """Actualiza las similitudes y el índice después de cambiar algunos reviewers
+
+        La similitud de dos artículos solo depende de sus columnas (centradas con la media
+        de cada reviewer), así que solo cambian las de los artículos puntuados por los
+        reviewers que han cambiado. El top-k se recalcula en esos artículos y en los que
+        tenían o tienen alguno de ellos como candidato.
+
+        Args:
+            X: nueva matriz de ratings; las filas y columnas anteriores mantienen su índice
+                y puede tener reviewers o artículos nuevos al final
+            changed_rows: filas de los reviewers con ratings nuevos, cambiados o borrados
+            reviewers (dict, optional): nuevo diccionario de reviewer a fila. Defaults to None.
+            items (dict, optional): nuevo diccionario de artículo a columna. Defaults to None.
+
+        Returns:
+            int: número de artículos cuyo top-k se ha recalculado
+        """
+        changed_rows = np.asarray(changed_rows, dtype=np.int64)
+        old_X = self.X
+        self._set_ratings(X)
+        if reviewers is not None:
+            self.reviewers = reviewers
+        if items is not None:
+            self.items = items
+
+        n, m = self.X.shape
+        old_m = old_X.shape[1]
+
+        # Artículos que puntuaban o puntúan los reviewers que han cambiado, y los nuevos
+        old_rows = changed_rows[changed_rows < old_X.shape[0]]
+        affected = np.union1d(
+            old_X[old_rows].indices, self.X[changed_rows].indices
+        ).astype(np.int64)
+        affected = np.union1d(affected, np.arange(old_m, m))
+
+        # Se quitan las filas y columnas afectadas y se ponen las recalculadas
+        similarities = self.similarities.tocoo()
+        similarities.resize((m, m))
+        is_affected = np.zeros(m, dtype=bool)
+        is_affected[affected] = True
+        keep = ~(is_affected[similarities.row] | is_affected[similarities.col])
+        old_candidates = self.similarities[affected[affected < old_m]].indices
+
+        new_rows = self._similarity_rows(affected).tocoo()
+        new_rows_index = affected[new_rows.row]
+        # Las filas recalculadas dan también las columnas (la similitud es simétrica),
+        # sin repetir las parejas en las que los dos artículos están afectados
+        mirrored = ~is_affected[new_rows.col]
+        self.similarities = coo_matrix(
+            (
+                np.concatenate(
+                    (
+                        similarities.data[keep],
+                        new_rows.data,
+                        new_rows.data[mirrored],
+                    )
+                ),
+                (
+                    np.concatenate(
+                        (
+                            similarities.row[keep],
+                            new_rows_index,
+                            new_rows.col[mirrored],
+                        )
+                    ),
+                    np.concatenate(
+                        (
+                            similarities.col[keep],
+                            new_rows.col,
+                            new_rows_index[mirrored],
+                        )
+                    ),
+                ),
+            ),
+            shape=(m, m),
+        ).tocsr()
+
+        # Se amplía el índice con los artículos nuevos y se recalcula el top-k
+        if m > old_m:
+            self.neighbor_index = np.vstack(
+                (self.neighbor_index, np.full((m - old_m, self.k), -1, dtype=np.int32))
+            )
+            self.neighbor_weights = np.vstack(
+                (self.neighbor_weights, np.zeros((m - old_m, self.k), dtype=np.float32))
+            )
+        else:
+            self.neighbor_index = np.array(self.neighbor_index)
+            self.neighbor_weights = np.array(self.neighbor_weights)
+        refreshed = np.union1d(
+            np.union1d(affected, old_candidates), new_rows.col
+        ).astype(np.int64)
+        self._update_index(refreshed)
+        return len(refreshed)
+
+    def _set_ratings(self, X) -> None:
+        self.X = csr_matrix(X, dtype=np.float32)
+        self.centered = None
+        self.weight_matrix = None
+        self.weight_matrix_t = None
+        self.directory = None
+
+    def _centered_ratings(self) -> None:
+        """Calcula los ratings centrados en la media de cada reviewer y sus normas
+
+        Solo hacen falta para calcular similitudes (fit y update), así que no se calculan
+        al cargar el índice y los workers de predict no los copian.
+        """
+        if self.centered is not None:
+            return
+        self.rated = self.X.copy()
+        self.rated.data[:] = 1
+        self.rated_csc = self.rated.tocsc()
+
+        # Ratings centrados en la media de cada reviewer, por columnas
+        counts = np.diff(self.X.indptr)
+        means = np.asarray(self.X.sum(axis=1)).ravel() / np.maximum(counts, 1)
+        centered = self.X.astype(np.float64)
+        centered.data -= np.repeat(means, counts)
+        self.centered = centered
+        self.centered_csc = centered.tocsc()
+        self.norms = np.sqrt(
+            np.asarray(centered.multiply(centered).sum(axis=0)).ravel()
+        )
+
+    def _similarity_rows(self, items: np.ndarray) -> csr_matrix:
+        """Calcula las similitudes de los artículos indicados con todos los demás
+
+        Returns:
+            csr_matrix: matriz (len(items), n_artículos) con las similitudes positivas
+        """
+        self._centered_ratings()
+        blocks = []
+        for start in range(0, len(items), self.block_size):
+            block = items[start : start + self.block_size]
+            dot = (self.centered_csc[:, block].T @ self.centered).tocoo()
+            common = (self.rated_csc[:, block].T @ self.rated).tocsr()
+
+            denominator = self.norms[block][dot.row] * self.norms[dot.col]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                similarity = dot.data / denominator
+            overlap = np.asarray(common[dot.row, dot.col]).ravel()
+            valid = (
+                (denominator > 0)
+                & (similarity > 0)
+                & (overlap >= self.min_overlap)
+                & (block[dot.row] != dot.col)
+            )
+            blocks.append(
+                csr_matrix(
+                    (
+                        similarity[valid].astype(np.float32),
+                        (dot.row[valid], dot.col[valid]),
+                    ),
+                    shape=(len(block), self.X.shape[1]),
+                )
+            )
+        if len(blocks) == 0:
+            return csr_matrix((0, self.X.shape[1]), dtype=np.float32)
+        return vstack(blocks, format="csr")
+
+    def _update_index(self, items: np.ndarray) -> None:
+        """Recalcula los k vecinos de los artículos indicados a partir de las similitudes
+
+        Se ordenan las similitudes de cada artículo de mayor a menor (en los empates,
+        por índice del artículo) y se quedan las k primeras.
+        """
+        for start in range(0, len(items), self.block_size):
+            block = items[start : start + self.block_size]
+            candidates = self.similarities[block].tocoo()
+            order = np.lexsort((candidates.col, -candidates.data, candidates.row))
+            rows = candidates.row[order]
+            starts = np.searchsorted(rows, np.arange(len(block)))
+            rank = np.arange(len(rows)) - starts[rows]
+            top = rank < self.k
+
+            neighbors = np.full((len(block), self.k), -1, dtype=np.int32)
+            weights = np.zeros((len(block), self.k), dtype=np.float32)
+            neighbors[rows[top], rank[top]] = candidates.col[order][top]
+            weights[rows[top], rank[top]] = candidates.data[order][top]
+            self.neighbor_index[block] = neighbors
+            self.neighbor_weights[block] = weights
+        self.weight_matrix = None
+        self.weight_matrix_t = None
+
+    def neighbors(self, items) -> np.ndarray:
+        """Devuelve los vecinos de varios artículos, ordenados por similitud (-1 si faltan)"""
+        return self.neighbor_index[np.asarray(items, dtype=np.int64)]
+
+    def _weights(self) -> csr_matrix:
+        """Matriz (n_artículos, n_artículos) con la similitud de cada artículo con sus vecinos"""
+        if self.weight_matrix is None:
+            valid = self.neighbor_index >= 0
+            self.weight_matrix = csr_matrix(
+                (
+                    self.neighbor_weights[valid],
+                    (np.nonzero(valid)[0], self.neighbor_index[valid]),
+                ),
+                shape=(self.X.shape[1], self.X.shape[1]),
+                dtype=np.float32,
+            )
+        return self.weight_matrix
+
+    def _prediction_bound(self, Y: csr_matrix) -> np.ndarray:
+        """Máximo de valores de cada fila de predict: los ratings de la fila más los
+        artículos que tienen como vecino alguno de ellos"""
+        valid = self.neighbor_index >= 0
+        in_degree = np.bincount(
+            np.asarray(self.neighbor_index)[valid], minlength=self.X.shape[1]
+        )
+        rated = csr_matrix(
+            (np.ones(Y.nnz, dtype=np.int64), Y.indices, Y.indptr), shape=Y.shape
+        )
+        return np.diff(Y.indptr) + rated @ in_degree
+
+    def _predict_block(
+        self, Y_block: csr_matrix, rows: np.ndarray = None
+    ) -> csr_matrix:
+        """Completa las filas de un bloque de reviewers con sus propios ratings"""
+        if self.weight_matrix_t is None:
+            self.weight_matrix_t = self._weights().T.tocsr()
+        known = Y_block.copy()
+        known.data[:] = 1
+
+        sums = Y_block @ self.weight_matrix_t
+        totals = known @ self.weight_matrix_t
+        predictions = sums.multiply(totals.power(-1)).tocsr()
+
+        # Solo se completan los artículos que el reviewer no ha puntuado
+        predictions = predictions - predictions.multiply(known)
+        predictions.eliminate_zeros()
+
+        return Y_block + predictions
+
+    def predict(self, reviewer_ratings_matrix, n_workers: int = 1):
+        """Completa los artículos no puntuados con la media ponderada de los ratings del
+        reviewer a los vecinos de cada artículo
+
+        Se usan los ratings de la matriz que se pasa, así que también sirve para reviewers
+        que no estaban al entrenar.
+
+        Args:
+            reviewer_ratings_matrix: ratings de los reviewers
+            n_workers (int, optional): procesos entre los que se reparten los bloques de
+                reviewers (ver parallel_predict). Defaults to 1.
+
+        Returns:
+            csr_matrix: la matriz completada
+        """
+        Y = csr_matrix(reviewer_ratings_matrix, dtype=np.float32)
+        if n_workers > 1:
+            return parallel_predict(self, Y, load_model, n_workers)
+
+        n = Y.shape[0]
+        blocks = []
+        for start in range(0, n, self.block_size):
+            end = min(start + self.block_size, n)
+            blocks.append(self._predict_block(Y[start:end]))
+        return vstack(blocks, format="csr")
+
+    def predict_pairs(
+        self, reviewer_indexes, item_indexes, n_workers: int = 1
+    ) -> np.ndarray:
+        """Predice solo los ratings de las parejas (reviewer, artículo) pedidas
+
+        Args:
+            reviewer_indexes: índices de los reviewers
+            item_indexes: índices de los artículos
+            n_workers (int, optional): procesos entre los que se reparten las parejas. Defaults to 1.
+
+        Returns:
+            np.ndarray: rating predicho de cada pareja, nan si el reviewer no ha puntuado
+                ningún vecino del artículo
+        """
+        if n_workers > 1:
+            return parallel_predict_pairs(
+                self, reviewer_indexes, item_indexes, load_model, n_workers
+            )
+        reviewer_indexes = np.asarray(reviewer_indexes, dtype=np.int64)
+        item_indexes = np.asarray(item_indexes, dtype=np.int64)
+        predictions = np.full(len(reviewer_indexes), np.nan, dtype=np.float32)
+        for start in range(0, len(reviewer_indexes), self.block_size):
+            block = slice(start, start + self.block_size)
+            neighbors = self.neighbors(item_indexes[block]).astype(np.int64)
+            weights = self.neighbor_weights[item_indexes[block]]
+
+            # Ratings del reviewer a los vecinos del artículo de cada pareja (0 si no hay)
+            rows = np.broadcast_to(reviewer_indexes[block][:, None], neighbors.shape)
+            ratings = np.zeros(neighbors.shape, dtype=np.float32)
+            valid = neighbors >= 0
+            ratings[valid] = np.asarray(self.X[rows[valid], neighbors[valid]]).ravel()
+            weights = np.where(ratings > 0, weights, 0)
+
+            sums = (weights * ratings).sum(axis=1)
+            totals = weights.sum(axis=1)
+            predicted = predictions[block]
+            has_ratings = totals > 0
+            predicted[has_ratings] = sums[has_ratings] / totals[has_ratings]
+        return predictions
+
+    def save(self, directory: str, watermark: ObjectId = None) -> None:
+        """Guarda las similitudes, el índice de vecinos, los ratings y los mapas de ids
+
+        Args:
+            directory (str): directorio del índice
+            watermark (ObjectId, optional): marca de la última review tenida en cuenta
+                (get_ingest_watermark), para refresh_item_index. Defaults to None.
+        """
+        os.makedirs(directory, exist_ok=True)
+        save_shared_matrix(directory, "ratings", self.X)
+        self.directory = directory
+        save_shared_matrix(directory, "similarities", self.similarities)
+        np.save(os.path.join(directory, "neighbors.npy"), self.neighbor_index)
+        np.save(os.path.join(directory, "neighbor_weights.npy"), self.neighbor_weights)
+
+        reviewers = None
+        if self.reviewers is not None:
+            reviewers = [None] * len(self.reviewers)
+            for reviewer_id, i in self.reviewers.items():
+                reviewers[i] = reviewer_id
+        items = None
+        if self.items is not None:
+            items = [None] * len(self.items)
+            for item, j in self.items.items():
+                items[j] = item
+
+        with open(os.path.join(directory, "index.json"), "w", encoding="utf-8") as fh:
+            json.dump(
+                {
+                    "version": ITEM_INDEX_VERSION,
+                    "k": self.k,
+                    "min_overlap": self.min_overlap,
+                    "block_size": self.block_size,
+                    "watermark": None if watermark is None else str(watermark),
+                    "reviewers": reviewers,
+                    "items": items,
+                },
+                fh,
+            )
+
+    @classmethod
+    def load(cls, directory: str) -> tuple["ItemKNN", ObjectId]:
+        """Carga un índice guardado con save
+
+        Los ratings y el índice de vecinos se abren con memmap; update los copia si hace
+        falta modificarlos.
+
+        Args:
+            directory (str): directorio del índice
+
+        Raises:
+            ValueError: si la versión del índice no es compatible
+
+        Returns:
+            tuple[ItemKNN, ObjectId]: el modelo y la marca de la última review tenida en
+                cuenta (None si no se guardó o es una fecha de una versión anterior)
+        """
+        with open(os.path.join(directory, "index.json"), "r", encoding="utf-8") as fh:
+            index = json.load(fh)
+        if index["version"] != ITEM_INDEX_VERSION:
+            raise ValueError(
+                f"Versión de índice {index['version']} no compatible en {directory}"
+            )
+
+        model = cls(index["k"], index["min_overlap"], index["block_size"])
+        model.reviewers = (
+            None
+            if index["reviewers"] is None
+            else {reviewer_id: i for i, reviewer_id in enumerate(index["reviewers"])}
+        )
+        model.items = (
+            None
+            if index["items"] is None
+            else {tuple(item): j for j, item in enumerate(index["items"])}
+        )
+        model._set_ratings(load_shared_matrix(directory, "ratings"))
+        model.similarities = load_shared_matrix(directory, "similarities")
+        model.neighbor_index = np.load(
+            os.path.join(directory, "neighbors.npy"), mmap_mode="r"
+        )
+        model.neighbor_weights = np.load(
+            os.path.join(directory, "neighbor_weights.npy"), mmap_mode="r"
+        )
+        # Las versiones anteriores guardaban un reviewTime; sin marca se revisan todos
+        watermark = (
+            ObjectId(index["watermark"])
+            if ObjectId.is_valid(index["watermark"])
+            else None
+        )
+        model.directory = directory
+        return model, watermark
+
+
+def load_model(directory: str) -> ItemKNN:
+    """Carga solo el modelo de un índice guardado con ItemKNN.save (para los workers)"""
+    return ItemKNN.load(directory)[0]
+
+
+def refresh_item_index(
+    collection: Collection,
+    directory: str,
+    items: dict,
+    k: int = 20,
+    min_overlap: int = 2,
+    chunk_size: int = 5000,
+) -> int:
+    """Actualiza el índice de artículos guardado con las reviews cargadas desde la
+    última ejecución
+
+    Se buscan los reviewers con reviews cargadas después de la marca guardada (por su
+    _id, ver get_ingest_watermark), se cambian sus filas de la matriz de ratings y se
+    recalculan solo los artículos afectados con ItemKNN.update. Si no hay índice se
+    entrena con todas las reviews.
+
+    Args:
+        collection (Collection): colección de MongoDB
+        directory (str): directorio del índice
+        items (dict): diccionario de (asin, type_id) a columna; los artículos del índice
+            tienen que mantener su columna
+        k (int, optional): artículos vecinos (solo al entrenar desde cero). Defaults to 20.
+        min_overlap (int, optional): reviewers en común (solo al entrenar desde cero). Defaults to 2.
+        chunk_size (int, optional): reviewers cuyas reviews se traen en cada consulta. Defaults to 5000.
+
+    Raises:
+        ValueError: si algún artículo del índice ha cambiado de columna
+
+    Returns:
+        int: número de artículos cuyo top-k se ha recalculado
+    """
+    # Se fija la nueva marca antes de leer para no perder reviews que lleguen durante la ejecución
+    new_watermark = get_ingest_watermark(collection)
+
+    if not os.path.exists(os.path.join(directory, "index.json")):
+        print("No hay un índice anterior, se calculan todas las similitudes")
+        reviewers, X = load_all_ratings_matrix(collection, items)
+        model = ItemKNN(k, min_overlap)
+        model.fit(X, reviewers=reviewers, items=items)
+        model.save(directory, new_watermark)
+        return X.shape[1]
+
+    model, watermark = ItemKNN.load(directory)
+    if any(items.get(item) != j for item, j in model.items.items()):
+        raise ValueError(
+            "Los artículos del índice han cambiado de columna, hay que volver a entrenarlo"
+        )
+
+    # Reviewers con reviews cargadas desde la última ejecución
+    docs = collection.aggregate(
+        [
+            {"$match": ingested_between(watermark, new_watermark)},
+            {"$group": {"_id": "$reviewerID"}},
+        ],
+        allowDiskUse=True,
+    )
+    changed = sorted(doc["_id"] for doc in docs)
+
+    reviewers = IdMap(model.reviewers.keys())
+    changed_rows = np.array([reviewers.add(id) for id in changed], dtype=np.int64)
+
+    # Se cambian las filas de los reviewers que han cambiado por sus reviews actuales
+    X = model.X.tocoo()
+    is_changed = np.zeros(len(reviewers), dtype=bool)
+    is_changed[changed_rows] = True
+    keep = ~is_changed[X.row]
+    arrays = CooArrays(int(keep.sum()))
+    arrays.extend(X.row[keep], X.col[keep], X.data[keep])
+    for start in range(0, len(changed), chunk_size):
+        docs = collection.find(
+            {"reviewerID": {"$in": changed[start : start + chunk_size]}},
+            RATING_PROJECTION,
+            batch_size=LOAD_BATCH_SIZE,
+        )
+        read_ratings(docs, reviewers, items, arrays)
+    X = arrays.tocsr((len(reviewers), len(items)))
+    refreshed = model.update(X, changed_rows, reviewers.index, items)
+    model.save(directory, new_watermark)
+    return refreshed
+
+
+if __name__ == "__main__":
+    from queries import obtener_tuplas_items
+    from utils import get_collection, read_config
+
+    config = read_config()
+    recommender_config = config["RECOMMENDER"]
+
+    parser = argparse.ArgumentParser(
+        description="Filtrado colaborativo por artículos con las reviews de MongoDB"
+    )
+    parser.add_argument(
+        "--k", type=int, default=int(recommender_config["vecinos_articulos"])
+    )
+    parser.add_argument(
+        "--min-overlap",
+        type=int,
+        default=int(recommender_config["min_reviewers_comunes"]),
+    )
+    parser.add_argument(
+        "--index", default=recommender_config["directorio_indice_articulos"]
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="actualiza el índice guardado con las reviews nuevas",
+    )
+    args = parser.parse_args()
+
+    items = {item: i for i, item in enumerate(obtener_tuplas_items())}
+    collection = get_collection(config)
+
+    start = time.perf_counter()
+    if args.refresh:
+        refreshed = refresh_item_index(
+            collection, args.index, items, args.k, args.min_overlap
+        )
+        print(
+            f"{refreshed} artículos actualizados en {time.perf_counter() - start:.3f} s"
+        )
+    else:
+        reviewers, X = load_all_ratings_matrix(collection, items)
+        X_train, rows, cols, ratings = split_ratings(X)
+
+        model = ItemKNN(args.k, args.min_overlap)
+        model.fit(X_train, reviewers=reviewers, items=items)
+        print(f"Entrenamiento: {time.perf_counter() - start:.3f} s")
+
+        predicted = model.predict_pairs(rows, cols)
+        predicted_mask = ~np.isnan(predicted)
+        print(f"Porcentaje de no imputados: {1 - predicted_mask.mean():.02%}")
+        print(
+            f"MAE: {np.mean(np.abs(predicted[predicted_mask] - ratings[predicted_mask])):.03f}"
+        )
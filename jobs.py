@@ -0,0 +1,262 @@
+import argparse
+import sys
+from contextlib import redirect_stdout
+
+from neo4j import GraphDatabase
+
+from co_review import select_articles, shared_reviews, upload_shared_reviews
+from neo4JProyecto import (
+    apartado_4_3,
+    borrar_neo4j,
+    cargar_grafo_reviews,
+    get_most_reviews,
+    seleccionar_articulos,
+    store_similarity,
+    update_similarity,
+    upload_to_neo4j,
+)
+from profiling import StageTimer
+from similarity import read_similarity_file
+from utils import connect_to_sql, get_collection, read_config
+
+
+def get_driver(config):
+    return GraphDatabase.driver(
+        config["NEO4J"]["connection"],
+        auth=(config["NEO4J"]["usuario"], config["NEO4J"]["password"]),
+    )
+
+
+def similarity_job(args, config, timer: StageTimer) -> None:
+    """Similitudes entre los usuarios con más reviews (apartado 4.1)"""
+    collection = get_collection(config)
+
+    with timer.stage("usuarios") as stage:
+        users = get_most_reviews(collection, args.users)
+        stage["rows"] = len(users)
+
+    if args.incremental:
+        driver = get_driver(config)
+        with timer.stage("actualizacion_incremental") as stage:
+            update_similarity(
+                collection,
+                users,
+                args.similarity_file,
+                config["NEO4J"]["directorio_estado_similitud"],
+                driver,
+                args.threshold,
+                args.chunk_size,
+                args.batch_size,
+                args.mode,
+                args.top_k,
+            )
+            stage["rows"] = len(read_similarity_file(args.similarity_file).edges)
+        driver.close()
+        return
+
+    with timer.stage("similitudes") as stage:
+        store_similarity(
+            collection,
+            users,
+            args.similarity_file,
+            args.threshold,
+            args.block_size,
+            args.chunk_size,
+            args.mode,
+            {
+                "num_perm": int(config["NEO4J"]["minhash_permutaciones"]),
+                "bands": int(config["NEO4J"]["minhash_bandas"]),
+                "sample_size": int(config["NEO4J"]["minhash_muestra_recall"]),
+            },
+            args.top_k,
+            args.workers,
+        )
+        stage["rows"] = len(read_similarity_file(args.similarity_file).edges)
+
+    if not args.no_upload:
+        driver = get_driver(config)
+        with timer.stage("carga_neo4j") as stage:
+            stage["rows"] = upload_to_neo4j(
+                args.similarity_file, driver, args.batch_size
+            )
+        driver.close()
+
+
+def product_graph_job(args, config, timer: StageTimer) -> None:
+    """Grafo de reviewers y artículos de una categoría (apartado 4.2)"""
+    collection = get_collection(config)
+    driver = get_driver(config)
+
+    with timer.stage("seleccion") as stage:
+        asins, type_id = seleccionar_articulos(args.category, args.products, args.seed)
+        stage["rows"] = len(asins)
+
+    if not args.keep_graph:
+        with timer.stage("borrado"):
+            borrar_neo4j(driver)
+
+    with timer.stage("carga_neo4j") as stage:
+        stage["rows"] = cargar_grafo_reviews(
+            collection, driver, asins, type_id, args.batch_size
+        )
+    driver.close()
+
+
+def multi_category_job(args, config, timer: StageTimer) -> None:
+    """Reviewers que han escrito de varios tipos de productos (apartado 4.3)"""
+    collection = get_collection(config)
+    connection = connect_to_sql()
+    driver = get_driver(config)
+
+    with timer.stage("agregacion_y_carga") as stage:
+        stage["rows"] = apartado_4_3(
+            connection, collection, driver, args.batch_size, args.limit
+        )
+    driver.close()
+    connection.close()
+
+
+def co_review_job(args, config, timer: StageTimer) -> None:
+    """Reviewers con artículos en común, calculados en memoria (apartado 4.4)"""
+    collection = get_collection(config)
+
+    with timer.stage("seleccion") as stage:
+        asins = select_articles(
+            collection, args.min_reviews, args.max_reviews, args.articles, args.type_id
+        )
+        stage["rows"] = len(asins)
+
+    with timer.stage("parejas") as stage:
+        pairs = shared_reviews(collection, asins, args.min_shared)
+        stage["rows"] = len(pairs)
+
+    if args.upload:
+        driver = get_driver(config)
+        with timer.stage("carga_neo4j") as stage:
+            stage["rows"] = upload_shared_reviews(driver, pairs, args.batch_size)
+        driver.close()
+
+
+def wipe_job(args, config, timer: StageTimer) -> None:
+    """Borra los datos de Neo4j"""
+    driver = get_driver(config)
+    with timer.stage("borrado"):
+        borrar_neo4j(driver)
+    driver.close()
+
+
+def get_parser(config) -> argparse.ArgumentParser:
+    neo4j_config = config["NEO4J"]
+
+    parser = argparse.ArgumentParser(
+        description="Ejecuta los trabajos de Neo4j sin el menú interactivo y guarda un informe JSON"
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="fichero JSON del informe (por defecto, stdout; el progreso va a stderr)",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="mide el pico de memoria de cada etapa con tracemalloc",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=int(neo4j_config["tamano_lote"])
+    )
+    subparsers = parser.add_subparsers(dest="job", required=True)
+
+    similarity = subparsers.add_parser("similarity", help="similitudes (4.1)")
+    similarity.add_argument(
+        "--users", type=int, default=int(neo4j_config["limite_usuarios_reviews"])
+    )
+    similarity.add_argument(
+        "--similarity-file", default=neo4j_config["fichero_similitud"]
+    )
+    similarity.add_argument(
+        "--threshold", type=float, default=float(neo4j_config["umbral_similitud"])
+    )
+    similarity.add_argument(
+        "--block-size", type=int, default=int(neo4j_config["tamano_bloque"])
+    )
+    similarity.add_argument(
+        "--chunk-size",
+        type=int,
+        default=int(neo4j_config["usuarios_por_consulta"]),
+        help="usuarios cuyos artículos se traen en cada agregación",
+    )
+    similarity.add_argument(
+        "--mode", choices=["exacto", "minhash"], default=neo4j_config["modo_similitud"]
+    )
+    similarity.add_argument(
+        "--top-k", type=int, default=int(neo4j_config["vecinos_top_k"])
+    )
+    similarity.add_argument(
+        "--workers", type=int, default=int(neo4j_config["procesos"])
+    )
+    similarity.add_argument("--no-upload", action="store_true")
+    similarity.add_argument("--incremental", action="store_true")
+    similarity.set_defaults(run=similarity_job)
+
+    product_graph = subparsers.add_parser(
+        "product-graph", help="grafo de reviewers y artículos (4.2)"
+    )
+    product_graph.add_argument("--category", required=True)
+    product_graph.add_argument("--products", type=int, required=True)
+    product_graph.add_argument("--seed", type=int, default=None)
+    product_graph.add_argument(
+        "--keep-graph", action="store_true", help="no borra Neo4j antes de cargar"
+    )
+    product_graph.set_defaults(run=product_graph_job)
+
+    multi_category = subparsers.add_parser(
+        "multi-category", help="reviewers de varios tipos de productos (4.3)"
+    )
+    multi_category.add_argument(
+        "--limit",
+        type=int,
+        default=int(neo4j_config["limite_reviewers_multicategoria"]),
+    )
+    multi_category.set_defaults(run=multi_category_job)
+
+    co_review = subparsers.add_parser(
+        "co-review", help="reviewers con artículos en común (4.4)"
+    )
+    co_review.add_argument(
+        "--min-reviews", type=int, default=int(neo4j_config["min_reviews_articulo"])
+    )
+    co_review.add_argument(
+        "--max-reviews", type=int, default=int(neo4j_config["max_reviews_articulo"])
+    )
+    co_review.add_argument(
+        "--articles",
+        type=int,
+        default=int(neo4j_config["numero_articulos_coreviews"]),
+    )
+    co_review.add_argument("--type-id", type=int, default=None)
+    co_review.add_argument("--min-shared", type=int, default=1)
+    co_review.add_argument("--upload", action="store_true")
+    co_review.set_defaults(run=co_review_job)
+
+    wipe = subparsers.add_parser("wipe", help="borra los datos de Neo4j")
+    wipe.set_defaults(run=wipe_job)
+
+    return parser
+
+
+if __name__ == "__main__":
+    config = read_config()
+    args = get_parser(config).parse_args()
+
+    timer = StageTimer(args.job, args.trace_memory)
+    timer.parameters = {
+        key: value for key, value in vars(args).items() if key not in ("run", "report")
+    }
+    # Sin --report el informe sale por stdout, así que lo que imprimen los trabajos se
+    # manda a stderr para que la salida se pueda leer como JSON
+    if args.report is None:
+        with redirect_stdout(sys.stderr):
+            args.run(args, config, timer)
+    else:
+        args.run(args, config, timer)
+    timer.write(args.report)
@@ -0,0 +1,447 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+from utils import percentile
+
+CALLBACK_ENDPOINT = "/_dash-update-component"
+
+
+class DashLoadClient:
+    """Cliente HTTP de un usuario virtual del dashboard"""
+
+    def __init__(self, base_url: str, timeout: float = 60) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def get(self, path: str) -> requests.Response:
+        return self.session.get(self.base_url + path, timeout=self.timeout)
+
+    def post_callback(self, payload: dict) -> requests.Response:
+        return self.session.post(
+            self.base_url + CALLBACK_ENDPOINT, json=payload, timeout=self.timeout
+        )
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def find_components(layout: dict, tab: str = None, found: dict = None) -> dict:
+    """Recorre el layout serializado de Dash y guarda los componentes con id
+
+    Args:
+        layout (dict): layout devuelto por /_dash-layout
+        tab (str, optional): valor de la pestaña en la que está el componente. Defaults to None.
+        found (dict, optional): diccionario donde se acumulan los componentes. Defaults to None.
+
+    Returns:
+        dict: diccionario de id a {"type", "props", "tab"}
+    """
+    if found is None:
+        found = {}
+
+    if isinstance(layout, list):
+        for child in layout:
+            find_components(child, tab, found)
+        return found
+
+    if not isinstance(layout, dict) or "props" not in layout:
+        return found
+
+    props = layout["props"]
+    if layout.get("type") == "Tab":
+        tab = props.get("value", tab)
+
+    if "id" in props:
+        found[props["id"]] = {"type": layout.get("type"), "props": props, "tab": tab}
+
+    find_components(props.get("children"), tab, found)
+    return found
+
+
+def parse_outputs(output: str) -> list[dict]:
+    """Separa el campo output de un callback en sus salidas
+
+    Dash escribe una sola salida como "id.prop" y varias como "..id1.prop1...id2.prop2..".
+
+    Args:
+        output (str): campo output del callback en /_dash-dependencies
+
+    Raises:
+        ValueError: si alguna salida no tiene la forma "id.prop"
+
+    Returns:
+        list[dict]: lista de {"id", "property"} de cada salida
+    """
+    multiple = output.startswith("..") and output.endswith("..")
+    parts = output[2:-2].split("...") if multiple else [output]
+
+    outputs = []
+    for part in parts:
+        output_id, _, output_property = part.rpartition(".")
+        if output_id == "" or output_property == "":
+            raise ValueError(f"Salida de callback no válida: {output!r}")
+        outputs.append({"id": output_id, "property": output_property})
+    return outputs
+
+
+def build_payload(dependency: dict, components: dict, changed: dict = None) -> dict:
+    """Construye el cuerpo de la petición a _dash-update-component igual que el navegador
+
+    Args:
+        dependency (dict): callback tal y como lo devuelve /_dash-dependencies
+        components (dict): componentes del layout (ver find_components)
+        changed (dict, optional): propiedades cambiadas por el usuario ({"id.prop": valor}). Defaults to None.
+
+    Returns:
+        dict: el payload de la petición
+    """
+    changed = changed or {}
+
+    def value_of(item: dict):
+        key = f"{item['id']}.{item['property']}"
+        if key in changed:
+            return changed[key]
+        return components.get(item["id"], {}).get("props", {}).get(item["property"])
+
+    # Con una sola salida el navegador manda un diccionario y con varias una lista
+    outputs = parse_outputs(dependency["output"])
+    return {
+        "output": dependency["output"],
+        "outputs": outputs if len(outputs) > 1 else outputs[0],
+        "inputs": [dict(item, value=value_of(item)) for item in dependency["inputs"]],
+        "state": [dict(item, value=value_of(item)) for item in dependency["state"]],
+        "changedPropIds": list(changed),
+    }
+
+
+def dropdown_actions(dependencies: list, components: dict) -> list[dict]:
+    """Obtiene las acciones que puede hacer un analista: cambiar el valor de un dcc.Dropdown
+
+    Los cambios de pestaña se resuelven en el navegador (las pestañas llevan su contenido
+    en el layout), así que no generan peticiones: se modelan como el tiempo de reflexión
+    antes de tocar un dropdown de esa pestaña.
+
+    Args:
+        dependencies (list): callbacks del dashboard
+        components (dict): componentes del layout
+
+    Returns:
+        list[dict]: lista de acciones con el callback, el dropdown, sus valores y su pestaña
+    """
+    actions = []
+    for dependency in dependencies:
+        for item in dependency["inputs"]:
+            component = components.get(item["id"])
+            if (
+                component is None
+                or component["type"] != "Dropdown"
+                or item["property"] != "value"
+            ):
+                continue
+            values = [
+                option["value"] if isinstance(option, dict) else option
+                for option in component["props"].get("options", [])
+            ]
+            if len(values) > 0:
+                actions.append(
+                    {
+                        "dependency": dependency,
+                        "dropdown": item["id"],
+                        "values": values,
+                        "tab": component["tab"],
+                    }
+                )
+    return actions
+
+
+class LoadTestResults:
+    """Acumula las latencias de todas las peticiones de forma segura entre hilos"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name: str, elapsed: float, ok: bool) -> None:
+        with self.lock:
+            if ok:
+                self.latencies[name].append(elapsed)
+            else:
+                self.errors[name] += 1
+
+    def summary(self, wall_time: float) -> dict:
+        """Resume los resultados por callback
+
+        Args:
+            wall_time (float): duración total de la prueba en segundos
+
+        Returns:
+            dict: para cada callback, peticiones, errores, throughput y latencias en ms
+        """
+        report = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            values = self.latencies[name]
+            report[name] = {
+                "requests": len(values),
+                "errors": self.errors[name],
+                "throughput_rps": len(values) / wall_time if wall_time > 0 else 0.0,
+                "mean_ms": 1000 * sum(values) / len(values) if values else float("nan"),
+                "p50_ms": 1000 * percentile(values, 50),
+                "p95_ms": 1000 * percentile(values, 95),
+                "p99_ms": 1000 * percentile(values, 99),
+            }
+        return report
+
+
+def timed(results: LoadTestResults, name: str, request, *args) -> requests.Response:
+    """Ejecuta una petición y guarda su latencia"""
+    start = time.perf_counter()
+    try:
+        response = request(*args)
+        ok = response.status_code in (200, 204)
+    except requests.RequestException:
+        response = None
+        ok = False
+    results.record(name, time.perf_counter() - start, ok)
+    return response
+
+
+def is_ok(response: requests.Response) -> bool:
+    """Indica si la petición ha llegado y el servidor ha respondido con éxito"""
+    return response is not None and response.status_code in (200, 204)
+
+
+def back_off(failures: int, stop_at: float, rng: random.Random) -> None:
+    """Espera antes de reintentar, más cuantos más fallos seguidos (como máximo 10 s)"""
+    delay = min(0.5 * 2 ** (failures - 1), 10) * rng.uniform(0.5, 1)
+    time.sleep(max(0, min(delay, stop_at - time.perf_counter())))
+
+
+def virtual_user(
+    user_number: int,
+    base_url: str,
+    results: LoadTestResults,
+    stop_at: float,
+    actions_per_session: int,
+    think_time: tuple[float, float],
+    seed: int,
+) -> None:
+    """Simula un analista: carga la página y va cambiando dropdowns hasta que se acabe el tiempo
+
+    Si falla la carga de la página (por ejemplo, un 503 con el servidor saturado) se
+    espera un poco y se vuelve a empezar la sesión, para que el usuario siga generando
+    carga durante toda la prueba; los fallos quedan apuntados como errores.
+
+    Args:
+        user_number (int): número del usuario virtual
+        base_url (str): url del dashboard
+        results (LoadTestResults): donde se guardan las latencias
+        stop_at (float): instante (time.perf_counter) en el que parar
+        actions_per_session (int): cambios de dropdown antes de volver a cargar la página
+        think_time (tuple[float, float]): tiempo de espera mínimo y máximo entre acciones
+        seed (int): semilla para que la secuencia sea reproducible
+    """
+    rng = random.Random(seed + user_number)
+    client = DashLoadClient(base_url)
+
+    failures = 0
+    try:
+        while time.perf_counter() < stop_at:
+            # Carga de la página: index, layout, dependencias y callbacks iniciales
+            timed(results, "GET /", client.get, "/")
+            layout = timed(results, "GET /_dash-layout", client.get, "/_dash-layout")
+            dependencies = timed(
+                results, "GET /_dash-dependencies", client.get, "/_dash-dependencies"
+            )
+            try:
+                if not (is_ok(layout) and is_ok(dependencies)):
+                    raise ValueError("la página no se ha cargado")
+                components = find_components(layout.json())
+                dependencies = dependencies.json()
+            except ValueError:
+                failures += 1
+                back_off(failures, stop_at, rng)
+                continue
+            failures = 0
+
+            for dependency in dependencies:
+                if not dependency.get("prevent_initial_call"):
+                    timed(
+                        results,
+                        dependency["output"],
+                        client.post_callback,
+                        build_payload(dependency, components),
+                    )
+
+            actions = dropdown_actions(dependencies, components)
+            if len(actions) == 0:
+                return
+
+            # Se cambia de pestaña y se elige un valor del dropdown de esa pestaña
+            for _ in range(actions_per_session):
+                if time.perf_counter() >= stop_at:
+                    break
+                time.sleep(rng.uniform(*think_time))
+                tab = rng.choice(sorted({str(a["tab"]) for a in actions}))
+                action = rng.choice([a for a in actions if str(a["tab"]) == tab])
+                value = rng.choice(action["values"])
+                components[action["dropdown"]]["props"]["value"] = value
+                payload = build_payload(
+                    action["dependency"],
+                    components,
+                    {f"{action['dropdown']}.value": value},
+                )
+                timed(
+                    results,
+                    action["dependency"]["output"],
+                    client.post_callback,
+                    payload,
+                )
+    finally:
+        client.close()
+
+
+def start_in_process_server(port: int = 0):
+    """Arranca el dashboard en un hilo de este proceso
+
+    Usa las bases de datos de configuracion.ini, que deben estar cargadas en local.
+
+    Args:
+        port (int, optional): puerto, 0 para uno libre. Defaults to 0.
+
+    Returns:
+        tuple: el servidor de werkzeug y su url
+    """
+    from werkzeug.serving import make_server
+    from dashboard import app
+
+    # Se silencia el log de cada petición para no medir la escritura por consola
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", port, app.server, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def run_load_test(
+    base_url: str,
+    n_users: int,
+    duration: float,
+    actions_per_session: int = 20,
+    think_time: tuple[float, float] = (0.5, 2.0),
+    ramp_up: float = 0,
+    seed: int = 33,
+) -> dict:
+    """Lanza n usuarios virtuales concurrentes contra el dashboard
+
+    Args:
+        base_url (str): url del dashboard
+        n_users (int): número de usuarios concurrentes
+        duration (float): duración de la prueba en segundos
+        actions_per_session (int, optional): acciones antes de recargar la página. Defaults to 20.
+        think_time (tuple[float, float], optional): espera entre acciones. Defaults to (0.5, 2.0).
+        ramp_up (float, optional): segundos en los que se van incorporando los usuarios. Defaults to 0.
+        seed (int, optional): semilla. Defaults to 33.
+
+    Returns:
+        dict: informe con la configuración, la duración y las métricas por callback
+    """
+    results = LoadTestResults()
+    start = time.perf_counter()
+    stop_at = start + duration
+
+    threads = []
+    for user_number in range(n_users):
+        thread = threading.Thread(
+            target=virtual_user,
+            args=(
+                user_number,
+                base_url,
+                results,
+                stop_at,
+                actions_per_session,
+                think_time,
+                seed,
+            ),
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+        if ramp_up > 0 and n_users > 1:
+            time.sleep(ramp_up / (n_users - 1))
+
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+
+    return {
+        "url": base_url,
+        "users": n_users,
+        "duration_s": wall_time,
+        "callbacks": results.summary(wall_time),
+    }
+
+
+def print_report(report: dict) -> None:
+    print(
+        f"{report['users']} usuarios concurrentes durante {report['duration_s']:.1f} s contra {report['url']}"
+    )
+    print(
+        f"{'callback':<40} {'peticiones':>10} {'errores':>8} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    )
+    for name, stats in report["callbacks"].items():
+        print(
+            f"{name:<40} {stats['requests']:>10} {stats['errors']:>8} {stats['throughput_rps']:>8.2f}"
+            f" {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prueba de carga del dashboard con usuarios concurrentes"
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:8050")
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="arranca el dashboard en este proceso en vez de usar --url",
+    )
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--actions-per-session", type=int, default=20)
+    parser.add_argument("--think-min", type=float, default=0.5)
+    parser.add_argument("--think-max", type=float, default=2.0)
+    parser.add_argument("--ramp-up", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=33)
+    parser.add_argument("--json", help="fichero donde guardar el informe en JSON")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if args.in_process:
+        server, url = start_in_process_server()
+
+    report = run_load_test(
+        url,
+        args.users,
+        args.duration,
+        args.actions_per_session,
+        (args.think_min, args.think_max),
+        args.ramp_up,
+        args.seed,
+    )
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2)
+
+    if server is not None:
+        server.shutdown()
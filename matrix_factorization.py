@@ -0,0 +1,495 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pymongo.collection import Collection
+from scipy.sparse import csr_matrix, vstack
+
+from recommender import (
+    KNN,
+    LOAD_BATCH_SIZE,
+    RATING_PROJECTION,
+    CooArrays,
+    load_ratings_matrix,
+    load_similarity_matrix,
+    n_neighbors,
+    read_ratings,
+    split_ratings,
+)
+from parallel_predict import parallel_predict, parallel_predict_pairs
+from utils import IdMap
+
+# Rango de los ratings de las reviews
+MIN_RATING = 1
+MAX_RATING = 5
+
+# Versión del formato de los modelos guardados con ALS.save
+ALS_VERSION = 1
+
+# Memoria máxima de los productos exteriores que se calculan a la vez en ALS._solve
+GRAM_CHUNK_BYTES = 32 * 2**20
+
+# Máximo de valores (reviewers x artículos) que devuelve ALS.predict; para más hay que
+# usar ALS.predict_pairs con los candidatos
+MAX_DENSE_PREDICTIONS = 50_000_000
+
+
+def load_all_ratings_matrix(
+    collection: Collection, items: dict, batch_size: int = LOAD_BATCH_SIZE
+) -> tuple[dict, csr_matrix]:
+    """Construye la matriz de ratings de todos los reviewers de MongoDB
+
+    No hace falta el grafo de similitudes de Neo4j, así que entran todos los reviewers
+    y no solo los de limite_usuarios_reviews.
+
+    Args:
+        collection (Collection): colección de MongoDB
+        items (dict): diccionario de (asin, type_id) a columna
+        batch_size (int, optional): documentos por lote del cursor. Defaults to LOAD_BATCH_SIZE.
+
+    Returns:
+        tuple[dict, csr_matrix]: diccionario de reviewer a fila y matriz de ratings
+    """
+    reviewers = IdMap()
+    arrays = CooArrays(collection.estimated_document_count())
+    docs = collection.find({}, RATING_PROJECTION, batch_size=batch_size)
+    read_ratings(docs, reviewers, items, arrays, batch_size)
+    return reviewers.index, arrays.tocsr((len(reviewers), len(items)))
+
+
+class ALS:
+    """Factorización de la matriz de ratings con mínimos cuadrados alternos (ALS)
+
+    Cada rating se aproxima por la media global más el producto de los factores del
+    reviewer y del artículo. En cada iteración se fijan los factores de los artículos y
+    se resuelven los de todos los reviewers, y al revés. Los sistemas de cada bloque de
+    filas se montan con los factores de sus ratings y se resuelven juntos con
+    np.linalg.solve, repartiendo los bloques entre varios hilos (NumPy suelta el GIL).
+
+    Tiene la misma interfaz que KNN (fit/predict/predict_pairs), pero no usa la matriz
+    de similitudes.
+    """
+
+    def __init__(
+        self,
+        factors=20,
+        regularization=0.1,
+        iterations=10,
+        block_size=1000,
+        n_threads=1,
+        seed=None,
+    ) -> None:
+        """
+        Args:
+            factors (int, optional): número de factores latentes. Defaults to 20.
+            regularization (float, optional): regularización, multiplicada por el número
+                de ratings de cada fila. Defaults to 0.1.
+            iterations (int, optional): iteraciones de ALS. Defaults to 10.
+            block_size (int, optional): reviewers o artículos que se resuelven a la vez. Defaults to 1000.
+            n_threads (int, optional): hilos entre los que se reparten los bloques. Defaults to 1.
+            seed (int, optional): semilla de la inicialización. Defaults to None.
+        """
+        self.factors = factors
+        self.regularization = regularization
+        self.iterations = iterations
+        self.block_size = block_size
+        self.n_threads = n_threads
+        self.seed = seed
+        # Directorio del modelo guardado o cargado (lo usan los workers de predict)
+        self.directory = None
+
+    def fit(self, X, similarity_matrix=None, reviewers=None, items=None) -> None:
+        """Entrena los factores con los ratings de X
+
+        Args:
+            X: matriz dispersa de ratings reviewer x artículo
+            similarity_matrix (optional): no se usa, está para poder cambiar KNN por ALS. Defaults to None.
+            reviewers (dict, optional): diccionario de reviewer a fila. Defaults to None.
+            items (dict, optional): diccionario de (asin, type_id) a columna. Defaults to None.
+        """
+        self.X = csr_matrix(X, dtype=np.float32)
+        self.reviewers = reviewers
+        self.items = items
+        self.X_csc = None
+        self.directory = None
+
+        n, m = self.X.shape
+        self.global_mean = float(self.X.data.mean()) if self.X.nnz > 0 else 0.0
+
+        # Se ajustan los ratings centrados en la media
+        centered = self.X.copy()
+        centered.data -= self.global_mean
+        centered_t = centered.T.tocsr()
+
+        rng = np.random.default_rng(self.seed)
+        scale = 1 / np.sqrt(self.factors)
+        self.user_factors = np.zeros((n, self.factors))
+        self.item_factors = rng.normal(0, scale, (m, self.factors))
+
+        for _ in range(self.iterations):
+            self.user_factors = self._solve(centered, self.item_factors)
+            self.item_factors = self._solve(centered_t, self.user_factors)
+
+    def _gram_matrices(
+        self, rated: csr_matrix, fixed: np.ndarray, start: int, end: int
+    ) -> np.ndarray:
+        """Calcula Fᵢᵀ Fᵢ de las filas start:end solo con los factores de sus ratings
+
+        Fᵢᵀ Fᵢ es la suma de los productos exteriores de los factores de las columnas con
+        rating. Se calculan con einsum para los ratings del bloque, en trozos de como mucho
+        GRAM_CHUNK_BYTES, y se suman por fila multiplicando por una matriz dispersa que
+        indica la fila de cada rating, así que la memoria no depende del número de columnas.
+        """
+        f = self.factors
+        n_rows = end - start
+        A = np.zeros((n_rows, f * f))
+        lo, hi = rated.indptr[start], rated.indptr[end]
+        row_of = np.repeat(np.arange(n_rows), np.diff(rated.indptr[start : end + 1]))
+        chunk_size = max(1, GRAM_CHUNK_BYTES // (8 * f * f))
+        for chunk_start in range(lo, hi, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, hi)
+            F = fixed[rated.indices[chunk_start:chunk_end]]
+            rows = csr_matrix(
+                (
+                    np.ones(chunk_end - chunk_start),
+                    (row_of[chunk_start - lo : chunk_end - lo], np.arange(len(F))),
+                ),
+                shape=(n_rows, len(F)),
+            )
+            A += rows @ np.einsum("if,ig->ifg", F, F).reshape(len(F), -1)
+        return A.reshape(n_rows, f, f)
+
+    def _solve_block(
+        self,
+        ratings: csr_matrix,
+        rated: csr_matrix,
+        fixed: np.ndarray,
+        start: int,
+        end: int,
+    ) -> np.ndarray:
+        """Resuelve los factores de las filas start:end con los otros factores fijos
+
+        Para cada fila u con ratings en las columnas I: (Fᵢᵀ Fᵢ + λ nᵤ I) xᵤ = Fᵢᵀ rᵤ
+        """
+        f = self.factors
+        A = self._gram_matrices(rated, fixed, start, end)
+
+        # Las filas sin ratings se quedan con los factores a 0
+        counts = np.maximum(np.diff(rated.indptr[start : end + 1]), 1)
+        A += self.regularization * counts[:, None, None] * np.eye(f)
+        b = np.asarray(ratings[start:end] @ fixed)
+        return np.linalg.solve(A, b[:, :, None])[:, :, 0]
+
+    def _solve(self, ratings: csr_matrix, fixed: np.ndarray) -> np.ndarray:
+        """Resuelve los factores de todas las filas de ratings por bloques"""
+        n = ratings.shape[0]
+        ratings = csr_matrix(ratings, dtype=np.float64)
+        rated = ratings.copy()
+        rated.data[:] = 1
+
+        bounds = [
+            (start, min(start + self.block_size, n))
+            for start in range(0, n, self.block_size)
+        ]
+        if len(bounds) == 0:
+            return np.zeros((0, self.factors))
+
+        def solve(block: tuple) -> np.ndarray:
+            return self._solve_block(ratings, rated, fixed, *block)
+
+        if self.n_threads > 1:
+            with ThreadPoolExecutor(self.n_threads) as executor:
+                blocks = list(executor.map(solve, bounds))
+        else:
+            blocks = [solve(block) for block in bounds]
+        return np.vstack(blocks)
+
+    def _predict_rows(self, rows: np.ndarray) -> np.ndarray:
+        predictions = self.global_mean + self.user_factors[rows] @ self.item_factors.T
+        return np.clip(predictions, MIN_RATING, MAX_RATING)
+
+    def _prediction_bound(self, Y: csr_matrix) -> np.ndarray:
+        """Máximo de valores de cada fila de predict: todos los artículos"""
+        return np.full(Y.shape[0], Y.shape[1], dtype=np.int64)
+
+    def _predict_block(self, Y_block: csr_matrix, rows: np.ndarray) -> csr_matrix:
+        """Completa las filas de un bloque de reviewers (rows son sus índices en el modelo)"""
+        predictions = self._predict_rows(rows).astype(np.float32)
+
+        # Se mantienen los ratings que ya existen
+        known = Y_block.tocoo()
+        predictions[known.row, known.col] = known.data
+        return csr_matrix(predictions)
+
+    def predict(self, reviewer_ratings_matrix, n_workers: int = 1):
+        """Completa todos los artículos que no ha puntuado cada reviewer
+
+        A diferencia de KNN todos los artículos tienen predicción, así que el resultado
+        tiene reviewers x artículos valores. Solo se permite hasta MAX_DENSE_PREDICTIONS
+        valores; para matrices más grandes hay que pedir los candidatos con predict_pairs.
+
+        Args:
+            reviewer_ratings_matrix: ratings de los reviewers, en el orden del modelo
+            n_workers (int, optional): procesos entre los que se reparten los bloques de
+                reviewers (ver parallel_predict). Defaults to 1.
+
+        Raises:
+            ValueError: si el resultado tendría más de MAX_DENSE_PREDICTIONS valores
+
+        Returns:
+            csr_matrix: la matriz completada
+        """
+        Y = csr_matrix(reviewer_ratings_matrix, dtype=np.float32)
+        n, m = Y.shape
+        if n * m > MAX_DENSE_PREDICTIONS:
+            raise ValueError(
+                f"ALS.predict completaría {n} x {m} valores (máximo {MAX_DENSE_PREDICTIONS}); "
+                "usa predict_pairs con los artículos candidatos"
+            )
+        if n_workers > 1:
+            return parallel_predict(self, Y, ALS.load, n_workers)
+
+        blocks = []
+        for start in range(0, n, self.block_size):
+            end = min(start + self.block_size, n)
+            blocks.append(self._predict_block(Y[start:end], np.arange(start, end)))
+        return vstack(blocks, format="csr")
+
+    def predict_pairs(
+        self, reviewer_indexes, item_indexes, n_workers: int = 1
+    ) -> np.ndarray:
+        """Predice solo los ratings de las parejas (reviewer, artículo) pedidas
+
+        Args:
+            reviewer_indexes: índices de los reviewers
+            item_indexes: índices de los artículos
+            n_workers (int, optional): procesos entre los que se reparten las parejas. Defaults to 1.
+
+        Returns:
+            np.ndarray: ratings predichos (float32, como los de KNN)
+        """
+        if n_workers > 1:
+            return parallel_predict_pairs(
+                self, reviewer_indexes, item_indexes, ALS.load, n_workers
+            )
+        reviewer_indexes = np.asarray(reviewer_indexes, dtype=np.int64)
+        item_indexes = np.asarray(item_indexes, dtype=np.int64)
+        predictions = self.global_mean + np.einsum(
+            "ij,ij->i",
+            self.user_factors[reviewer_indexes],
+            self.item_factors[item_indexes],
+        )
+        return np.clip(predictions, MIN_RATING, MAX_RATING).astype(np.float32)
+
+    def save(self, directory: str) -> None:
+        """Guarda los factores y los mapas de ids
+
+        Los factores se guardan en .npy para abrirlos con memmap en ALS.load.
+
+        Args:
+            directory (str): directorio del modelo
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "user_factors.npy"), self.user_factors)
+        np.save(os.path.join(directory, "item_factors.npy"), self.item_factors)
+
+        reviewers = None
+        if self.reviewers is not None:
+            reviewers = [None] * len(self.reviewers)
+            for reviewer_id, i in self.reviewers.items():
+                reviewers[i] = reviewer_id
+        items = None
+        if self.items is not None:
+            items = [None] * len(self.items)
+            for item, j in self.items.items():
+                items[j] = item
+
+        with open(os.path.join(directory, "model.json"), "w", encoding="utf-8") as fh:
+            json.dump(
+                {
+                    "version": ALS_VERSION,
+                    "factors": self.factors,
+                    "regularization": self.regularization,
+                    "iterations": self.iterations,
+                    "block_size": self.block_size,
+                    "n_threads": self.n_threads,
+                    "seed": self.seed,
+                    "global_mean": self.global_mean,
+                    "reviewers": reviewers,
+                    "items": items,
+                },
+                fh,
+            )
+        self.directory = directory
+
+    @classmethod
+    def load(cls, directory: str) -> "ALS":
+        """Carga un modelo guardado con save sin copiar los factores (memmap)
+
+        El modelo cargado predice, pero no tiene la matriz de ratings del entrenamiento.
+
+        Args:
+            directory (str): directorio del modelo
+
+        Raises:
+            ValueError: si la versión del modelo no es compatible
+
+        Returns:
+            ALS: el modelo
+        """
+        with open(os.path.join(directory, "model.json"), "r", encoding="utf-8") as fh:
+            saved = json.load(fh)
+        if saved["version"] != ALS_VERSION:
+            raise ValueError(
+                f"Versión de modelo {saved['version']} no compatible en {directory}"
+            )
+
+        model = cls(
+            saved["factors"],
+            saved["regularization"],
+            saved["iterations"],
+            saved["block_size"],
+            saved["n_threads"],
+            saved["seed"],
+        )
+        model.global_mean = saved["global_mean"]
+        model.reviewers = (
+            None
+            if saved["reviewers"] is None
+            else {reviewer_id: i for i, reviewer_id in enumerate(saved["reviewers"])}
+        )
+        model.items = (
+            None
+            if saved["items"] is None
+            else {tuple(item): j for j, item in enumerate(saved["items"])}
+        )
+        model.X = None
+        model.X_csc = None
+        model.user_factors = np.load(
+            os.path.join(directory, "user_factors.npy"), mmap_mode="r"
+        )
+        model.item_factors = np.load(
+            os.path.join(directory, "item_factors.npy"), mmap_mode="r"
+        )
+        model.directory = directory
+        return model
+
+
+def benchmark(
+    X: csr_matrix,
+    similarity_matrix: csr_matrix,
+    reviewers: dict,
+    items: dict,
+    knn: KNN,
+    als: ALS,
+    test_fraction: float = 0.1,
+    seed: int = 33,
+) -> dict:
+    """Compara KNN y ALS con los mismos ratings de train y test
+
+    El MAE se calcula solo con los ratings de test que cada modelo puede predecir
+    (KNN no predice si ningún vecino ha puntuado el artículo).
+
+    Returns:
+        dict: tiempos de entrenamiento y predicción, MAE y cobertura de cada modelo
+    """
+    X_train, rows, cols, ratings = split_ratings(X, test_fraction, seed)
+    result = {"ratings": X.nnz, "test_ratings": len(ratings)}
+    for name, model in (("knn", knn), ("als", als)):
+        start = time.perf_counter()
+        model.fit(X_train, similarity_matrix, reviewers, items)
+        fit_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        predicted = model.predict_pairs(rows, cols)
+        predict_time = time.perf_counter() - start
+
+        predicted_mask = ~np.isnan(predicted)
+        result[name] = {
+            "fit_s": fit_time,
+            "predict_s": predict_time,
+            "mae": (
+                float(
+                    np.mean(np.abs(predicted[predicted_mask] - ratings[predicted_mask]))
+                )
+                if predicted_mask.any()
+                else float("nan")
+            ),
+            "coverage": float(predicted_mask.mean()) if len(ratings) > 0 else 0.0,
+        }
+    return result
+
+
+if __name__ == "__main__":
+    from queries import obtener_tuplas_items
+    from utils import get_collection, read_config
+
+    config = read_config()
+    recommender_config = config["RECOMMENDER"]
+
+    parser = argparse.ArgumentParser(
+        description="Factorización de matrices (ALS) entrenada con las reviews de MongoDB"
+    )
+    parser.add_argument(
+        "--factors", type=int, default=int(recommender_config["factores"])
+    )
+    parser.add_argument(
+        "--regularization",
+        type=float,
+        default=float(recommender_config["regularizacion"]),
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=int(recommender_config["iteraciones"])
+    )
+    parser.add_argument("--threads", type=int, default=int(recommender_config["hilos"]))
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="compara con KNN sobre los reviewers del fichero de similitudes",
+    )
+    args = parser.parse_args()
+
+    items = {item: i for i, item in enumerate(obtener_tuplas_items())}
+    collection = get_collection(config)
+    als = ALS(
+        args.factors,
+        args.regularization,
+        args.iterations,
+        n_threads=args.threads,
+        seed=33,
+    )
+
+    if args.benchmark:
+        reviewers, similarity_matrix = load_similarity_matrix(
+            config["NEO4J"]["fichero_similitud"]
+        )
+        X = load_ratings_matrix(collection, reviewers, items)
+        knn = KNN(
+            n_neighbors,
+            metric=recommender_config["distancia"],
+            min_overlap=int(recommender_config["min_articulos_comunes"]),
+        )
+        result = benchmark(X, similarity_matrix, reviewers, items, knn, als)
+        for name in ("knn", "als"):
+            print(
+                f"{name.upper()}: entrenamiento {result[name]['fit_s']:.3f} s, "
+                f"predicción {result[name]['predict_s']:.3f} s, "
+                f"MAE {result[name]['mae']:.03f}, cobertura {result[name]['coverage']:.02%}"
+            )
+    else:
+        start = time.perf_counter()
+        reviewers, X = load_all_ratings_matrix(collection, items)
+        print(
+            f"{len(reviewers)} reviewers y {X.nnz} ratings cargados en {time.perf_counter() - start:.3f} s"
+        )
+        X_train, rows, cols, ratings = split_ratings(X)
+
+        start = time.perf_counter()
+        als.fit(X_train, reviewers=reviewers, items=items)
+        print(f"Entrenamiento: {time.perf_counter() - start:.3f} s")
+
+        predicted = als.predict_pairs(rows, cols)
+        print(f"MAE: {np.mean(np.abs(predicted - ratings)):.03f}")
@@ -1,10 +1,55 @@
+import glob
+import json
 import os
-from typing import Any
-from utils import get_collection, read_config, connect_to_sql
+import time
+from typing import Iterator
+import numpy as np
+from scipy.sparse import csr_matrix, load_npz, save_npz
+from bson import ObjectId
+from utils import (
+    get_collection,
+    get_ingest_watermark,
+    ingested_between,
+    read_config,
+    connect_to_sql,
+    IdMap,
+)
 from queries import get_product_types
+from similarity import (
+    append_similarity_delta,
+    build_user_item_matrix,
+    compact_similarity_file,
+    jaccard_pairs,
+    minhash_pairs,
+    minhash_recall,
+    jaccard_rows,
+    needs_compaction,
+    parallel_jaccard_pairs,
+    read_similarity_file,
+    similarity_delta_paths,
+    top_k_pairs,
+    update_user_item_matrix,
+    write_similarity_file,
+)
 from pymongo.collection import Collection
 import random
 from neo4j import GraphDatabase
+from graph_writer import GraphWriter, create_schema
+from co_review import (
+    cypher_shared_reviews,
+    select_articles,
+    shared_reviews,
+    upload_shared_reviews,
+)
+from edge_store import LINK_DTYPE, EdgeWriter, iter_edges, load_edges
+from bulk_export import (
+    BulkExporter,
+    export_multi_category,
+    export_reviews,
+    export_similarities,
+    import_command,
+    validate_import_files,
+)
 import random
 
 # QUERY 4.1
@@ -33,147 +78,493 @@ def get_most_reviews(collection: Collection, limit: int) -> list[dict]:
     return list(docs)
 
 
-def get_set_articles(articles: list) -> set[str]:
-    """Devuelve un set de los articulos. Junta el asin con el type_id para evitar los duplicados de distintos tipos de objetos
+def get_set_articles(articles: list, items: IdMap) -> np.ndarray:
+    """Devuelve los articulos como un array ordenado de enteros. Usa la tupla (asin, type_id) para evitar los duplicados de distintos tipos de objetos
 
     Args:
-        articles (list): Lista de artículos
+        articles (list): Lista de artículos (diccionarios con asin y type_id)
+        items (IdMap): mapa de los artículos a enteros
 
     Returns:
-        set[str]: set de los identificadores de los artículos
+        np.ndarray: array ordenado y sin repetidos de los índices de los artículos
     """
-    return set(
-        "-".join([article["asin"], str(article["type_id"])]) for article in articles
+    return np.unique(
+        np.fromiter(
+            (items.add((article["asin"], article["type_id"])) for article in articles),
+            dtype=np.int32,
+        )
     )
 
 
-def calculate_jaccard_similarity(
-    set_articles_user1: set, set_articles_user2: set
-) -> float:
-    """Calcula la similitud de Jaccard
+def fetch_user_articles(
+    collection: Collection, user_ids: list, items: IdMap, chunk_size: int = 5000
+) -> Iterator[tuple[str, np.ndarray]]:
+    """Obtiene los artículos de cada usuario con una agregación por cada bloque de usuarios
 
     Args:
-        set_articles_user1 (set): Set de los identificadores de los artículos del primer usuario
-        set_articles_user2 (set): Set de los identificadores de los artículos del segundo usuario
+        collection (Collection): colección de MongoDB
+        user_ids (list): ids de los usuarios
+        items (IdMap): mapa de los artículos a enteros
+        chunk_size (int, optional): usuarios por agregación. Defaults to 5000.
 
-    Returns:
-        float: La similitud de Jaccard
+    Yields:
+        tuple[str, np.ndarray]: id del usuario y array ordenado de sus artículos
     """
+    for start in range(0, len(user_ids), chunk_size):
+        docs = collection.aggregate(
+            [
+                {
+                    "$match": {
+                        "reviewerID": {"$in": user_ids[start : start + chunk_size]}
+                    }
+                },
+                {"$project": {"_id": 0, "reviewerID": 1, "asin": 1, "type_id": 1}},
+                {
+                    "$group": {
+                        "_id": "$reviewerID",
+                        "articles": {
+                            "$addToSet": {"asin": "$asin", "type_id": "$type_id"}
+                        },
+                    }
+                },
+            ],
+            allowDiskUse=True,
+            batchSize=chunk_size,
+        )
+        for doc in docs:
+            yield doc["_id"], get_set_articles(doc["articles"], items)
 
-    intersection = len(set_articles_user1 & set_articles_user2)
-    union = len(set_articles_user1 | set_articles_user2)
-
-    return intersection / union
 
+def store_similarity(
+    collection: Collection,
+    users: list,
+    similarity_file: str,
+    threshold: float = 0.0,
+    block_size: int = 2000,
+    chunk_size: int = 5000,
+    mode: str = "exacto",
+    minhash_config: dict = None,
+    top_k: int = 0,
+    n_workers: int = 1,
+) -> tuple[csr_matrix, IdMap]:
+    """Se guarda la similitud de los usuarios en un fichero
 
-def insert_to_cache(cache: dict, key: str, data: Any, max_cache_size: int) -> None:
-    """Inserta en el caché la información requerida
+    Se construye una sola vez la matriz dispersa usuario x artículo. En modo "exacto" se
+    calculan todas las intersecciones con productos de matrices dispersas por bloques y
+    en modo "minhash" se estima la similitud con firmas MinHash y LSH.
 
     Args:
-        cache (dict): caché
-        key (str): la clave
-        data (Any): los datos a guardar
-        max_cache_size (int): el tamaño máximo del caché
+        collection (Collection): colección de MongoDB
+        users (list): Lista de los usuarios
+        similarity_file (str): Fichero donde se quiere guardar las similitudes
+        threshold (float, optional): Solo se guardan las similitudes mayores que este valor. Defaults to 0.0.
+        block_size (int, optional): Usuarios que se comparan a la vez. Defaults to 2000.
+        chunk_size (int, optional): Usuarios cuyos artículos se traen en cada agregación. Defaults to 5000.
+        mode (str, optional): "exacto" o "minhash". Defaults to "exacto".
+        minhash_config (dict, optional): num_perm, bands y sample_size (muestra para medir
+            el recall, 0 para no medirlo) del modo minhash. Defaults to None.
+        top_k (int, optional): Si es mayor que 0, solo se guardan los top_k vecinos más
+            similares de cada usuario. Defaults to 0.
+        n_workers (int, optional): Procesos para el modo exacto; con más de uno se reparten
+            los bloques de usuarios entre ellos. Defaults to 1.
+
+    Returns:
+        tuple[csr_matrix, IdMap]: la matriz usuario x artículo y el mapa de artículos a columnas
     """
-    if len(cache) < max_cache_size:
-        cache[key] = data
+    start = time.perf_counter()
+
+    user_ids = [user["_id"] for user in users]
+
+    # Se traen los artículos de los usuarios por bloques con una agregación por bloque
+    items = IdMap()
+    user_articles = fetch_user_articles(collection, user_ids, items, chunk_size)
+    matrix = build_user_item_matrix(user_ids, user_articles)
+
+    # Se calculan las similitudes
+    if mode == "exacto" and n_workers > 1:
+        pairs = parallel_jaccard_pairs(matrix, threshold, block_size, n_workers)
+    elif mode == "exacto":
+        pairs = jaccard_pairs(matrix, threshold, block_size)
+    elif mode == "minhash":
+        minhash_config = minhash_config or {}
+        num_perm = minhash_config.get("num_perm", 128)
+        bands = minhash_config.get("bands", 32)
+        sample_size = minhash_config.get("sample_size", 0)
+
+        if sample_size > 0:
+            quality = minhash_recall(matrix, sample_size, threshold, num_perm, bands)
+            print(
+                f"MinHash en una muestra de {sample_size} usuarios: recall {quality['recall']:.02%}, "
+                f"precisión {quality['precision']:.02%}, error medio {quality['mean_abs_error']:.03f}"
+            )
+        pairs = minhash_pairs(matrix, threshold, num_perm, bands)
     else:
-        delete_key = random.choice(cache.keys())
-        cache.pop(delete_key)
-        cache[key] = data
+        raise ValueError(f"Modo de similitud desconocido: {mode}")
 
+    # Se conservan solo los vecinos más similares de cada usuario
+    if top_k > 0:
+        pairs = top_k_pairs(pairs, len(user_ids), top_k)
 
-def add_user_articles_to_cache(
-    collection: Collection,
-    user_id: str,
-    cache: dict,
-    max_cache_size: int,
-) -> None:
-    """Añade los artículos del usuario deseado al caché
+    # Se guardan en el fichero
+    n_pairs = write_similarity_file(similarity_file, user_ids, pairs)
+    print(
+        f"Se han guardado {n_pairs} similitudes en {similarity_file} en {time.perf_counter() - start:.2f} s"
+    )
+    return matrix, items
+
+
+def upload_to_neo4j(similarity_file: str, driver, batch_size: int = 10000) -> int:
+    """Sube las similitudes a Neo4j por lotes, con una sola relación por pareja
+
+    La relación SIMILAR_TO es simétrica, así que se consulta sin dirección.
 
     Args:
-        collection (Collection): collección de MongoDB
-        user_id (str): Id del usuario
-        cache (dict): caché
-        max_cache_size (int): Tamaño máximo del caché
+        similarity_file (str): Fichero donde se quiere guardar las similitudes
+        driver: El driver de la conexión a la Neo4J
+        batch_size (int, optional): Similitudes por transacción. Defaults to 10000.
+
+    Returns:
+        int: número de relaciones creadas
     """
-    # Se buscan los artículos en MongoDB
-    user_docs = collection.find({"reviewerID": user_id})
-    # Se consigue el set de los artículos
-    set_articles_user = get_set_articles(user_docs)
-    # Se añaden al caché
-    insert_to_cache(cache, user_id, set_articles_user, max_cache_size)
 
+    query = """
+                UNWIND $rows AS row
+                MERGE (user1: User {user_id: row.user1})
+                MERGE (user2: User {user_id: row.user2})
+                CREATE (user1) - [:SIMILAR_TO {similarity: row.similarity}] -> (user2)
+            """
+
+    create_schema(driver)
 
-def store_similarity(
-    collection: Collection, users: list, similarity_file: str, max_cache_size: int = 30
+    with GraphWriter(driver, query, batch_size, "SIMILAR_TO") as writer:
+
+        # Se recorre el fichero mapeado en memoria por bloques
+        store = read_similarity_file(similarity_file)
+        for ids1, ids2, block in iter_edges(store, batch_size):
+            writer.add_many(
+                {"user1": id1, "user2": id2, "similarity": similarity}
+                for id1, id2, similarity in zip(
+                    ids1.tolist(), ids2.tolist(), block["similarity"].tolist()
+                )
+            )
+    return writer.written
+
+
+# Versión del formato del estado de la actualización incremental
+SIMILARITY_STATE_VERSION = 2
+
+
+def _state_delta_paths(directory: str) -> list[str]:
+    """Ficheros de cambios del estado, en el orden en que se añadieron"""
+    return sorted(glob.glob(os.path.join(glob.escape(directory), "delta_*.npz")))
+
+
+def save_similarity_state(
+    directory: str,
+    watermark: ObjectId,
+    user_ids: list,
+    items: IdMap,
+    matrix: csr_matrix,
 ) -> None:
-    """Se guarda la similitud de los usuarios en un fichero
+    """Guarda el estado completo para actualizar las similitudes de forma incremental
+
+    Sustituye a los cambios guardados con append_similarity_state, que se borran.
 
     Args:
-        collection (Collection): colección de MongoDB
-        users (list): Lista de los usuarios
-        similarity_file (str): Fichero donde se quiere guardar las similitudes
-        max_cache_size (int, optional): Tamaño máximo del caché. Defaults to 30.
+        directory (str): directorio del estado
+        watermark (ObjectId): marca de la última review tenida en cuenta (get_ingest_watermark)
+        user_ids (list): usuarios de la matriz
+        items (IdMap): mapa de los artículos a columnas
+        matrix (csr_matrix): matriz usuario x artículo
     """
+    os.makedirs(directory, exist_ok=True)
+    for path in _state_delta_paths(directory):
+        os.remove(path)
+    save_npz(os.path.join(directory, "matrix.npz"), matrix)
+    with open(os.path.join(directory, "state.json"), "w", encoding="utf-8") as fh:
+        json.dump(
+            {
+                "version": SIMILARITY_STATE_VERSION,
+                "watermark": str(watermark) if watermark is not None else None,
+                "users": user_ids,
+                "items": items.ids,
+            },
+            fh,
+        )
 
-    # Se crea el ficheros en blanco
-    if os.path.exists(similarity_file):
-        os.remove(similarity_file)
-    with open(similarity_file, "w"):
-        pass
 
-    # Se inicializa el caché
-    cache = {}
+def append_similarity_state(
+    directory: str,
+    watermark: ObjectId,
+    user_articles: dict,
+    removed: list,
+    new_items: list,
+) -> None:
+    """Guarda solo los cambios de una actualización incremental
 
-    # Se recorren todos los pares de usuarios
-    for i, user1 in enumerate(users):
+    Se guardan las filas nuevas de los usuarios que han cambiado, los usuarios que se
+    quitan y los artículos nuevos; load_similarity_state los aplica en orden sobre el
+    estado completo.
 
-        # Se guarda la información del primer usuario
-        id1 = user1["_id"]
-        if id1 not in cache:
-            add_user_articles_to_cache(collection, id1, cache, max_cache_size)
+    Args:
+        directory (str): directorio del estado
+        watermark (ObjectId): marca de la última review tenida en cuenta
+        user_articles (dict): artículos (índices de columna) de los usuarios que han
+            cambiado; los que no estaban en el estado se añaden al final
+        removed (list): usuarios que se quitan
+        new_items (list): artículos (asin, type_id) añadidos al mapa de artículos
+    """
+    changed = sorted(user_articles)
+    rows = build_user_item_matrix(
+        changed, ((user_id, user_articles[user_id]) for user_id in changed)
+    )
 
-        for user2 in users[i + 1 :]:
+    paths = _state_delta_paths(directory)
+    number = int(paths[-1].rsplit("_", 1)[1].split(".")[0]) + 1 if paths else 1
+    path = os.path.join(directory, f"delta_{number:06d}.npz")
+
+    # Se escribe en un temporal y se renombra para no dejar un fichero a medias
+    with open(path + ".tmp", "wb") as fh:
+        np.savez(
+            fh,
+            watermark=np.array(str(watermark) if watermark is not None else ""),
+            users=np.array(changed, dtype=str),
+            indptr=rows.indptr,
+            indices=rows.indices,
+            removed=np.array(list(removed), dtype=str),
+            item_asins=np.array([asin for asin, _ in new_items], dtype=str),
+            item_types=np.array([type_id for _, type_id in new_items], dtype=np.int64),
+        )
+    os.replace(path + ".tmp", path)
 
-            # Se guarda la información del segundo usuario
-            id2 = user2["_id"]
-            if id2 not in cache:
-                add_user_articles_to_cache(collection, id2, cache, max_cache_size)
 
-            # Se calcula la similitud
-            similarity = calculate_jaccard_similarity(cache[id1], cache[id2])
+def load_similarity_state(directory: str) -> tuple:
+    """Carga el estado guardado por save_similarity_state con los cambios añadidos después
 
-            # Se guarda la similitud en el fichero si es mayor de 0
-            if similarity > 0:
-                with open(similarity_file, "a", encoding="utf-8") as fh:
-                    fh.write(f"{id1} {id2} {similarity}\n")
+    Args:
+        directory (str): directorio del estado
 
+    Returns:
+        tuple: watermark, usuarios, mapa de artículos y matriz, o None si no hay estado
+            (o es de una versión anterior)
+    """
+    state_file = os.path.join(directory, "state.json")
+    if not os.path.exists(state_file):
+        return None
+
+    with open(state_file, "r", encoding="utf-8") as fh:
+        state = json.load(fh)
+    if state.get("version") != SIMILARITY_STATE_VERSION:
+        print("El estado guardado es de una versión anterior")
+        return None
+
+    items = IdMap(tuple(item) for item in state["items"])
+    matrix = load_npz(os.path.join(directory, "matrix.npz")).tocsr()
+    watermark = state["watermark"]
+    user_ids = state["users"]
+
+    # Se aplican en orden los cambios de las actualizaciones incrementales
+    for path in _state_delta_paths(directory):
+        with np.load(path) as delta:
+            watermark = str(delta["watermark"])
+            for asin, type_id in zip(
+                delta["item_asins"].tolist(), delta["item_types"].tolist()
+            ):
+                items.add((asin, type_id))
+            changed = delta["users"].tolist()
+            indptr = delta["indptr"]
+            indices = delta["indices"]
+            removed = set(delta["removed"].tolist())
+
+        user_articles = {
+            user_id: indices[indptr[k] : indptr[k + 1]]
+            for k, user_id in enumerate(changed)
+        }
+        current = set(user_ids)
+        new_user_ids = [user_id for user_id in user_ids if user_id not in removed]
+        new_user_ids += [user_id for user_id in changed if user_id not in current]
+        matrix = update_user_item_matrix(matrix, user_ids, new_user_ids, user_articles)
+        user_ids = new_user_ids
+
+    watermark = ObjectId(watermark) if watermark else None
+    return watermark, user_ids, items, matrix
+
+
+def update_similarity(
+    collection: Collection,
+    users: list,
+    similarity_file: str,
+    state_directory: str,
+    driver,
+    threshold: float = 0.0,
+    chunk_size: int = 5000,
+    batch_size: int = 10000,
+    mode: str = "exacto",
+    top_k: int = 0,
+) -> None:
+    """Actualiza las similitudes y Neo4j solo con los cambios desde la última ejecución
 
-def upload_to_neo4j(similarity_file: str, driver) -> None:
-    """Sube las similitudes a Neo4j
+    Se buscan los usuarios con reviews cargadas después de la última ejecución (por su
+    _id, ver get_ingest_watermark) y los que entran o salen de la lista de usuarios, se
+    recalculan solo sus parejas y en Neo4j se crean, modifican o borran solo las
+    relaciones que han cambiado. Tampoco se reescriben el fichero de similitudes ni el
+    estado: las parejas recalculadas y las filas nuevas de la matriz se añaden como
+    ficheros de cambios, que se juntan con la base cuando ocupan más que ella. La
+    primera vez se calcula todo.
 
     Args:
-        similarity_file (str): Fichero donde se quiere guardar las similitudes
+        collection (Collection): colección de MongoDB
+        users (list): Lista de los usuarios
+        similarity_file (str): Fichero de similitudes
+        state_directory (str): Directorio donde se guarda el estado entre ejecuciones
         driver: El driver de la conexión a la Neo4J
+        threshold (float, optional): Solo se guardan las similitudes mayores que este valor. Defaults to 0.0.
+        chunk_size (int, optional): Usuarios cuyos artículos se traen en cada agregación. Defaults to 5000.
+        batch_size (int, optional): Relaciones por transacción. Defaults to 10000.
+        mode (str, optional): modo de similitud configurado; solo se admite "exacto". Defaults to "exacto".
+        top_k (int, optional): vecinos por usuario configurados; solo se admite 0. Defaults to 0.
+
+    Raises:
+        ValueError: si el modo no es "exacto" o top_k es mayor que 0, porque un cambio
+            puede sacar vecinos de usuarios que no han cambiado
     """
+    if mode != "exacto" or top_k > 0:
+        raise ValueError(
+            "La actualización incremental solo admite modo_similitud = exacto y "
+            f"vecinos_top_k = 0 (configurado: {mode} y {top_k})"
+        )
 
-    query = """
-                MERGE (user1: User {user_id: $user1})
-                MERGE (user2: User {user_id: $user2})
-                CREATE (user1) - [:SIMILAR_TO {similarity: $similarity}] -> (user2)
-                CREATE (user1) <- [:SIMILAR_TO {similarity: $similarity}] - (user2)
-            """
+    start = time.perf_counter()
+    user_ids = [user["_id"] for user in users]
 
-    with driver.session() as session:
-        with open(similarity_file, "r") as fh:
+    # Se fija la nueva marca antes de leer para no perder reviews que lleguen durante la ejecución
+    new_watermark = get_ingest_watermark(collection)
 
-            # Se recorre el fichero
-            for line in fh:
-                id1, id2, similarity = line.strip().split(" ")
+    state = load_similarity_state(state_directory)
+    if state is None or not os.path.exists(similarity_file):
+        print("No hay un estado anterior, se calculan todas las similitudes")
+        matrix, items = store_similarity(
+            collection, users, similarity_file, threshold, chunk_size=chunk_size
+        )
+        with driver.session() as session:
+            session.run(
+                "MATCH ()-[s:SIMILAR_TO]->() CALL { WITH s DELETE s } IN TRANSACTIONS OF 10000 ROWS"
+            ).consume()
+        upload_to_neo4j(similarity_file, driver, batch_size)
+        save_similarity_state(state_directory, new_watermark, user_ids, items, matrix)
+        return
 
-                # Se ejecuta la query
-                session.run(query, user1=id1, user2=id2, similarity=float(similarity))
+    watermark, old_user_ids, items, matrix = state
+
+    # Usuarios con reviews cargadas desde la última ejecución
+    docs = collection.aggregate(
+        [
+            {"$match": ingested_between(watermark, new_watermark)},
+            {"$group": {"_id": "$reviewerID"}},
+        ],
+        allowDiskUse=True,
+    )
+    current = set(user_ids)
+    previous = set(old_user_ids)
+    changed = {doc["_id"] for doc in docs} & current
+    changed |= current - previous
+    removed = previous - current
+    affected = changed | removed
+
+    # Se actualizan solo las filas de los usuarios que han cambiado; los nuevos van al final
+    n_items = len(items)
+    user_articles = dict(
+        fetch_user_articles(collection, sorted(changed), items, chunk_size)
+    )
+    for user_id in changed:
+        user_articles.setdefault(user_id, np.empty(0, dtype=np.int32))
+    user_ids = [user_id for user_id in old_user_ids if user_id not in removed]
+    user_ids += sorted(current - previous)
+    matrix = update_user_item_matrix(matrix, old_user_ids, user_ids, user_articles)
+    changed_rows = [i for i, user_id in enumerate(user_ids) if user_id in changed]
+    rows, cols, similarities = jaccard_rows(matrix, changed_rows, threshold)
+
+    def key(id1: str, id2: str) -> tuple[str, str]:
+        return (id1, id2) if id1 < id2 else (id2, id1)
+
+    # Las similitudes del fichero son float32, así que las nuevas se redondean igual para compararlas
+    new_pairs = {
+        key(user_ids[i], user_ids[j]): s
+        for i, j, s in zip(
+            rows.tolist(), cols.tolist(), similarities.astype(np.float32).tolist()
+        )
+    }
+
+    # Se buscan las parejas anteriores de los usuarios afectados
+    store = read_similarity_file(similarity_file)
+    old_affected = np.array(
+        [user_id in affected for user_id in store.sources], dtype=bool
+    )
+    edge_affected = old_affected[store.edges["src"]] | old_affected[store.edges["dst"]]
+    old_pairs = {}
+    for ids1, ids2, block in iter_edges(
+        store._replace(edges=store.edges[edge_affected])
+    ):
+        for id1, id2, similarity in zip(
+            ids1.tolist(), ids2.tolist(), block["similarity"].tolist()
+        ):
+            old_pairs[key(id1, id2)] = similarity
+    n_pairs = int((~edge_affected).sum()) + len(rows)
+    del store
+
+    upserts = [
+        {"user1": id1, "user2": id2, "similarity": s}
+        for (id1, id2), s in new_pairs.items()
+        if old_pairs.get((id1, id2)) != s
+    ]
+    deletes = [
+        {"user1": id1, "user2": id2} for id1, id2 in old_pairs.keys() - new_pairs.keys()
+    ]
+
+    # Se aplican solo los cambios en Neo4j
+    upsert_query = """
+                UNWIND $rows AS row
+                MERGE (user1: User {user_id: row.user1})
+                MERGE (user2: User {user_id: row.user2})
+                MERGE (user1) - [similarity:SIMILAR_TO] - (user2)
+                SET similarity.similarity = row.similarity
+            """
+    delete_query = """
+                UNWIND $rows AS row
+                MATCH (:User {user_id: row.user1}) - [similarity:SIMILAR_TO] - (:User {user_id: row.user2})
+                DELETE similarity
+            """
+    create_schema(driver)
+    with GraphWriter(driver, upsert_query, batch_size, "SIMILAR_TO nuevas") as writer:
+        writer.add_many(upserts)
+    with GraphWriter(driver, delete_query, batch_size, "SIMILAR_TO borradas") as writer:
+        writer.add_many(deletes)
+
+    # Se guardan solo los cambios, después de Neo4j para repetirlos si algo falla antes
+    append_similarity_delta(
+        similarity_file, user_ids, sorted(affected), (rows, cols, similarities)
+    )
+    append_similarity_state(
+        state_directory,
+        new_watermark,
+        {user_id: user_articles[user_id] for user_id in changed},
+        sorted(removed),
+        items.ids[n_items:],
+    )
+
+    # Cuando los cambios ocupan más que la base se juntan con ella
+    if needs_compaction(similarity_file, similarity_delta_paths(similarity_file)):
+        compact_similarity_file(similarity_file)
+    if needs_compaction(
+        os.path.join(state_directory, "matrix.npz"), _state_delta_paths(state_directory)
+    ):
+        save_similarity_state(state_directory, new_watermark, user_ids, items, matrix)
+
+    print(
+        f"{len(changed)} usuarios con cambios y {len(removed)} eliminados: {len(upserts)} similitudes "
+        f"nuevas o modificadas, {len(deletes)} borradas, {n_pairs} en total "
+        f"({time.perf_counter() - start:.2f} s)"
+    )
 
 
 # QUERY 4.2
@@ -224,181 +615,243 @@ def usuarios_articulos_pedir_datos() -> tuple[list, int]:
     type_id_variable = int(
         [key for key, value in diccionario_categorias.items() if value == categoria][0]
     )
-    numero_de_datos = len(get_product_asins(type_id_variable))
+    lista_productos = get_product_asins(type_id_variable)
+    numero_de_datos = len(lista_productos)
 
     n = -1
     while not 0 <= n <= numero_de_datos:
         print(f"Numero de datos aleatorios, entre 0 y {numero_de_datos}")
         n = int(input())
 
-    lista_productos = get_product_asins(type_id_variable)
     seleccion = random.sample(lista_productos, k=n)
 
     return seleccion, type_id_variable
 
 
-def query_4_2() -> None:
-    """Genera el gráfico en neo4j con los usuarios y los artículos que han comprado
+def seleccionar_articulos(categoria: str, n: int, seed: int = None) -> tuple[list, int]:
+    """Versión no interactiva de usuarios_articulos_pedir_datos
 
     Args:
-        connection: conexión a la base de datos
+        categoria (str): nombre del tipo de producto
+        n (int): número de artículos aleatorios
+        seed (int, optional): semilla para repetir la selección. Defaults to None.
+
+    Raises:
+        ValueError: si la categoría no existe o no tiene n artículos
 
     Returns:
-        None (aunque carga datos en la base de datos de Neo4j)
+        tuple[list, int]: lista de productos seleccionados y el type_id de los productos
     """
+    type_ids = {value: key for key, value in get_product_types()}
+    if categoria not in type_ids:
+        raise ValueError(f"La categoría {categoria} no existe")
+    type_id = int(type_ids[categoria])
+
+    lista_productos = get_product_asins(type_id)
+    if not 0 <= n <= len(lista_productos):
+        raise ValueError(
+            f"Numero de datos aleatorios, entre 0 y {len(lista_productos)}"
+        )
+    return random.Random(seed).sample(lista_productos, k=n), type_id
 
-    seleccion, type_id_variable = usuarios_articulos_pedir_datos()
-
-    config = read_config()
-    collection = get_collection(config)
 
-    lista_general = []
+def cargar_grafo_reviews(
+    collection: Collection,
+    driver,
+    asins: list,
+    type_id: int,
+    batch_size: int = 10000,
+    chunk_size: int = 10000,
+) -> int:
+    """Carga en Neo4j las reviews de los artículos leyéndolas de MongoDB en streaming
+
+    Se pide un solo find con $in por cada chunk_size artículos (uno solo si hay menos)
+    y los documentos se pasan directamente a los lotes de Neo4j, con la nota como float
+    y la fecha como datetime.
 
-    for asin in seleccion:
+    Args:
+        collection (Collection): colección de MongoDB
+        driver: driver de la conexión a Neo4j
+        asins (list): artículos seleccionados
+        type_id (int): tipo de los artículos
+        batch_size (int, optional): relaciones por transacción. Defaults to 10000.
+        chunk_size (int, optional): artículos por consulta. Defaults to 10000.
 
-        result = collection.find(
-            {"asin": asin, "type_id": type_id_variable},
-            {"asin": 1, "reviewerID": 1, "overall": 1, "reviewTime": 1, "_id": 0},
-        )
-        for res in result:
-            lista_general.append(res)
-    with open("resultados_reviews.txt", "w") as file:
-        # Escribir los encabezados si es necesario
-        # Iterar a través de la lista de diccionarios y escribir cada uno en el archivo
-        for document in lista_general:
-            # Convertir los valores del diccionario en una cadena separada por tabulaciones
-            line = f"{document['reviewerID']}/{document['asin']}/{document['overall']}/{document['reviewTime']}\n"
-            # Escribir la línea en el archivo
-            file.write(line)
-
-    print("Los datos han sido guardados en resultados_reviews.txt")
-
-    class ReviewGraph:
-        def __init__(self, uri, user, password):
-            self.driver = GraphDatabase.driver(uri, auth=(user, password))
-
-        def close(self) -> None:
-            self.driver.close()
-
-        def create_review_relationship(self, reviewer_id, asin, overall, review_time):
-            with self.driver.session() as session:
-                session.execute_write(
-                    self._create_and_link, reviewer_id, asin, overall, review_time
-                )
+    Returns:
+        int: número de relaciones escritas
+    """
+    neo4j_query = """
+                UNWIND $rows AS row
+                MERGE (reviewer:Reviewer {id: row.reviewer_id})
+                MERGE (product:Product {id: row.asin})
+                MERGE (reviewer)-[:REVIEWED {overall: row.overall, reviewTime: row.review_time}]->(product)
+                """
 
-        @staticmethod
-        def _create_and_link(tx, reviewer_id, asin, overall, review_time):
-            query = (
-                "MERGE (reviewer:Reviewer {id: $reviewer_id}) "
-                "MERGE (product:Product {id: $asin}) "
-                "MERGE (reviewer)-[:REVIEWED {overall: $overall, reviewTime: $review_time}]->(product)"
+    collection.create_index([("asin", 1), ("type_id", 1)])
+    create_schema(driver)
+
+    with GraphWriter(driver, neo4j_query, batch_size, "REVIEWED") as writer:
+        for start in range(0, len(asins), chunk_size):
+            docs = collection.find(
+                {
+                    "asin": {"$in": asins[start : start + chunk_size]},
+                    "type_id": type_id,
+                },
+                {"asin": 1, "reviewerID": 1, "overall": 1, "reviewTime": 1, "_id": 0},
+                batch_size=batch_size,
             )
-            tx.run(
-                query,
-                reviewer_id=reviewer_id,
-                asin=asin,
-                overall=overall,
-                review_time=review_time,
+            writer.add_many(
+                {
+                    "reviewer_id": doc["reviewerID"],
+                    "asin": doc["asin"],
+                    "overall": float(doc["overall"]),
+                    "review_time": doc["reviewTime"],
+                }
+                for doc in docs
             )
+    return writer.written
+
+
+def query_4_2(categoria: str = None, n: int = None, seed: int = None) -> int:
+    """Genera el gráfico en neo4j con los usuarios y los artículos que han comprado
+
+    Si no se indican la categoría y el número de artículos se piden por pantalla.
+
+    Args:
+        categoria (str, optional): nombre del tipo de producto. Defaults to None.
+        n (int, optional): número de artículos aleatorios. Defaults to None.
+        seed (int, optional): semilla de la selección. Defaults to None.
+
+    Returns:
+        int: número de relaciones cargadas en Neo4j
+    """
+
+    if categoria is None or n is None:
+        seleccion, type_id_variable = usuarios_articulos_pedir_datos()
+    else:
+        seleccion, type_id_variable = seleccionar_articulos(categoria, n, seed)
 
     config = read_config()
+    collection = get_collection(config)
+
     user = config["NEO4J"]["usuario"]
     password = config["NEO4J"]["password"]
     connection = config["NEO4J"]["connection"]
+    batch_size = int(config["NEO4J"]["tamano_lote"])
     uri = connection
 
     driver = GraphDatabase.driver(uri, auth=(user, password))
     with driver.session() as session:
         session.run("MATCH (n) DETACH DELETE n")
 
-    graph = ReviewGraph(uri, user, password)
-
-    with open("resultados_reviews.txt", "r") as file:
-        for line in file:
-            parts = line.strip().split("/")
-            if len(parts) == 4:
-                reviewer_id, asin, overall, review_time = parts
-                graph.create_review_relationship(
-                    reviewer_id, asin, overall, review_time
-                )
+    written = cargar_grafo_reviews(
+        collection, driver, seleccion, type_id_variable, batch_size
+    )
 
-    graph.close()
+    driver.close()
     print("Grafo creado con éxito")
+    return written
 
 
 # QUERY 4.3
 
 
-def apartado_4_3(connection, collection: Collection, driver) -> None:
+def apartado_4_3(
+    connection,
+    collection: Collection,
+    driver,
+    batch_size: int = 10000,
+    limit: int = 0,
+) -> int:
     """Carga en Neo4j los usuarios que han escrito a más de dos tipos de productos distintos
 
+    Se hace una sola agregación: se agrupa por (reviewer, tipo), después por reviewer y
+    se quedan los que tienen al menos dos tipos. Los nombres se traen de mySQL de una vez.
+
     Args:
         connection: conexión a la base de datos
         collection (Collection): colección de MongoDB
         driver: driver de la conexión a Neo4j
+        batch_size (int, optional): relaciones por transacción. Defaults to 10000.
+        limit (int, optional): solo se miran los primeros reviewers por nombre (0 para todos). Defaults to 0.
 
     Returns:
-        None (aunque carga datos en la base de datos de Neo4j)
+        int: número de relaciones cargadas en Neo4j
     """
 
-    sql = """
-            SELECT reviewerID, reviewerName
-            FROM reviewers
-            ORDER BY reviewerName
-            LIMIT 400;
-        """
-
+    # Se hace MERGE solo por user_id (la restricción de unicidad) y después se pone el nombre
     neo4j_query = """
-                MERGE (reviewer: User {user_id: $reviewer_id, reviewer_name: $reviewer_name})
-                MERGE (type: ProductType {product_type: $product_type})
-                CREATE (reviewer) - [:WROTE {number_of_articles: $count}] -> (type)
+                UNWIND $rows AS row
+                MERGE (reviewer: User {user_id: row.reviewer_id})
+                SET reviewer.reviewer_name = row.reviewer_name
+                MERGE (type: ProductType {product_type: row.product_type})
+                CREATE (reviewer) - [:WROTE {number_of_articles: row.count}] -> (type)
                 """
 
-    cursor = connection.cursor()
-    cursor.execute(sql)
-    reviewer_names = cursor.fetchall()
+    pipeline = [
+        {
+            "$group": {
+                "_id": {"reviewerID": "$reviewerID", "type_id": "$type_id"},
+                "count": {"$sum": 1},
+            }
+        },
+        {
+            "$group": {
+                "_id": "$_id.reviewerID",
+                "types": {"$push": {"type_id": "$_id.type_id", "count": "$count"}},
+            }
+        },
+        {"$match": {"$expr": {"$gte": [{"$size": "$types"}, 2]}}},
+    ]
+
+    # Se consiguen los nombres de los reviewers
+    if limit > 0:
+        sql = """
+                SELECT reviewerID, reviewerName
+                FROM reviewers
+                ORDER BY reviewerName
+                LIMIT %s;
+            """
+        cursor = connection.cursor()
+        cursor.execute(sql, (limit,))
+        reviewer_names = dict(cursor.fetchall())
+        cursor.close()
+        pipeline.insert(0, {"$match": {"reviewerID": {"$in": list(reviewer_names)}}})
+    else:
+        reviewer_names = get_reviewer_names(connection)
 
     # Se consigue un diccionario de los ids y nombres de productos
     product_types = dict(get_product_types())
 
-    with driver.session() as session:
-        # Se recorren los reviewers
-        for id, name in reviewer_names:
-            docs = collection.aggregate(
-                [
-                    {"$match": {"reviewerID": id}},
-                    {"$group": {"_id": "$type_id", "count": {"$sum": 1}}},
-                ]
+    create_schema(driver)
+
+    docs = collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+    with GraphWriter(driver, neo4j_query, batch_size, "WROTE") as writer:
+        # Se recorren los reviewers que han escrito a más de dos tipos de productos distintos
+        for doc in docs:
+
+            # Se cambia el nombre si no existe a NameDoesNotExist
+            name = reviewer_names.get(doc["_id"]) or "NameDoesNotExist"
+
+            # Se añaden al lote
+            writer.add_many(
+                {
+                    "reviewer_id": doc["_id"],
+                    "reviewer_name": name,
+                    "product_type": product_types[type_doc["type_id"]],
+                    "count": type_doc["count"],
+                }
+                for type_doc in doc["types"]
             )
-            docs = list(docs)
-
-            # Si han escrito a más de dos tipos de productos distintos
-            # Se suben las relaciones a Neo4j
-            if len(list(docs)) >= 2:
-
-                # Se cambia el nombre si no existe a NameDoesNotExist
-                if name is None:
-                    name = "NameDoesNotExist"
-
-                for doc in docs:
-                    product_type = product_types[doc["_id"]]
-                    count = doc["count"]
-                    # Se ejecuta la query
-                    session.run(
-                        neo4j_query,
-                        reviewer_id=id,
-                        reviewer_name=name,
-                        product_type=product_type,
-                        count=count,
-                    )
     print("Se ha finalizado la carga en Neo4j")
+    return writer.written
 
 
 def apartado_4_4() -> None:
-    """Obtiene los artículos más populares, bajo un límite de 39 reviews y los artículos en común entre usuarios
+    """Obtiene los artículos más populares, bajo un límite de reviews, y los artículos en común entre usuarios
 
-    Args:
-        collection (Collection): colección de MongoDB
+    La selección de artículos y el motor (Cypher sobre el grafo o el cálculo en memoria
+    de co_review) se configuran en configuracion.ini.
 
     Returns:
         None (aunque imprime los resultados)
@@ -406,105 +859,65 @@ def apartado_4_4() -> None:
     user = config["NEO4J"]["usuario"]
     password = config["NEO4J"]["password"]
     connection = config["NEO4J"]["connection"]
+    batch_size = int(config["NEO4J"]["tamano_lote"])
+    reviews_file = config["NEO4J"]["fichero_reviews"]
     uri = connection
     driver = GraphDatabase.driver(uri, auth=(user, password))
     with driver.session() as session:
         session.run("MATCH (n) DETACH DELETE n")
-    driver.close()
-
-    def get_top_asin_reviewers() -> None:
-        collection = get_collection(config)
-
-        # La pipeline de agregación para obtener los asin
-        pipeline = [
-            {"$group": {"_id": "$asin", "reviewCount": {"$sum": 1}}},
-            {"$match": {"reviewCount": {"$lt": 40}}},
-            {"$sort": {"reviewCount": -1}},
-            {"$limit": 5},
-        ]
-
-        # Obtener los asin con la mayor cantidad de reviews, pero menos de 40
-        top_asin_under_40_reviews = list(collection.aggregate(pipeline))
-        asins = [asin["_id"] for asin in top_asin_under_40_reviews]
 
-        # Escribir los resultados en un archivo de texto
-        with open("resultados_reviews.txt", "w") as f:
-            for asin in asins:
-                # Obtener los reviewerID para este asin
-                reviewers = collection.find({"asin": asin}, {"_id": 0, "reviewerID": 1})
-                reviewer_ids = [reviewer["reviewerID"] for reviewer in reviewers]
-                # Escribir el asin seguido de los reviewerID asociados en la misma línea
-                f.write(f"{asin}/{'/'.join(reviewer_ids)}\n")
-
-    def create_nodes_and_relationships(tx, asin, reviewer_ids):
-
-        driver = GraphDatabase.driver(uri, auth=(user, password))
-
-        # Crear el nodo del artículo si no existe
-        tx.run("MERGE (a:Article {asin: $asin})", asin=asin)
+    collection = get_collection(config)
 
-        for reviewer_id in reviewer_ids:
-            # Crear el nodo del usuario si no existe
-            tx.run("MERGE (u:User {reviewerID: $reviewer_id})", reviewer_id=reviewer_id)
-            # Crear la relación entre el artículo y el usuario si no existe
-            tx.run(
-                """
-                MATCH (a:Article {asin: $asin}), (u:User {reviewerID: $reviewer_id})
-                MERGE (u)-[:REVIEWED]->(a)
-                """,
-                asin=asin,
-                reviewer_id=reviewer_id,
-            )
-        driver.close()
+    # Obtener los asin con la mayor cantidad de reviews, dentro del rango configurado
+    asins = select_articles(
+        collection,
+        int(config["NEO4J"]["min_reviews_articulo"]),
+        int(config["NEO4J"]["max_reviews_articulo"]),
+        int(config["NEO4J"]["numero_articulos_coreviews"]),
+    )
 
-    # Función para calcular y retornar los enlaces entre los usuarios
-    def find_shared_reviews(tx) -> list:
-        return list(
-            tx.run(
-                """
-                    MATCH (u1:User)-[:REVIEWED]->(a:Article)<-[:REVIEWED]-(u2:User)
-                    WHERE id(u1) < id(u2)
-                    WITH u1, u2, COUNT(a) AS sharedReviews
-                    RETURN u1.reviewerID AS User1, u2.reviewerID AS User2, sharedReviews
-                    ORDER BY sharedReviews DESC
-                """
+    if config["NEO4J"]["motor_coreviews"] == "memoria":
+        # Se calculan las parejas con la matriz de incidencia y solo se suben las parejas
+        shared_review_data = shared_reviews(collection, asins)
+        upload_shared_reviews(driver, shared_review_data, batch_size)
+    else:
+        # Escribir los enlaces artículo-reviewer en el fichero binario
+        with EdgeWriter(reviews_file, LINK_DTYPE) as writer:
+            docs = collection.find(
+                {"asin": {"$in": asins}}, {"_id": 0, "asin": 1, "reviewerID": 1}
             )
-        )
-
-    # Llamar a la función y especificar el archivo de salida
-    get_top_asin_reviewers()
-
-    # Conectar con Neo4j
-    driver = GraphDatabase.driver(uri, auth=(user, password))
-
-    # Leer el archivo .txt y procesar cada línea
-    with driver.session() as session:
-        with open("resultados_reviews.txt", "r") as file:
-            for line in file:
-                parts = line.strip().split("/")
-                asin = parts[0]
-                reviewer_ids = parts[1:]
-                session.execute_write(
-                    create_nodes_and_relationships, asin, reviewer_ids
+            for doc in docs:
+                writer.add(doc["asin"], doc["reviewerID"])
+
+        neo4j_query = """
+                    UNWIND $rows AS row
+                    MERGE (a:Article {asin: row.asin})
+                    MERGE (u:User {reviewerID: row.reviewer_id})
+                    MERGE (u)-[:REVIEWED]->(a)
+                    """
+        create_schema(driver)
+
+        # Leer el fichero binario por bloques
+        with GraphWriter(driver, neo4j_query, batch_size, "REVIEWED") as writer:
+            for asin_ids, reviewer_ids, _ in iter_edges(load_edges(reviews_file)):
+                writer.add_many(
+                    {"asin": asin, "reviewer_id": reviewer_id}
+                    for asin, reviewer_id in zip(
+                        asin_ids.tolist(), reviewer_ids.tolist()
+                    )
                 )
 
-    # Cerrar la conexión con Neo4j
-    driver.close()
+        # Se ejecuta la consulta de los enlaces entre los usuarios
+        shared_review_data = cypher_shared_reviews(driver)
 
-    # Conectar con Neo4j y ejecutar la consulta
-    driver = GraphDatabase.driver(uri, auth=(user, password))
-    with driver.session() as session:
-        shared_review_data = session.execute_read(find_shared_reviews)
-        for record in shared_review_data:
-            print(
-                f"User {record['User1']} and User {record['User2']} have {record['sharedReviews']} shared reviews."
-            )
-        if len(shared_review_data) == 0:
-            print("No se han encontrado usuarios con reviews en común")
-        else:
-            print(
-                f"Se han encontrado {len(shared_review_data)} parejas de reviewers que tienen reviews en común"
-            )
+    for user1, user2, shared in shared_review_data:
+        print(f"User {user1} and User {user2} have {shared} shared reviews.")
+    if len(shared_review_data) == 0:
+        print("No se han encontrado usuarios con reviews en común")
+    else:
+        print(
+            f"Se han encontrado {len(shared_review_data)} parejas de reviewers que tienen reviews en común"
+        )
     driver.close()
 
 
@@ -524,6 +937,57 @@ def borrar_neo4j(driver) -> None:
         )
 
 
+# EXPORTACIÓN PARA LA IMPORTACIÓN OFFLINE
+
+
+def get_reviewer_names(connection) -> dict:
+    """Devuelve un diccionario de los ids de los reviewers a sus nombres
+
+    Args:
+        connection: conexión a la base de datos de mySQL
+
+    Returns:
+        dict: diccionario de reviewerID a reviewerName
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT reviewerID, reviewerName FROM reviewers")
+    names = dict(cursor.fetchall())
+    cursor.close()
+    return names
+
+
+def exportar_neo4j_import(
+    connection, collection: Collection, similarity_file: str, directory: str
+) -> None:
+    """Exporta los grafos a CSV para cargarlos con neo4j-admin database import
+
+    Se exportan las relaciones SIMILAR_TO (del fichero de similitudes, si existe),
+    REVIEWED y WROTE con sus nodos, con las mismas etiquetas y propiedades que las
+    cargas de los apartados 4.1, 4.2 y 4.3. El grafo User-Article del apartado 4.4 no
+    se exporta, porque se construye en cada consulta con los artículos elegidos.
+
+    Args:
+        connection: conexión a la base de datos de mySQL
+        collection (Collection): colección de MongoDB
+        similarity_file (str): fichero de similitudes generado por store_similarity
+        directory (str): directorio donde se guardan los CSV
+    """
+    product_types = dict(get_product_types())
+
+    with BulkExporter(directory, get_reviewer_names(connection)) as exporter:
+        if os.path.exists(similarity_file):
+            export_similarities(exporter, similarity_file)
+        export_reviews(exporter, collection)
+        export_multi_category(exporter, collection, product_types)
+
+    # Se comprueban los ficheros antes de dar el comando de importación
+    counts = validate_import_files(directory)
+    for name, count in counts.items():
+        print(f"{name}: {count} filas")
+    print("Para importarlos, con la base de datos parada:")
+    print(import_command(directory))
+
+
 if __name__ == "__main__":
     config = read_config()
     collection = get_collection(config)
@@ -531,14 +995,26 @@ if __name__ == "__main__":
 
     LIMITE_REVIEWERS = int(config["NEO4J"]["limite_usuarios_reviews"])
     similarity_file = config["NEO4J"]["fichero_similitud"]
-    max_cache_size = int(config["NEO4J"]["max_cache_size"])
-    users = get_most_reviews(collection, LIMITE_REVIEWERS)
+    similarity_threshold = float(config["NEO4J"]["umbral_similitud"])
+    block_size = int(config["NEO4J"]["tamano_bloque"])
+    users_per_query = int(config["NEO4J"]["usuarios_por_consulta"])
+    batch_size = int(config["NEO4J"]["tamano_lote"])
+    export_directory = config["NEO4J"]["directorio_exportacion"]
+    state_directory = config["NEO4J"]["directorio_estado_similitud"]
+    similarity_mode = config["NEO4J"]["modo_similitud"]
+    top_k = int(config["NEO4J"]["vecinos_top_k"])
+    n_workers = int(config["NEO4J"]["procesos"])
+    minhash_config = {
+        "num_perm": int(config["NEO4J"]["minhash_permutaciones"]),
+        "bands": int(config["NEO4J"]["minhash_bandas"]),
+        "sample_size": int(config["NEO4J"]["minhash_muestra_recall"]),
+    }
     USUARIO = config["NEO4J"]["usuario"]
     PASSWORD = config["NEO4J"]["password"]
     connection = config["NEO4J"]["connection"]
 
     opcion_menu = None
-    while opcion_menu is None or 1 <= opcion_menu <= 5:
+    while opcion_menu is None or 1 <= opcion_menu <= 7:
         print()
         print("1. Obtener similitudes entre usuarios y mostrar los enlaces en Neo4J")
         print("2. Obtener enlaces entre usuarios y artículos")
@@ -547,14 +1023,31 @@ if __name__ == "__main__":
         )
         print("4. Artículos populares y artículos en común entre usuarios")
         print("5. Borrar datos de Neo4J")
+        print("6. Exportar los grafos a CSV para neo4j-admin database import")
+        print("7. Actualizar las similitudes con las reviews nuevas (incremental)")
         print("Introduzca otro numero para salir.")
         opcion_menu = int(input("Inserte el número de la opción deseada: "))
 
+        # Los usuarios con más reviews solo se calculan en las opciones que los usan
+        if opcion_menu in (1, 6, 7):
+            users = get_most_reviews(collection, LIMITE_REVIEWERS)
+
         if opcion_menu == 1:
 
             driver = GraphDatabase.driver(connection, auth=(USUARIO, PASSWORD))
-            store_similarity(collection, users, similarity_file, max_cache_size)
-            upload_to_neo4j(similarity_file, driver)
+            store_similarity(
+                collection,
+                users,
+                similarity_file,
+                similarity_threshold,
+                block_size,
+                users_per_query,
+                similarity_mode,
+                minhash_config,
+                top_k,
+                n_workers,
+            )
+            upload_to_neo4j(similarity_file, driver, batch_size)
 
         if opcion_menu == 2:
             query_4_2()
@@ -565,7 +1058,13 @@ if __name__ == "__main__":
             connection = config["NEO4J"]["connection"]
 
             driver = GraphDatabase.driver(connection, auth=(USUARIO, PASSWORD))
-            apartado_4_3(sql_connection, collection, driver)
+            apartado_4_3(
+                sql_connection,
+                collection,
+                driver,
+                batch_size,
+                int(config["NEO4J"]["limite_reviewers_multicategoria"]),
+            )
 
         if opcion_menu == 4:
             apartado_4_4()
@@ -573,3 +1072,35 @@ if __name__ == "__main__":
         if opcion_menu == 5:
             driver = GraphDatabase.driver(connection, auth=(USUARIO, PASSWORD))
             borrar_neo4j(driver)
+
+        if opcion_menu == 6:
+            store_similarity(
+                collection,
+                users,
+                similarity_file,
+                similarity_threshold,
+                block_size,
+                users_per_query,
+                similarity_mode,
+                minhash_config,
+                top_k,
+                n_workers,
+            )
+            exportar_neo4j_import(
+                sql_connection, collection, similarity_file, export_directory
+            )
+
+        if opcion_menu == 7:
+            driver = GraphDatabase.driver(connection, auth=(USUARIO, PASSWORD))
+            update_similarity(
+                collection,
+                users,
+                similarity_file,
+                state_directory,
+                driver,
+                similarity_threshold,
+                users_per_query,
+                batch_size,
+                similarity_mode,
+                top_k,
+            )
@@ -0,0 +1,197 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from similarity import load_shared_matrix, save_shared_matrix
+
+# Modelos ya cargados en cada worker, por directorio
+_models = {}
+
+
+def _get_model(loader: Callable, directory: str):
+    """Carga el modelo del directorio una sola vez por proceso"""
+    if directory not in _models:
+        _models[directory] = loader(directory)
+    return _models[directory]
+
+
+def _predict_tile(args: tuple) -> int:
+    """Predice en un worker las filas [start, end) y las escribe en el buffer de salida
+
+    Cada fila tiene reservado un hueco en los arrays de salida a partir de su offset; se
+    escriben sus valores y su número de valores.
+    """
+    loader, model_directory, directory, start, end = args
+    model = _get_model(loader, model_directory)
+    Y = load_shared_matrix(directory, "input")
+    block = model._predict_block(Y[start:end], np.arange(start, end)).tocsr()
+
+    offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+    data = np.load(os.path.join(directory, "output_data.npy"), mmap_mode="r+")
+    indices = np.load(os.path.join(directory, "output_indices.npy"), mmap_mode="r+")
+    counts = np.load(os.path.join(directory, "output_counts.npy"), mmap_mode="r+")
+
+    block_counts = np.diff(block.indptr)
+    entry_rows = np.repeat(np.arange(end - start), block_counts)
+    positions = offsets[start + entry_rows] + (
+        np.arange(block.nnz) - block.indptr[entry_rows]
+    )
+    data[positions] = block.data
+    indices[positions] = block.indices
+    counts[start:end] = block_counts
+    data.flush()
+    indices.flush()
+    counts.flush()
+    return end - start
+
+
+def _predict_pairs_tile(args: tuple) -> int:
+    """Predice en un worker las parejas [start, end) y las escribe en el buffer de salida"""
+    loader, model_directory, directory, start, end = args
+    model = _get_model(loader, model_directory)
+    reviewer_indexes = np.load(os.path.join(directory, "reviewers.npy"), mmap_mode="r")
+    item_indexes = np.load(os.path.join(directory, "items.npy"), mmap_mode="r")
+    output = np.load(os.path.join(directory, "output.npy"), mmap_mode="r+")
+    output[start:end] = model.predict_pairs(
+        reviewer_indexes[start:end], item_indexes[start:end]
+    )
+    output.flush()
+    return end - start
+
+
+def _model_directory(model, directory: str) -> str:
+    """Directorio del que los workers cargan el modelo (se guarda si no viene de uno)"""
+    if getattr(model, "directory", None) is not None:
+        return model.directory
+    model_directory = os.path.join(directory, "model")
+    model.save(model_directory)
+    # El directorio temporal se borra al terminar, así que el modelo no se queda con él
+    model.directory = None
+    return model_directory
+
+
+def parallel_predict(
+    model,
+    reviewer_ratings_matrix,
+    loader: Callable,
+    n_workers: int = None,
+    block_size: int = None,
+) -> csr_matrix:
+    """Igual que model.predict, pero repartiendo los bloques de reviewers entre procesos
+
+    El modelo se guarda con save (o se usa el directorio del que se cargó) y los workers
+    lo abren con loader, que mapea los arrays en memoria, así que no se copian a cada
+    proceso. Los ratings de entrada se guardan en ficheros .npy y cada worker escribe
+    sus filas en unos arrays de salida compartidos (memmap), con un hueco por fila del
+    tamaño máximo que puede tener según model._prediction_bound.
+
+    Args:
+        model: KNN, ItemKNN o ALS entrenado
+        reviewer_ratings_matrix: ratings de los reviewers que se completan
+        loader (Callable): función que carga el modelo de un directorio
+        n_workers (int, optional): número de procesos, por defecto tantos como núcleos. Defaults to None.
+        block_size (int, optional): filas por tarea (por defecto el block_size del modelo). Defaults to None.
+
+    Returns:
+        csr_matrix: la matriz completada
+    """
+    Y = csr_matrix(reviewer_ratings_matrix, dtype=np.float32)
+    Y.sort_indices()
+    n, m = Y.shape
+    block_size = block_size or model.block_size
+
+    bounds = np.minimum(model._prediction_bound(Y), m).astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(bounds)))
+    total = int(offsets[-1])
+
+    with tempfile.TemporaryDirectory(prefix="predict_") as directory:
+        model_directory = _model_directory(model, directory)
+        save_shared_matrix(directory, "input", Y)
+        np.save(os.path.join(directory, "offsets.npy"), offsets)
+        for name, dtype, size in (
+            ("output_data", np.float32, total),
+            ("output_indices", np.int32, total),
+            ("output_counts", np.int64, n),
+        ):
+            np.lib.format.open_memmap(
+                os.path.join(directory, f"{name}.npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=(size,),
+            ).flush()
+
+        tasks = [
+            (loader, model_directory, directory, start, min(start + block_size, n))
+            for start in range(0, n, block_size)
+        ]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for _ in executor.map(_predict_tile, tasks):
+                pass
+
+        # Se juntan los huecos de las filas quitando lo que no se ha usado
+        data = np.load(os.path.join(directory, "output_data.npy"), mmap_mode="r")
+        indices = np.load(os.path.join(directory, "output_indices.npy"), mmap_mode="r")
+        counts = np.load(os.path.join(directory, "output_counts.npy"))
+        positions = np.repeat(offsets[:-1], counts) + (
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        )
+        return csr_matrix(
+            (
+                np.array(data[positions]),
+                np.array(indices[positions]),
+                np.concatenate(([0], np.cumsum(counts))),
+            ),
+            shape=(n, m),
+        )
+
+
+def parallel_predict_pairs(
+    model,
+    reviewer_indexes,
+    item_indexes,
+    loader: Callable,
+    n_workers: int = None,
+    block_size: int = 100000,
+) -> np.ndarray:
+    """Igual que model.predict_pairs, pero repartiendo las parejas entre procesos
+
+    Cada worker escribe sus predicciones en su trozo de un array de salida compartido.
+
+    Args:
+        model: KNN, ItemKNN o ALS entrenado
+        reviewer_indexes: índices de los reviewers
+        item_indexes: índices de los artículos
+        loader (Callable): función que carga el modelo de un directorio
+        n_workers (int, optional): número de procesos, por defecto tantos como núcleos. Defaults to None.
+        block_size (int, optional): parejas por tarea. Defaults to 100000.
+
+    Returns:
+        np.ndarray: rating predicho de cada pareja
+    """
+    reviewer_indexes = np.asarray(reviewer_indexes, dtype=np.int64)
+    item_indexes = np.asarray(item_indexes, dtype=np.int64)
+    n = len(reviewer_indexes)
+
+    with tempfile.TemporaryDirectory(prefix="predict_pairs_") as directory:
+        model_directory = _model_directory(model, directory)
+        np.save(os.path.join(directory, "reviewers.npy"), reviewer_indexes)
+        np.save(os.path.join(directory, "items.npy"), item_indexes)
+        np.lib.format.open_memmap(
+            os.path.join(directory, "output.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(n,),
+        ).flush()
+
+        tasks = [
+            (loader, model_directory, directory, start, min(start + block_size, n))
+            for start in range(0, n, block_size)
+        ]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for _ in executor.map(_predict_pairs_tile, tasks):
+                pass
+        return np.load(os.path.join(directory, "output.npy"))
@@ -0,0 +1,83 @@
+import datetime
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+def max_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """Memoria residente máxima del proceso (o de sus hijos) en MB"""
+    max_rss = resource.getrusage(who).ru_maxrss
+    # En macOS ru_maxrss está en bytes y en Linux en KB
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+class StageTimer:
+    """Mide el tiempo, las filas y la memoria pico de cada etapa de un trabajo
+
+    Cada etapa se mide con "with timer.stage(nombre) as stage" y se pueden apuntar
+    las filas procesadas con stage["rows"] = n. La memoria residente máxima es la del
+    proceso hasta ese momento; con trace_memory también se mide el pico de memoria
+    reservada en la propia etapa (tracemalloc, más lento).
+    """
+
+    def __init__(self, job: str, trace_memory: bool = False) -> None:
+        """
+        Args:
+            job (str): nombre del trabajo
+            trace_memory (bool, optional): medir el pico de memoria de cada etapa. Defaults to False.
+        """
+        self.job = job
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.parameters = {}
+        self.started_at = datetime.datetime.now()
+        self.start = time.perf_counter()
+        if trace_memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        record = {"name": name, "rows": None}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if record["rows"] is not None and record["seconds"] > 0:
+                record["rows_per_second"] = record["rows"] / record["seconds"]
+            record["max_rss_mb"] = max_rss_mb()
+            if self.trace_memory:
+                record["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            self.stages.append(record)
+            # El progreso va a stderr para que stdout solo tenga el informe JSON
+            print(
+                f"[{self.job}] {name}: {record['seconds']:.2f} s, {record['rows']} filas",
+                file=sys.stderr,
+            )
+
+    def report(self) -> dict:
+        """Devuelve el informe del trabajo"""
+        return {
+            "job": self.job,
+            "started_at": self.started_at.isoformat(),
+            "parameters": self.parameters,
+            "total_seconds": time.perf_counter() - self.start,
+            "max_rss_mb": max_rss_mb(),
+            "max_rss_children_mb": max_rss_mb(resource.RUSAGE_CHILDREN),
+            "stages": self.stages,
+        }
+
+    def write(self, path: str = None) -> dict:
+        """Escribe el informe en JSON en el fichero o, si no se indica, por pantalla"""
+        report = self.report()
+        if path is None:
+            print(json.dumps(report, indent=2, default=str))
+        else:
+            with open(path, "w", encoding="utf-8") as fh:
+                json.dump(report, fh, indent=2, default=str)
+        return report
@@ -0,0 +1,230 @@
+import argparse
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import Flask, jsonify, request
+
+from recommender import KNN
+from utils import percentile, read_config
+
+
+def parse_count(value) -> int:
+    """Convierte el número de recomendaciones pedido (entero o texto) a entero positivo
+
+    Raises:
+        ValueError: si no es un entero mayor que 0
+    """
+    error = ValueError(f"n tiene que ser un entero positivo, no {value!r}")
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise error
+    try:
+        n = int(value)
+    except ValueError:
+        raise error from None
+    if n < 1:
+        raise error
+    return n
+
+
+class RecommendationService:
+    """Sirve los top-N artículos de cada reviewer a partir de un índice de KNN
+
+    Las recomendaciones se guardan en una caché LRU por (reviewer, n) y se mide la
+    latencia de cada petición. Es seguro usarlo desde varios hilos.
+    """
+
+    def __init__(
+        self, knn: KNN, cache_size: int = 10000, latency_window: int = 10000
+    ) -> None:
+        """
+        Args:
+            knn (KNN): modelo entrenado o cargado con KNN.load
+            cache_size (int, optional): recomendaciones que se guardan en la caché. Defaults to 10000.
+            latency_window (int, optional): últimas latencias que se usan en las métricas. Defaults to 10000.
+        """
+        self.knn = knn
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=latency_window)
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+
+        # Ids de los artículos por índice
+        self.item_ids = None
+        if knn.items is not None:
+            self.item_ids = [None] * len(knn.items)
+            for item, j in knn.items.items():
+                self.item_ids[j] = item
+
+    def _format(self, items, scores) -> list[dict]:
+        recommendations = []
+        for j, score in zip(items.tolist(), scores.tolist()):
+            if self.item_ids is None:
+                recommendations.append({"item": j, "score": score})
+            else:
+                asin, type_id = self.item_ids[j]
+                recommendations.append(
+                    {"asin": asin, "type_id": type_id, "score": score}
+                )
+        return recommendations
+
+    def _get_cached(self, key: tuple):
+        with self.lock:
+            value = self.cache.get(key)
+            if value is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def _set_cached(self, key: tuple, value: list) -> None:
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            # Si se pasa del tamaño se quita el que lleva más tiempo sin usarse
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _record(self, start: float) -> None:
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(time.perf_counter() - start)
+
+    def recommend_batch(self, reviewer_ids: list, n: int = 10) -> dict:
+        """Devuelve los n artículos recomendados de varios reviewers
+
+        Los que no están en la caché se calculan juntos con KNN.recommend.
+
+        Args:
+            reviewer_ids (list): ids de los reviewers
+            n (int, optional): número de artículos por reviewer. Defaults to 10.
+
+        Raises:
+            ValueError: si n no es un entero positivo
+            KeyError: si algún reviewer no está en el índice
+
+        Returns:
+            dict: recomendaciones (asin, type_id y rating predicho) de cada reviewer
+        """
+        start = time.perf_counter()
+        n = parse_count(n)
+        unknown = [
+            reviewer_id
+            for reviewer_id in reviewer_ids
+            if reviewer_id not in self.knn.reviewers
+        ]
+        if len(unknown) > 0:
+            raise KeyError(unknown[0])
+
+        results = {}
+        missing = []
+        for reviewer_id in reviewer_ids:
+            cached = self._get_cached((reviewer_id, n))
+            if cached is None:
+                missing.append(reviewer_id)
+            else:
+                results[reviewer_id] = cached
+
+        if len(missing) > 0:
+            rows = [self.knn.reviewers[reviewer_id] for reviewer_id in missing]
+            for reviewer_id, (items, scores) in zip(
+                missing, self.knn.recommend(rows, n)
+            ):
+                results[reviewer_id] = self._format(items, scores)
+                self._set_cached((reviewer_id, n), results[reviewer_id])
+
+        self._record(start)
+        return results
+
+    def recommend(self, reviewer_id: str, n: int = 10) -> list[dict]:
+        """Devuelve los n artículos recomendados de un reviewer"""
+        return self.recommend_batch([reviewer_id], n)[reviewer_id]
+
+    def metrics(self) -> dict:
+        """Devuelve el número de peticiones, el uso de la caché y la latencia en ms"""
+        with self.lock:
+            latencies = [latency * 1000 for latency in self.latencies]
+            lookups = self.hits + self.misses
+            return {
+                "requests": self.requests,
+                "cache_size": len(self.cache),
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+                "cache_hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                # Sin peticiones no hay latencias (None en vez de nan, que no es JSON válido)
+                "mean_ms": sum(latencies) / len(latencies) if latencies else None,
+                "p50_ms": percentile(latencies, 50) if latencies else None,
+                "p95_ms": percentile(latencies, 95) if latencies else None,
+                "p99_ms": percentile(latencies, 99) if latencies else None,
+            }
+
+
+def create_app(service: RecommendationService) -> Flask:
+    """Crea la aplicación de Flask con los endpoints del servicio
+
+    GET /recommendations/<reviewer_id>?n=10, POST /recommendations con
+    {"reviewers": [...], "n": 10} y GET /metrics.
+    """
+    app = Flask(__name__)
+
+    @app.get("/recommendations/<reviewer_id>")
+    def recommendations(reviewer_id: str):
+        try:
+            items = service.recommend(reviewer_id, request.args.get("n", 10))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except KeyError:
+            return jsonify({"error": f"El reviewer {reviewer_id} no existe"}), 404
+        return jsonify({"reviewer": reviewer_id, "recommendations": items})
+
+    @app.post("/recommendations")
+    def batch_recommendations():
+        body = request.get_json(silent=True) or {}
+        reviewer_ids = body.get("reviewers")
+        if not isinstance(reviewer_ids, list):
+            return jsonify({"error": "Falta la lista de reviewers"}), 400
+        try:
+            results = service.recommend_batch(reviewer_ids, body.get("n", 10))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except KeyError as e:
+            return jsonify({"error": f"El reviewer {e.args[0]} no existe"}), 404
+        return jsonify({"recommendations": results})
+
+    @app.get("/metrics")
+    def metrics():
+        return jsonify(service.metrics())
+
+    return app
+
+
+if __name__ == "__main__":
+    config = read_config()
+
+    parser = argparse.ArgumentParser(
+        description="Servicio HTTP de recomendaciones a partir del índice de KNN"
+    )
+    parser.add_argument("--index", default=config["RECOMMENDER"]["directorio_indice"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=int(config["RECOMMENDER"]["puerto_servicio"])
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=int(config["RECOMMENDER"]["tamano_cache_servicio"]),
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    knn = KNN.load(args.index)
+    print(
+        f"Índice de {len(knn.reviewers)} reviewers cargado en {time.perf_counter() - start:.3f} s"
+    )
+
+    service = RecommendationService(knn, args.cache_size)
+    create_app(service).run(host=args.host, port=args.port, threaded=True)
@@ -1,12 +1,17 @@
+import json
 import math
+import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from utils import read_config, get_collection, connect_to_sql
+from utils import IdMap, iter_chunks, read_config, get_collection, connect_to_sql
 from queries import obtener_tuplas_items
 from neo4j import GraphDatabase
-import random
-from scipy.spatial.distance import cdist
+from similarity import load_shared_matrix, read_similarity_file, save_shared_matrix
+from distances import DISTANCES, pair_distances
+from parallel_predict import parallel_predict, parallel_predict_pairs
+from scipy.sparse import coo_matrix, csr_matrix, vstack
+from pymongo.collection import Collection
 import seaborn as sns
 
 import warnings
@@ -15,42 +20,613 @@ warnings.filterwarnings("ignore")
 
 n_neighbors = 20
 
+# Versión del formato de los índices guardados con KNN.save
+INDEX_VERSION = 2
+
+# Las gráficas necesitan las matrices densas, así que solo se hacen con matrices pequeñas
+MAX_HEATMAP_CELLS = 10_000_000
+
+# Campos de las reviews que hacen falta para la matriz de ratings (sin reviewText)
+RATING_PROJECTION = {"_id": 0, "reviewerID": 1, "asin": 1, "type_id": 1, "overall": 1}
+
+# Documentos por lote del cursor de MongoDB y registros que se pasan a la vez a los arrays
+LOAD_BATCH_SIZE = 50000
+
+
+def to_csr(
+    rows: np.ndarray, cols: np.ndarray, data: np.ndarray, shape: tuple
+) -> csr_matrix:
+    """Construye una matriz CSR float32 quedándose con el último valor de cada posición
+
+    Es lo que hacía la asignación X[i, j] = valor sobre la matriz densa (coo_matrix
+    sumaría los repetidos).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    data = np.asarray(data, dtype=np.float32)
+
+    keys = rows * shape[1] + cols
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+
+    matrix = coo_matrix((data[last], (rows[last], cols[last])), shape=shape).tocsr()
+    matrix.indices = matrix.indices.astype(np.int32)
+    matrix.indptr = matrix.indptr.astype(np.int32)
+    return matrix
+
+
+def to_dense(matrix: csr_matrix) -> np.ndarray:
+    """Pasa una matriz dispersa de ratings a densa con nan donde no hay rating"""
+    dense = np.full(matrix.shape, np.nan, dtype=np.float32)
+    coo = matrix.tocoo()
+    dense[coo.row, coo.col] = coo.data
+    return dense
+
+
+def split_ratings(
+    X: csr_matrix, test_fraction: float = 0.1, seed: int = 33
+) -> tuple[csr_matrix, np.ndarray, np.ndarray, np.ndarray]:
+    """Separa al azar (sin repetición) una parte de los ratings para test
+
+    Args:
+        X (csr_matrix): matriz dispersa de ratings
+        test_fraction (float, optional): fracción de los ratings para test. Defaults to 0.1.
+        seed (int, optional): semilla, para reproducibilidad. Defaults to 33.
+
+    Returns:
+        tuple: matriz de train y filas, columnas y ratings de test
+    """
+    X_coo = X.tocoo()
+    rng = np.random.default_rng(seed)
+    test = rng.choice(X.nnz, int(test_fraction * X.nnz), replace=False)
+    keep = np.ones(X.nnz, dtype=bool)
+    keep[test] = False
+    X_train = to_csr(X_coo.row[keep], X_coo.col[keep], X_coo.data[keep], X.shape)
+    return X_train, X_coo.row[test], X_coo.col[test], X_coo.data[test]
+
 
 class KNN:
-    def __init__(self, k=10) -> None:
+    """Completa la matriz de ratings con la media de los ratings de los k vecinos más cercanos
+
+    Las matrices son dispersas (CSR float32): en la de ratings solo se guardan los
+    ratings que existen, así que la memoria depende del número de reviews y no del
+    número de reviewers por el de artículos. Los vecinos y las predicciones se
+    calculan por bloques de reviewers con operaciones de matrices dispersas.
+    """
+
+    def __init__(
+        self,
+        k=10,
+        weights="uniform",
+        block_size=1000,
+        metric="msd",
+        min_overlap=1,
+    ) -> None:
+        """
+        Args:
+            k (int, optional): número de vecinos. Defaults to 10.
+            weights (str, optional): "uniform" (media de los vecinos) o "similarity" (media
+                ponderada por la similitud). Defaults to "uniform".
+            block_size (int, optional): reviewers que se procesan a la vez. Defaults to 1000.
+            metric (str, optional): distancia para ordenar los vecinos: "msd" o "pearson" sobre
+                los artículos en común o "euclidean" (contando como 0 los ratings que no
+                existen). Defaults to "msd".
+            min_overlap (int, optional): artículos en común que tiene que tener un vecino. Defaults to 1.
+        """
+        if weights not in ("uniform", "similarity"):
+            raise ValueError(f"Pesos desconocidos: {weights}")
+        if metric not in DISTANCES:
+            raise ValueError(f"Distancia desconocida: {metric}")
         self.k = k
-
-    def fit(self, X, similarity_matrix, reviewers) -> None:
-        self.similarity_matrix = similarity_matrix
+        self.weights = weights
+        self.block_size = block_size
+        self.metric = metric
+        self.min_overlap = min_overlap
+        # Directorio del índice guardado o cargado (lo usan los workers de predict)
+        self.directory = None
+
+    def fit(self, X, similarity_matrix, reviewers, items=None) -> None:
+        self.similarity_matrix = csr_matrix(similarity_matrix, dtype=np.float32)
         self.reviewers = reviewers
         self.idx_to_ids = {v: k for k, v in reviewers.items()}
-        self.X = X
+        self.items = items
+        self.X = csr_matrix(X, dtype=np.float32)
+
+        # Matriz con un 1 en cada rating que existe, para contar los vecinos que han puntuado
+        self.rated = self.X.copy()
+        self.rated.data[:] = 1
+        self.X_csc = None
+        self.directory = None
+
+        # Índice de vecinos: los k vecinos de cada reviewer y su similitud
+        n = self.X.shape[0]
+        self.neighbor_index = np.full((n, self.k), -1, dtype=np.int32)
+        self.neighbor_weights = np.zeros((n, self.k), dtype=np.float32)
+        for start in range(0, n, self.block_size):
+            rows = np.arange(start, min(start + self.block_size, n))
+            neighbors = self._nearest_neighbors(rows)
+            valid = neighbors >= 0
+            weights = np.zeros(neighbors.shape, dtype=np.float32)
+            weights[valid] = np.asarray(
+                self.similarity_matrix[
+                    np.broadcast_to(rows[:, None], neighbors.shape)[valid],
+                    neighbors[valid],
+                ]
+            ).ravel()
+            self.neighbor_index[rows] = neighbors
+            self.neighbor_weights[rows] = weights
+
+    def save(self, directory: str) -> None:
+        """Guarda el índice de vecinos, la matriz de ratings y los mapas de ids
+
+        Los arrays se guardan en .npy para abrirlos con memmap en KNN.load. Los ratings se
+        guardan también por artículo (la traspuesta) para predict_pairs.
+
+        Args:
+            directory (str): directorio del índice
+        """
+        os.makedirs(directory, exist_ok=True)
+        save_shared_matrix(directory, "ratings", self.X)
+        save_shared_matrix(directory, "ratings_t", self.X.T.tocsr())
+        np.save(
+            os.path.join(directory, "rated_data.npy"),
+            np.ones(self.X.nnz, dtype=np.float32),
+        )
+        self.directory = directory
+        np.save(os.path.join(directory, "neighbors.npy"), self.neighbor_index)
+        np.save(os.path.join(directory, "neighbor_weights.npy"), self.neighbor_weights)
+        with open(os.path.join(directory, "index.json"), "w", encoding="utf-8") as fh:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "k": self.k,
+                    "weights": self.weights,
+                    "block_size": self.block_size,
+                    "metric": self.metric,
+                    "min_overlap": self.min_overlap,
+                    "reviewers": [self.idx_to_ids[i] for i in range(self.X.shape[0])],
+                    "items": None if self.items is None else list(self.items),
+                },
+                fh,
+            )
+
+    @classmethod
+    def load(cls, directory: str) -> "KNN":
+        """Carga un índice guardado con save sin copiar los arrays (memmap)
+
+        Las páginas de los ficheros se comparten entre los procesos que cargan el mismo
+        índice. El modelo cargado predice con el índice de vecinos, sin la matriz de
+        similitudes.
+
+        Args:
+            directory (str): directorio del índice
+
+        Raises:
+            ValueError: si la versión del índice no es compatible
+
+        Returns:
+            KNN: el modelo
+        """
+        with open(os.path.join(directory, "index.json"), "r", encoding="utf-8") as fh:
+            index = json.load(fh)
+        if index["version"] != INDEX_VERSION:
+            raise ValueError(
+                f"Versión de índice {index['version']} no compatible en {directory}"
+            )
+
+        knn = cls(
+            index["k"],
+            index["weights"],
+            index["block_size"],
+            index["metric"],
+            index["min_overlap"],
+        )
+        knn.similarity_matrix = None
+        knn.reviewers = {user_id: i for i, user_id in enumerate(index["reviewers"])}
+        knn.idx_to_ids = dict(enumerate(index["reviewers"]))
+        knn.items = (
+            None
+            if index["items"] is None
+            else {tuple(item): j for j, item in enumerate(index["items"])}
+        )
+        knn.X = load_shared_matrix(directory, "ratings")
+        knn.rated = csr_matrix(
+            (
+                np.load(os.path.join(directory, "rated_data.npy"), mmap_mode="r"),
+                knn.X.indices,
+                knn.X.indptr,
+            ),
+            shape=knn.X.shape,
+            copy=False,
+        )
+        # La traspuesta de la CSR por artículo es la CSC de los ratings, sin copiarla
+        knn.X_csc = load_shared_matrix(directory, "ratings_t").T
+        knn.directory = directory
+        knn.neighbor_index = np.load(
+            os.path.join(directory, "neighbors.npy"), mmap_mode="r"
+        )
+        knn.neighbor_weights = np.load(
+            os.path.join(directory, "neighbor_weights.npy"), mmap_mode="r"
+        )
+        return knn
+
+    def neighbors(self, rows) -> np.ndarray:
+        """Devuelve los vecinos de varios reviewers del índice calculado en fit
+
+        Args:
+            rows: índices de los reviewers
+
+        Returns:
+            np.ndarray: matriz (len(rows), k) con los índices de los vecinos ordenados por
+                distancia, con -1 si hay menos de k candidatos
+        """
+        return self.neighbor_index[np.asarray(rows, dtype=np.int64)]
+
+    def _nearest_neighbors(self, rows) -> np.ndarray:
+        """Calcula los k vecinos más cercanos de varios reviewers a la vez
+
+        Los candidatos son los reviewers con similitud mayor que 0 y al menos min_overlap
+        artículos en común y se ordenan por la distancia entre sus ratings.
+
+        Args:
+            rows: índices de los reviewers
+
+        Returns:
+            np.ndarray: matriz (len(rows), k) con los índices de los vecinos ordenados por
+                distancia, con -1 si hay menos de k candidatos
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        result = np.full((len(rows), self.k), -1, dtype=np.int64)
 
-    def get_k_nearest_neighbors(self, idx) -> None:
         # Se cogen los indices de los que tienen similitud mayor que 0
-        similarity_indexes = np.where(self.similarity_matrix[idx] > 0)[0]
+        candidates = self.similarity_matrix[rows]
+        candidates.data[candidates.data <= 0] = 0
+        candidates.eliminate_zeros()
+        if candidates.nnz == 0 or self.k == 0:
+            return result
+        candidate_rows = np.repeat(np.arange(len(rows)), np.diff(candidates.indptr))
+        candidate_cols = candidates.indices.astype(np.int64)
 
         # Se miden la distancias a los puntos con similitud (si se da un rating similar, serán más cercanos)
-        distances = cdist([self.X[idx]], self.X[similarity_indexes])
-
-        # Se cogen los k vecinos más cercanos
-        nearest_indexes = np.argsort(distances[0])[: self.k]
-
+        distances = pair_distances(
+            self.metric,
+            self.X,
+            rows[candidate_rows],
+            candidate_cols,
+            self.min_overlap,
+        )
+
+        # Se descartan los candidatos sin suficientes artículos en común
+        valid = np.isfinite(distances)
+        if not valid.any():
+            return result
+        candidate_rows = candidate_rows[valid]
+        candidate_cols = candidate_cols[valid]
+        distances = distances[valid]
+
+        # Se ordenan los candidatos por reviewer y distancia (en los empates se quedan los
+        # primeros) y se cogen los k primeros de cada reviewer, sin matrices densas de
+        # len(rows) x candidatos
+        order = np.lexsort((distances, candidate_rows))
+        candidate_rows = candidate_rows[order]
+        candidate_cols = candidate_cols[order]
+        starts = np.searchsorted(candidate_rows, np.arange(len(rows)))
+        positions = np.arange(len(candidate_rows)) - starts[candidate_rows]
+        nearest = positions < self.k
+        result[candidate_rows[nearest], positions[nearest]] = candidate_cols[nearest]
+        return result
+
+    def get_k_nearest_neighbors(self, idx) -> np.ndarray:
         # Se devuelve por orden los índices de los reviewers
-        return similarity_indexes[nearest_indexes]
+        neighbors = self.neighbors([idx])[0]
+        return neighbors[neighbors >= 0]
+
+    def _neighbor_weights(self, rows: np.ndarray) -> csr_matrix:
+        """Matriz (len(rows), n_reviewers) con el peso de cada vecino de cada fila"""
+        neighbors = self.neighbors(rows)
+        valid = neighbors >= 0
+        weight_rows = np.nonzero(valid)[0]
+        weight_cols = neighbors[valid]
+        if self.weights == "similarity":
+            weights = self.neighbor_weights[np.asarray(rows, dtype=np.int64)][valid]
+        else:
+            weights = np.ones(len(weight_rows), dtype=np.float32)
+        return csr_matrix(
+            (weights, (weight_rows, weight_cols)),
+            shape=(len(rows), self.X.shape[0]),
+            dtype=np.float32,
+        )
+
+    def _prediction_bound(self, Y: csr_matrix) -> np.ndarray:
+        """Máximo de valores de cada fila de predict: los ratings de la fila más los de sus vecinos"""
+        neighbors = self.neighbors(np.arange(Y.shape[0]))
+        counts = np.diff(self.X.indptr)
+        neighbor_counts = np.where(neighbors >= 0, counts[neighbors], 0).sum(axis=1)
+        return np.diff(Y.indptr) + neighbor_counts
+
+    def _predict_block(self, Y_block: csr_matrix, rows: np.ndarray) -> csr_matrix:
+        """Completa las filas de un bloque de reviewers (rows son sus índices en el modelo)"""
+        weights = self._neighbor_weights(rows)
+
+        # Se calcula la media de los ratings de los vecinos, solo de los que han puntuado el artículo
+        sums = weights @ self.X
+        totals = weights @ self.rated
+        predictions = sums.multiply(totals.power(-1)).tocsr()
+
+        # Solo se completan los artículos que el reviewer no ha puntuado
+        known = Y_block.copy()
+        known.data[:] = 1
+        predictions = predictions - predictions.multiply(known)
+        predictions.eliminate_zeros()
+
+        return Y_block + predictions
+
+    def predict(self, reviewer_ratings_matrix, n_workers: int = 1):
+        """Completa los ratings de los reviewers con la media de los de sus vecinos
+
+        Args:
+            reviewer_ratings_matrix: ratings de los reviewers, en el orden del modelo
+            n_workers (int, optional): procesos entre los que se reparten los bloques de
+                reviewers (ver parallel_predict). Defaults to 1.
+
+        Returns:
+            csr_matrix: la matriz completada
+        """
+        Y = csr_matrix(reviewer_ratings_matrix, dtype=np.float32)
+        if n_workers > 1:
+            return parallel_predict(self, Y, KNN.load, n_workers)
+
+        n = Y.shape[0]
+        blocks = []
+        for start in range(0, n, self.block_size):
+            end = min(start + self.block_size, n)
+            blocks.append(self._predict_block(Y[start:end], np.arange(start, end)))
+        return vstack(blocks, format="csr")
+
+    def recommend(
+        self, rows, n: int = 10, exclude_rated: bool = True
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Devuelve los n artículos con mayor rating predicho de varios reviewers a la vez
+
+        Args:
+            rows: índices de los reviewers
+            n (int, optional): número de artículos por reviewer. Defaults to 10.
+            exclude_rated (bool, optional): quitar los artículos que ya ha puntuado. Defaults to True.
+
+        Returns:
+            list[tuple[np.ndarray, np.ndarray]]: por cada reviewer, los índices de los
+                artículos y su rating predicho, de mayor a menor
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        weights = self._neighbor_weights(rows)
+        sums = weights @ self.X
+        totals = weights @ self.rated
+        scores = sums.multiply(totals.power(-1)).tocsr()
+
+        recommendations = []
+        for i, row in enumerate(rows):
+            items = scores.indices[scores.indptr[i] : scores.indptr[i + 1]]
+            values = scores.data[scores.indptr[i] : scores.indptr[i + 1]]
+            if exclude_rated:
+                own = self.X.indices[self.X.indptr[row] : self.X.indptr[row + 1]]
+                keep = ~np.isin(items, own)
+                items, values = items[keep], values[keep]
+
+            # Se preseleccionan con partition los que llegan al n-ésimo rating (con empates)
+            # y se ordenan por rating y, en los empates, por índice del artículo
+            if len(values) > n > 0:
+                kth = np.partition(-values, n - 1)[n - 1]
+                candidates = -values <= kth
+                items, values = items[candidates], values[candidates]
+            order = np.lexsort((items, -values))[:n]
+            recommendations.append((items[order], values[order]))
+        return recommendations
+
+    def predict_pairs(
+        self, reviewer_indexes, item_indexes, n_workers: int = 1
+    ) -> np.ndarray:
+        """Predice solo los ratings de las parejas (reviewer, artículo) pedidas
+
+        Args:
+            reviewer_indexes: índices de los reviewers
+            item_indexes: índices de los artículos
+            n_workers (int, optional): procesos entre los que se reparten las parejas. Defaults to 1.
+
+        Returns:
+            np.ndarray: rating predicho de cada pareja, nan si ningún vecino ha puntuado el artículo
+        """
+        if n_workers > 1:
+            return parallel_predict_pairs(
+                self, reviewer_indexes, item_indexes, KNN.load, n_workers
+            )
+        reviewer_indexes = np.asarray(reviewer_indexes, dtype=np.int64)
+        item_indexes = np.asarray(item_indexes, dtype=np.int64)
+        if self.X_csc is None:
+            self.X_csc = self.X.tocsc()
+
+        predictions = np.full(len(reviewer_indexes), np.nan, dtype=np.float32)
+        for start in range(0, len(reviewer_indexes), self.block_size):
+            block = slice(start, start + self.block_size)
+            weights = self._neighbor_weights(reviewer_indexes[block])
+
+            # Ratings de todos los reviewers para el artículo de cada pareja
+            ratings = self.X_csc[:, item_indexes[block]].T
+            rated = ratings.copy()
+            rated.data[:] = 1
+            sums = np.asarray(weights.multiply(ratings).sum(axis=1)).ravel()
+            totals = np.asarray(weights.multiply(rated).sum(axis=1)).ravel()
+
+            predicted = predictions[block]
+            has_ratings = totals > 0
+            predicted[has_ratings] = sums[has_ratings] / totals[has_ratings]
+        return predictions
+
+
+class CooArrays:
+    """Arrays (fila, columna, valor) preasignados para construir una matriz dispersa
+
+    Se llenan por trozos y, si se quedan pequeños, se amplían al doble. Ocupan 12 bytes
+    por valor en lugar de los objetos de Python de tres listas.
+    """
+
+    def __init__(self, capacity: int = 0) -> None:
+        self.rows = np.empty(capacity, dtype=np.int32)
+        self.cols = np.empty(capacity, dtype=np.int32)
+        self.data = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+
+    def extend(self, rows, cols, data) -> None:
+        n = len(rows)
+        if self.size + n > len(self.rows):
+            capacity = max(2 * len(self.rows), self.size + n)
+            for name in ("rows", "cols", "data"):
+                old = getattr(self, name)
+                new = np.empty(capacity, dtype=old.dtype)
+                new[: self.size] = old[: self.size]
+                setattr(self, name, new)
+        self.rows[self.size : self.size + n] = rows
+        self.cols[self.size : self.size + n] = cols
+        self.data[self.size : self.size + n] = data
+        self.size += n
+
+    def tocsr(self, shape: tuple) -> csr_matrix:
+        return to_csr(
+            self.rows[: self.size],
+            self.cols[: self.size],
+            self.data[: self.size],
+            shape,
+        )
+
+
+def read_ratings(
+    docs,
+    reviewers,
+    items: dict,
+    arrays: CooArrays = None,
+    chunk_size: int = LOAD_BATCH_SIZE,
+) -> CooArrays:
+    """Pasa las reviews de un cursor a arrays COO por trozos de chunk_size documentos
+
+    Args:
+        docs: cursor de MongoDB con los campos de RATING_PROJECTION
+        reviewers: IdMap (se añaden los reviewers nuevos) o diccionario de reviewer a fila
+        items (dict): diccionario de (asin, type_id) a columna
+        arrays (CooArrays, optional): arrays en los que se añaden los ratings (None para
+            crear unos nuevos). Defaults to None.
+        chunk_size (int, optional): documentos que se pasan a la vez. Defaults to LOAD_BATCH_SIZE.
+
+    Returns:
+        CooArrays: los arrays con los ratings
+    """
+    if arrays is None:
+        arrays = CooArrays()
+    reviewer_index = (
+        reviewers.add if isinstance(reviewers, IdMap) else reviewers.__getitem__
+    )
+    for chunk in iter_chunks(docs, chunk_size):
+        arrays.extend(
+            [reviewer_index(doc["reviewerID"]) for doc in chunk],
+            [items[(doc["asin"], doc["type_id"])] for doc in chunk],
+            [doc["overall"] for doc in chunk],
+        )
+    return arrays
+
+
+def load_ratings_matrix(
+    collection: Collection,
+    reviewers: dict,
+    items: dict,
+    batch_size: int = LOAD_BATCH_SIZE,
+) -> csr_matrix:
+    """Construye la matriz dispersa de ratings reviewer x artículo desde MongoDB
+
+    Solo se traen los campos de RATING_PROJECTION y los arrays se reservan con el número
+    de reviews de los reviewers.
+
+    Args:
+        collection (Collection): colección de MongoDB
+        reviewers (dict): diccionario de reviewer a fila
+        items (dict): diccionario de (asin, type_id) a columna
+        batch_size (int, optional): documentos por lote del cursor. Defaults to LOAD_BATCH_SIZE.
+
+    Returns:
+        csr_matrix: ratings (float32) de los reviewers
+    """
+    query = {"reviewerID": {"$in": list(reviewers)}}
+    arrays = CooArrays(collection.count_documents(query))
+    docs = collection.find(query, RATING_PROJECTION, batch_size=batch_size)
+    read_ratings(docs, reviewers, items, arrays, batch_size)
+    return arrays.tocsr((len(reviewers), len(items)))
+
+
+def load_similarity_matrix(similarity_file: str) -> tuple[dict, csr_matrix]:
+    """Carga las similitudes del fichero binario de store_similarity sin pasar por Neo4j
+
+    Los registros se leen mapeados en memoria y se pasan directamente a la matriz dispersa.
+
+    Args:
+        similarity_file (str): fichero de similitudes
+
+    Returns:
+        tuple[dict, csr_matrix]: diccionario de reviewer a índice y matriz de similitudes simétrica
+    """
+    store = read_similarity_file(similarity_file)
+    reviewers = {user_id: i for i, user_id in enumerate(store.sources)}
+
+    src = store.edges["src"]
+    dst = store.edges["dst"]
+    similarities = store.edges["similarity"]
+    similarity_matrix = coo_matrix(
+        (
+            np.concatenate((similarities, similarities)),
+            (np.concatenate((src, dst)), np.concatenate((dst, src))),
+        ),
+        shape=(len(reviewers), len(reviewers)),
+        dtype=np.float32,
+    ).tocsr()
+    return reviewers, similarity_matrix
+
+
+def load_neo4j_similarity_matrix(
+    driver, fetch_size: int = LOAD_BATCH_SIZE
+) -> tuple[dict, csr_matrix]:
+    """Carga los reviewers y las similitudes de Neo4J (subidas en el apartado 4.1)
+
+    Los registros se leen a medida que llegan (fetch_size por petición) y se pasan a
+    arrays preasignados con el número de relaciones, sin crear la lista de resultados.
+
+    Args:
+        driver: driver de la conexión a Neo4J
+        fetch_size (int, optional): registros por petición y por trozo. Defaults to LOAD_BATCH_SIZE.
+
+    Returns:
+        tuple[dict, csr_matrix]: diccionario de reviewer a índice y matriz de similitudes
+    """
+    # Se obtienen las similitude de Neo4J (subidas en el apartado 4.1)
+    get_similarities_query = """MATCH (u1:User) - [similarity:SIMILAR_TO] - (u2:User)
+                            RETURN u1.user_id as user1, u2.user_id as user2, similarity.similarity as similarity"""
 
-    def predict(self, reviewer_ratings_matrix):
-        n = len(reviewer_ratings_matrix)
-        Y = np.copy(reviewer_ratings_matrix)
-        for reviewer_idx in range(0, n):
+    with driver.session(fetch_size=fetch_size) as session:
+        # Se crea un mapa de reviewer a un indice que servirá como entrada en la matriz de similitudes
+        result = session.run("MATCH (n:User) RETURN n.user_id AS user_id")
+        reviewers = IdMap(record["user_id"] for record in result)
+        n_reviewers = len(reviewers)
+
+        # La consulta sin dirección devuelve las dos direcciones de cada relación
+        n_similarities = session.run(
+            "MATCH ()-[s:SIMILAR_TO]->() RETURN count(s) AS n"
+        ).single()["n"]
+        arrays = CooArrays(2 * n_similarities)
+        result = session.run(get_similarities_query)
+        for chunk in iter_chunks(result, fetch_size):
+            arrays.extend(
+                [reviewers[record["user1"]] for record in chunk],
+                [reviewers[record["user2"]] for record in chunk],
+                [record["similarity"] for record in chunk],
+            )
 
-            k_nearest_neighbors_indexes = self.get_k_nearest_neighbors(reviewer_idx)
-            # Se calcula la media de los ratings de los vecinos
-            prediction = np.nanmean(self.X[k_nearest_neighbors_indexes], axis=0)
-            Y[reviewer_idx, np.isnan(Y[reviewer_idx])] = prediction[
-                np.isnan(Y[reviewer_idx])
-            ]
-        return np.array(Y)
+    similarity_matrix = arrays.tocsr((n_reviewers, n_reviewers))
+    return reviewers.index, similarity_matrix
 
 
 if __name__ == "__main__":
@@ -61,104 +637,67 @@ if __name__ == "__main__":
     PASSWORD = config["NEO4J"]["password"]
     connection = config["NEO4J"]["connection"]
 
-    driver = GraphDatabase.driver(connection, auth=(USUARIO, PASSWORD))
-
     # Se obtienen todos los productos que existen de mySQL
     items = {item: i for i, item in enumerate(obtener_tuplas_items())}
     n_items = len(items)
 
-    # Se obtienen todos los reviewers de Neo4J
-    with driver.session() as session:
-        reviewers = session.run("MATCH (n:User) RETURN n").data()
-    # Se crea un diccionario de reviewer a un indice que servirá como entrada
-    # en la matriz de similitudes
-    reviewers = {n["n"]["user_id"]: i for i, n in enumerate(reviewers)}
+    # Se leen las similitudes del fichero binario o, si se indica, de Neo4J
+    if config["RECOMMENDER"]["fuente_similitudes"] == "neo4j":
+        driver = GraphDatabase.driver(connection, auth=(USUARIO, PASSWORD))
+        reviewers, similarity_matrix = load_neo4j_similarity_matrix(driver)
+        driver.close()
+    else:
+        reviewers, similarity_matrix = load_similarity_matrix(
+            config["NEO4J"]["fichero_similitud"]
+        )
     n_reviewers = len(reviewers)
 
     print(f"Número de reviewers obtenidos: {n_reviewers}")
     print(f"Número de productos: {n_items}")
 
-    # Se obtienen las similitude de Neo4J (subidas en el apartado 4.1)
-    get_similarities_query = """MATCH (u1:User) - [similarity:SIMILAR_TO] - (u2:User)
-                            RETURN u1.user_id as user1, u2.user_id as user2, similarity.similarity as similarity"""
-
-    with driver.session() as session:
-        result = session.run(get_similarities_query)
-        user_similarities = result.data()
-
-    # Se crea la matriz de similitud enteramente de ceros
-    similarity_matrix = np.zeros((n_reviewers, n_reviewers))
-    for similarity_dict in user_similarities:
-        # Se añade la similitud a la entrada de la matriz correspondiente
-        u1 = similarity_dict["user1"]
-        u2 = similarity_dict["user2"]
-        s = similarity_dict["similarity"]
-        i = reviewers[u1]
-        j = reviewers[u2]
-        similarity_matrix[i, j] = s
-        similarity_matrix[j, i] = s
-
-    # Se crea la matriz de los ratings llena de nans
-    X = np.empty((n_reviewers, n_items))
-    X[:] = np.nan
-
-    # Se obtienen todas las reviews de mongoDB
+    # Se obtienen las reviews de mongoDB de los reviewers en una matriz dispersa
     collection = get_collection(config)
-    for doc in collection.find({}):
-        reviewer = doc["reviewerID"]
-        rating = doc["overall"]
-
-        asin = doc["asin"]
-        type = doc["type_id"]
-        item = (asin, type)
-
-        # Se añade el rating a la matriz
-        i = reviewers.get(reviewer)
-        j = items[item]
-        if i is not None:
-            X[i, j] = rating
-
-    # Se cambian a None unos índices para tener un train y test set
-    not_nan_idxs = np.where(~np.isnan(X))
-    num_mask = int(0.1 * len(not_nan_idxs[0]))
-    print(f"Se van a tapar {num_mask} ratings")
+    X = load_ratings_matrix(collection, reviewers, items)
 
-    # Para reproducibilidad
-    random.seed(33)
-
-    # Se escogen aleatoriamente valores que poner a nan
-    choices = random.choices(list(zip(*not_nan_idxs)), k=num_mask)
-    mask_ids = tuple(zip(*choices))
-
-    # Se crea el set de train tapando ciertos ratings
-    X_train = X.copy()
-    X_train[mask_ids] = np.nan
+    # Se tapan unos ratings (sin repetición) para tener un train y test set
+    X_train, test_rows, test_cols, test_ratings = split_ratings(X, 0.1, seed=33)
+    mask_ids = (test_rows, test_cols)
+    print(f"Se van a tapar {len(test_ratings)} ratings")
 
     # Se inicializa y entrena el modelo
-    knn = KNN(n_neighbors)
-    knn.fit(X_train, similarity_matrix, reviewers)
-
-    # Se completa la matriz
-    X_new = knn.predict(X_train)
-
-    # Se muestran las gráficas de las diferencias de las matrices
-    plt.figure()
-    sns.heatmap(X, cmap="coolwarm")
-    plt.title("X")
-    plt.figure()
-    sns.heatmap(X_train, cmap="coolwarm")
-    plt.title("X_train")
-
-    plt.figure()
-    sns.heatmap(X_new, cmap="coolwarm")
-    plt.title("X_new")
+    knn = KNN(
+        n_neighbors,
+        metric=config["RECOMMENDER"]["distancia"],
+        min_overlap=int(config["RECOMMENDER"]["min_articulos_comunes"]),
+    )
+    knn.fit(X_train, similarity_matrix, reviewers, items)
 
-    numero_de_productos_no_imputados = len(np.where(np.isnan(X_new[mask_ids]))[0])
+    # Se guarda el índice de vecinos para cargarlo sin recalcular (KNN.load)
+    knn.save(config["RECOMMENDER"]["directorio_indice"])
 
+    # Se completa la matriz
+    X_new = knn.predict(X_train, int(config["RECOMMENDER"]["procesos_prediccion"]))
+
+    # Se muestran las gráficas de las diferencias de las matrices (solo si caben en memoria)
+    if n_reviewers * n_items <= MAX_HEATMAP_CELLS:
+        plt.figure()
+        sns.heatmap(to_dense(X), cmap="coolwarm")
+        plt.title("X")
+        plt.figure()
+        sns.heatmap(to_dense(X_train), cmap="coolwarm")
+        plt.title("X_train")
+
+        plt.figure()
+        sns.heatmap(to_dense(X_new), cmap="coolwarm")
+        plt.title("X_new")
+
+    # En la matriz dispersa los ratings no imputados son 0 (los ratings van de 1 a 5)
+    predicted = np.asarray(X_new[mask_ids]).ravel()
+    imputed = predicted != 0
+    numero_de_productos_imputados = int(imputed.sum())
+
+    print(f"Porcentaje de no imputados: {1 - imputed.mean():.02%}")
     print(
-        f"Porcentaje de no imputados: {numero_de_productos_no_imputados / len(mask_ids[0]):.02%}"
-    )
-    print(
-        f"MAE: {(np.nansum(np.abs(X[mask_ids] - X_new[mask_ids])))/ numero_de_productos_no_imputados:.03f}"
+        f"MAE: {np.abs(test_ratings[imputed] - predicted[imputed]).sum() / max(numero_de_productos_imputados, 1):.03f}"
     )
     plt.show()
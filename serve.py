@@ -0,0 +1,67 @@
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from utils import read_config
+
+
+class DashboardApplication(BaseApplication):
+    """Sirve el dashboard con gunicorn usando varios workers
+
+    Los workers comparten la caché en disco de dashboard.py, así que las agregaciones
+    y las figuras precalculadas solo se calculan una vez.
+    Gunicorn solo funciona en sistemas tipo Unix.
+    """
+
+    def __init__(self, options: dict) -> None:
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Se importa dentro de cada worker para que cada uno abra sus propias conexiones
+        from dashboard import app
+
+        return app.server
+
+
+def worker_exit(server, worker) -> None:
+    """Cierra la conexión a MongoDB del worker cuando termina"""
+    import queries
+
+    queries.collection.database.client.close()
+
+
+def get_server_options(config) -> dict:
+    """Obtiene las opciones de gunicorn de configuracion.ini
+
+    Args:
+        config (ConfigParser): configparser de configuracion.ini
+
+    Returns:
+        dict: opciones de gunicorn
+    """
+    server_config = config["SERVER"]
+    return {
+        "bind": server_config["bind"],
+        "workers": int(server_config["workers"]),
+        "threads": int(server_config["threads"]),
+        "worker_class": "gthread",
+        "timeout": int(server_config["timeout"]),
+        # Al recibir SIGTERM se dejan de aceptar peticiones y se esperan las que están en curso
+        "graceful_timeout": int(server_config["graceful_timeout"]),
+        "preload_app": False,
+        "worker_exit": worker_exit,
+    }
+
+
+if __name__ == "__main__":
+    config = read_config()
+
+    # El botón de salir del dashboard no apaga los workers en producción
+    os.environ["DASHBOARD_PRODUCTION"] = "1"
+
+    DashboardApplication(get_server_options(config)).run()
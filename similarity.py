@@ -0,0 +1,678 @@
+import glob
+import heapq
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from edge_store import (
+    SIMILARITY_DTYPE,
+    EdgeStore,
+    EdgeWriter,
+    load_edges,
+    replace_edges,
+)
+from utils import IdMap
+
+
+def build_user_item_matrix(
+    user_ids: list, user_articles: Iterable[tuple[str, np.ndarray]]
+) -> csr_matrix:
+    """Construye la matriz dispersa usuario x artículo (1 si el usuario ha hecho review)
+
+    Args:
+        user_ids (list): ids de los usuarios, en el orden de las filas
+        user_articles (Iterable[tuple[str, np.ndarray]]): id de cada usuario y array de
+            los índices (internados) de sus artículos, sin repetidos
+
+    Returns:
+        csr_matrix: la matriz CSR binaria
+    """
+    users = {user_id: i for i, user_id in enumerate(user_ids)}
+
+    rows = []
+    cols = []
+    for user_id, articles in user_articles:
+        i = users.get(user_id)
+        if i is not None:
+            rows.append(np.full(len(articles), i, dtype=np.int32))
+            cols.append(articles)
+
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int32)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int32)
+    n_items = int(cols.max()) + 1 if len(cols) > 0 else 0
+
+    return csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(users), n_items),
+    )
+
+
+def jaccard_pairs(
+    matrix: csr_matrix, threshold: float = 0.0, block_size: int = 2000
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Calcula la similitud de Jaccard de todas las parejas de filas de la matriz
+
+    Las intersecciones salen del producto disperso de un bloque de filas por la
+    traspuesta de las filas siguientes, y las uniones de las cuentas de cada fila:
+    |A u B| = |A| + |B| - |A n B|. Solo se devuelven las parejas i < j.
+
+    Args:
+        matrix (csr_matrix): matriz binaria usuario x artículo
+        threshold (float, optional): solo se devuelven similitudes mayores que este valor. Defaults to 0.0.
+        block_size (int, optional): filas que se procesan a la vez (limita la memoria). Defaults to 2000.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: índices de fila i, j y su similitud
+    """
+    matrix = csr_matrix(matrix, dtype=np.int32)
+    counts = np.diff(matrix.indptr)
+    n = matrix.shape[0]
+
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+
+        # Solo hace falta el triángulo superior: el bloque contra él mismo y las filas siguientes
+        intersections = (matrix[start:end] @ matrix[start:].T).tocoo()
+        rows = intersections.row.astype(np.int64) + start
+        cols = intersections.col.astype(np.int64) + start
+        keep = cols > rows
+        rows, cols, inter = rows[keep], cols[keep], intersections.data[keep]
+
+        similarity = inter / (counts[rows] + counts[cols] - inter)
+        keep = similarity > threshold
+
+        # Se ordena para que la salida siga el orden de los usuarios
+        order = np.lexsort((cols[keep], rows[keep]))
+        yield rows[keep][order], cols[keep][order], similarity[keep][order]
+
+
+def load_shared_matrix(directory: str, name: str) -> csr_matrix:
+    """Abre una matriz CSR guardada con save_shared_matrix sin copiarla (memmap)"""
+    arrays = [
+        np.load(os.path.join(directory, f"{name}_{part}.npy"), mmap_mode="r")
+        for part in ("data", "indices", "indptr", "shape")
+    ]
+    data, indices, indptr, shape = arrays
+    matrix = csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+    return matrix
+
+
+def save_shared_matrix(directory: str, name: str, matrix: csr_matrix) -> None:
+    """Guarda los arrays de una matriz CSR para que los workers los abran con memmap"""
+    for part, array in (
+        ("data", matrix.data),
+        ("indices", matrix.indices),
+        ("indptr", matrix.indptr),
+        ("shape", np.array(matrix.shape, dtype=np.int64)),
+    ):
+        np.save(os.path.join(directory, f"{name}_{part}.npy"), array)
+
+
+def _jaccard_tile(args: tuple) -> tuple[str, int]:
+    """Calcula en un worker las similitudes de las filas [start, end) contra las siguientes
+
+    Escribe el resultado parcial, ordenado por (i, j), en un fichero .npz.
+    """
+    directory, start, end, threshold = args
+    matrix = load_shared_matrix(directory, "users")
+    transposed = load_shared_matrix(directory, "items")
+    counts = np.diff(matrix.indptr)
+
+    # Como en jaccard_pairs, el bloque solo se multiplica por los usuarios desde start:
+    # las columnas start: de la traspuesta (artículo x usuario) se sacan en una pasada
+    # sobre el memmap, sin la conversión a CSR que necesitaría matrix[start:].T
+    intersections = (matrix[start:end] @ transposed[:, start:]).tocoo()
+    rows = intersections.row.astype(np.int64) + start
+    cols = intersections.col.astype(np.int64) + start
+    keep = cols > rows
+    rows, cols, inter = rows[keep], cols[keep], intersections.data[keep]
+
+    similarity = inter / (counts[rows] + counts[cols] - inter)
+    keep = similarity > threshold
+    order = np.lexsort((cols[keep], rows[keep]))
+
+    path = os.path.join(directory, f"part_{start:012d}.npz")
+    np.savez(
+        path,
+        rows=rows[keep][order],
+        cols=cols[keep][order],
+        similarity=similarity[keep][order],
+    )
+    return path, int(keep.sum())
+
+
+def parallel_jaccard_pairs(
+    matrix: csr_matrix,
+    threshold: float = 0.0,
+    block_size: int = 500,
+    n_workers: int = None,
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Igual que jaccard_pairs, pero repartiendo los bloques de filas entre varios procesos
+
+    La matriz y su traspuesta se guardan una vez en ficheros .npy que los workers abren
+    con memmap, así que comparten las páginas en vez de recibir una copia cada uno.
+    Cada worker escribe su resultado parcial ordenado y aquí se leen en orden de bloque,
+    por lo que la salida queda ordenada igual que en jaccard_pairs.
+
+    Args:
+        matrix (csr_matrix): matriz binaria usuario x artículo
+        threshold (float, optional): solo se devuelven similitudes mayores que este valor. Defaults to 0.0.
+        block_size (int, optional): filas por tarea. Defaults to 500.
+        n_workers (int, optional): número de procesos, por defecto tantos como núcleos. Defaults to None.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: índices de fila i, j y su similitud
+    """
+    matrix = csr_matrix(matrix, dtype=np.int32)
+    matrix.sort_indices()
+    n = matrix.shape[0]
+
+    with tempfile.TemporaryDirectory(prefix="similarity_") as directory:
+        save_shared_matrix(directory, "users", matrix)
+        save_shared_matrix(directory, "items", matrix.T.tocsr())
+
+        tasks = [
+            (directory, start, min(start + block_size, n), threshold)
+            for start in range(0, n, block_size)
+        ]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for path, _ in executor.map(_jaccard_tile, tasks):
+                with np.load(path) as part:
+                    yield part["rows"], part["cols"], part["similarity"]
+                os.remove(path)
+
+
+def write_similarity_file(
+    similarity_file: str,
+    user_ids: list,
+    pairs: Iterable[tuple[np.ndarray, np.ndarray, np.ndarray]],
+) -> int:
+    """Guarda las similitudes en formato binario (ver edge_store): los ids de los usuarios
+    en un JSON y las parejas como registros de ancho fijo (int32, int32, float32)
+
+    Args:
+        similarity_file (str): fichero de salida
+        user_ids (list): ids de los usuarios según su índice
+        pairs (Iterable): bloques de (i, j, similitud) como los de jaccard_pairs
+
+    Returns:
+        int: número de parejas escritas
+    """
+    # Los cambios de actualizaciones anteriores no valen para el fichero nuevo
+    remove_similarity_deltas(similarity_file)
+    with EdgeWriter(
+        similarity_file, SIMILARITY_DTYPE, IdMap(user_ids), shared_ids=True
+    ) as writer:
+        for rows, cols, similarities in pairs:
+            records = np.empty(len(rows), dtype=SIMILARITY_DTYPE)
+            records["src"] = rows
+            records["dst"] = cols
+            records["similarity"] = similarities
+            writer.write(records)
+    return writer.count
+
+
+def similarity_delta_paths(similarity_file: str) -> list[str]:
+    """Ficheros de cambios del fichero de similitudes, en el orden en que se añadieron"""
+    return sorted(glob.glob(glob.escape(similarity_file) + ".delta_*.npz"))
+
+
+def remove_similarity_deltas(similarity_file: str) -> None:
+    for path in similarity_delta_paths(similarity_file):
+        os.remove(path)
+
+
+def needs_compaction(base_path: str, delta_paths: list) -> bool:
+    """Indica si los ficheros de cambios ocupan ya más que el fichero base
+
+    Si se juntan entonces, reescribir la base cuesta como mucho lo mismo que los cambios
+    acumulados desde la última vez.
+    """
+    return sum(os.path.getsize(path) for path in delta_paths) > os.path.getsize(
+        base_path
+    )
+
+
+def append_similarity_delta(
+    similarity_file: str,
+    user_ids: list,
+    affected: list,
+    pairs: tuple[np.ndarray, np.ndarray, np.ndarray],
+) -> int:
+    """Añade los cambios de una actualización incremental sin reescribir el fichero
+
+    Se guardan en un .npz aparte las parejas recalculadas y los usuarios a los que
+    afectan; al leer (read_similarity_file) se descartan las parejas anteriores de esos
+    usuarios y se usan las nuevas.
+
+    Args:
+        similarity_file (str): fichero de similitudes
+        user_ids (list): ids de los usuarios según su índice en pairs
+        affected (list): ids de los usuarios cuyas parejas se sustituyen
+        pairs (tuple[np.ndarray, np.ndarray, np.ndarray]): índices i, j y similitud de
+            las parejas nuevas
+
+    Returns:
+        int: número de parejas escritas
+    """
+    rows, cols, similarities = pairs
+    used, inverse = np.unique(
+        np.concatenate((rows, cols)).astype(np.int64), return_inverse=True
+    )
+
+    paths = similarity_delta_paths(similarity_file)
+    number = int(paths[-1].rsplit("_", 1)[1].split(".")[0]) + 1 if paths else 1
+    path = f"{similarity_file}.delta_{number:06d}.npz"
+
+    # Se escribe en un temporal y se renombra para no dejar un fichero a medias
+    with open(path + ".tmp", "wb") as fh:
+        np.savez(
+            fh,
+            sources=np.array([user_ids[i] for i in used.tolist()], dtype=str),
+            affected=np.array(list(affected), dtype=str),
+            src=inverse[: len(rows)].astype(np.int32),
+            dst=inverse[len(rows) :].astype(np.int32),
+            similarity=np.asarray(similarities, dtype=np.float32),
+        )
+    os.replace(path + ".tmp", path)
+    return len(rows)
+
+
+def read_similarity_file(similarity_file: str) -> EdgeStore:
+    """Lee el fichero de similitudes escrito por write_similarity_file sin copiarlo
+
+    Si hay cambios añadidos con append_similarity_delta, se combinan al leer: una pareja
+    se queda si ninguno de sus usuarios aparece como afectado en un cambio posterior al
+    fichero del que viene. En ese caso los registros se devuelven en memoria.
+
+    Returns:
+        EdgeStore: ids de los usuarios y registros (src, dst, similarity)
+    """
+    store = load_edges(similarity_file)
+    paths = similarity_delta_paths(similarity_file)
+    if len(paths) == 0:
+        return store
+
+    # Se pasan los índices de todos los ficheros a un mismo mapa de usuarios
+    users = IdMap(store.sources)
+    parts = [(store.edges["src"], store.edges["dst"], store.edges["similarity"])]
+    affected = []
+    for path in paths:
+        with np.load(path) as delta:
+            remap = np.array(
+                [users.add(user_id) for user_id in delta["sources"].tolist()],
+                dtype=np.int64,
+            )
+            parts.append(
+                (remap[delta["src"]], remap[delta["dst"]], delta["similarity"])
+            )
+            affected.append(
+                [users.add(user_id) for user_id in delta["affected"].tolist()]
+            )
+
+    # Último cambio en el que aparece cada usuario (0 si solo está en la base)
+    last_change = np.zeros(len(users), dtype=np.int64)
+    for level, indexes in enumerate(affected, start=1):
+        last_change[np.array(indexes, dtype=np.int64)] = level
+
+    kept = []
+    for level, (src, dst, similarities) in enumerate(parts):
+        keep = np.maximum(last_change[src], last_change[dst]) <= level
+        kept.append((src[keep], dst[keep], similarities[keep]))
+
+    edges = np.empty(sum(len(src) for src, _, _ in kept), dtype=SIMILARITY_DTYPE)
+    edges["src"] = np.concatenate([src for src, _, _ in kept])
+    edges["dst"] = np.concatenate([dst for _, dst, _ in kept])
+    edges["similarity"] = np.concatenate([values for _, _, values in kept])
+    return EdgeStore(users.ids, users.ids, edges)
+
+
+def compact_similarity_file(similarity_file: str) -> int:
+    """Junta los cambios con el fichero base y los borra
+
+    Returns:
+        int: número de parejas del fichero
+    """
+    store = read_similarity_file(similarity_file)
+    n_pairs = write_similarity_file(
+        similarity_file + ".tmp",
+        store.sources,
+        [(store.edges["src"], store.edges["dst"], store.edges["similarity"])],
+    )
+    del store
+    replace_edges(similarity_file + ".tmp", similarity_file)
+    remove_similarity_deltas(similarity_file)
+    return n_pairs
+
+
+def jaccard_rows(
+    matrix: csr_matrix, rows: np.ndarray, threshold: float = 0.0
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Calcula la similitud de unas filas concretas contra todas las demás
+
+    Args:
+        matrix (csr_matrix): matriz binaria usuario x artículo
+        rows (np.ndarray): índices de las filas
+        threshold (float, optional): solo se devuelven similitudes mayores que este valor. Defaults to 0.0.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: parejas i < j (sin repetir) y su similitud
+    """
+    matrix = csr_matrix(matrix, dtype=np.int32)
+    counts = np.diff(matrix.indptr)
+    rows = np.asarray(rows, dtype=np.int64)
+
+    intersections = (matrix[rows] @ matrix.T).tocoo()
+    i = rows[intersections.row]
+    j = intersections.col.astype(np.int64)
+    inter = intersections.data
+    keep = i != j
+    i, j, inter = i[keep], j[keep], inter[keep]
+
+    similarity = inter / (counts[i] + counts[j] - inter)
+    keep = similarity > threshold
+
+    # Si las dos filas están en la lista, la pareja sale dos veces
+    n = matrix.shape[0]
+    low = np.minimum(i[keep], j[keep])
+    high = np.maximum(i[keep], j[keep])
+    keys, first = np.unique(low * n + high, return_index=True)
+    return keys // n, keys % n, similarity[keep][first]
+
+
+def update_user_item_matrix(
+    matrix: csr_matrix,
+    old_user_ids: list,
+    new_user_ids: list,
+    user_articles: dict,
+) -> csr_matrix:
+    """Reconstruye la matriz para una nueva lista de usuarios cambiando solo algunas filas
+
+    Args:
+        matrix (csr_matrix): matriz anterior, con una fila por cada usuario de old_user_ids
+        old_user_ids (list): usuarios de la matriz anterior
+        new_user_ids (list): usuarios de la nueva matriz
+        user_articles (dict): artículos nuevos de los usuarios que han cambiado; los demás
+            usuarios tienen que estar en la matriz anterior
+
+    Returns:
+        csr_matrix: la nueva matriz
+    """
+    old_rows = {user_id: i for i, user_id in enumerate(old_user_ids)}
+
+    def rows():
+        for user_id in new_user_ids:
+            if user_id in user_articles:
+                yield user_id, user_articles[user_id]
+            else:
+                i = old_rows[user_id]
+                yield user_id, matrix.indices[matrix.indptr[i] : matrix.indptr[i + 1]]
+
+    new_matrix = build_user_item_matrix(new_user_ids, rows())
+    # Se mantienen al menos las columnas de la matriz anterior
+    if new_matrix.shape[1] < matrix.shape[1]:
+        new_matrix.resize((new_matrix.shape[0], matrix.shape[1]))
+    return new_matrix
+
+
+# Primo de Mersenne 2^31 - 1 para las funciones hash (a * x + b) mod p
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def minhash_signatures(
+    matrix: csr_matrix, num_perm: int = 128, seed: int = 33, max_entries: int = 2**22
+) -> np.ndarray:
+    """Calcula la firma MinHash de cada fila de la matriz
+
+    Cada permutación se aproxima con una función hash universal sobre el índice de la
+    columna y la firma es el mínimo del hash sobre los artículos de la fila.
+
+    Args:
+        matrix (csr_matrix): matriz binaria usuario x artículo
+        num_perm (int, optional): longitud de la firma. Defaults to 128.
+        seed (int, optional): semilla de las funciones hash. Defaults to 33.
+        max_entries (int, optional): hashes que se calculan a la vez (limita la memoria). Defaults to 2**22.
+
+    Returns:
+        np.ndarray: matriz (usuarios x num_perm) de firmas
+    """
+    matrix = csr_matrix(matrix)
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+    b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+
+    n = matrix.shape[0]
+    signatures = np.full((n, num_perm), MERSENNE_PRIME, dtype=np.int64)
+    reviews_per_block = max(1, max_entries // num_perm)
+
+    start = 0
+    while start < n:
+        # Se cogen tantas filas como quepan en el bloque (al menos una)
+        end = int(
+            np.searchsorted(
+                matrix.indptr, matrix.indptr[start] + reviews_per_block, side="right"
+            )
+        )
+        end = min(max(end - 1, start + 1), n)
+
+        indptr = matrix.indptr[start : end + 1]
+        columns = matrix.indices[indptr[0] : indptr[-1]].astype(np.int64)
+        not_empty = np.diff(indptr) > 0
+        if len(columns) > 0:
+            hashes = (columns[:, None] * a + b) % MERSENNE_PRIME
+
+            # Mínimo por fila; las filas vacías se quedan con el valor máximo
+            offsets = indptr[:-1] - indptr[0]
+            minimums = np.minimum.reduceat(hashes, offsets[not_empty], axis=0)
+            signatures[start:end][not_empty] = minimums
+        start = end
+
+    return signatures
+
+
+def lsh_candidate_pairs(signatures: np.ndarray, bands: int) -> np.ndarray:
+    """Obtiene las parejas candidatas con banding (LSH)
+
+    La firma se divide en bandas y dos usuarios son candidatos si coinciden en todas
+    las filas de alguna banda.
+
+    Args:
+        signatures (np.ndarray): firmas MinHash
+        bands (int): número de bandas (tiene que dividir a la longitud de la firma)
+
+    Returns:
+        np.ndarray: array (parejas x 2) de índices i < j sin repetir
+    """
+    n, num_perm = signatures.shape
+    if num_perm % bands != 0:
+        raise ValueError(
+            f"El número de bandas ({bands}) tiene que dividir a la longitud de la firma ({num_perm})"
+        )
+    rows_per_band = num_perm // bands
+    rng = np.random.default_rng(0)
+
+    candidates = []
+    for band in range(bands):
+        band_signatures = signatures[
+            :, band * rows_per_band : (band + 1) * rows_per_band
+        ]
+
+        # Se resume cada banda en un entero (las colisiones solo añaden candidatos)
+        multipliers = rng.integers(1, 1 << 62, size=rows_per_band, dtype=np.uint64)
+        keys = (band_signatures.astype(np.uint64) * multipliers).sum(
+            axis=1, dtype=np.uint64
+        )
+
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        boundaries = np.flatnonzero(np.diff(sorted_keys)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [n]))
+
+        for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+            members = np.sort(order[start:end])
+            i, j = np.triu_indices(len(members), 1)
+            candidates.append(members[i] * n + members[j])
+
+    if len(candidates) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    pairs = np.unique(np.concatenate(candidates))
+    return np.stack((pairs // n, pairs % n), axis=1)
+
+
+def minhash_pairs(
+    matrix: csr_matrix,
+    threshold: float = 0.0,
+    num_perm: int = 128,
+    bands: int = 32,
+    seed: int = 33,
+    block_size: int = 100000,
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Similitud de Jaccard aproximada con MinHash y LSH
+
+    Con b bandas de r filas, la probabilidad de que una pareja con similitud s sea
+    candidata es 1 - (1 - s^r)^b, así que el umbral efectivo es aproximadamente (1/b)^(1/r).
+
+    Args:
+        matrix (csr_matrix): matriz binaria usuario x artículo
+        threshold (float, optional): solo se devuelven similitudes estimadas mayores que este valor. Defaults to 0.0.
+        num_perm (int, optional): longitud de la firma. Defaults to 128.
+        bands (int, optional): número de bandas. Defaults to 32.
+        seed (int, optional): semilla de las funciones hash. Defaults to 33.
+        block_size (int, optional): parejas candidatas que se estiman a la vez. Defaults to 100000.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: índices de fila i, j y su similitud estimada
+    """
+    signatures = minhash_signatures(matrix, num_perm, seed)
+    candidates = lsh_candidate_pairs(signatures, bands)
+
+    for start in range(0, len(candidates), block_size):
+        rows = candidates[start : start + block_size, 0]
+        cols = candidates[start : start + block_size, 1]
+
+        # La fracción de posiciones iguales de la firma estima la similitud de Jaccard
+        similarity = (signatures[rows] == signatures[cols]).mean(axis=1)
+        keep = similarity > threshold
+        yield rows[keep], cols[keep], similarity[keep]
+
+
+def minhash_recall(
+    matrix: csr_matrix,
+    sample_size: int = 2000,
+    threshold: float = 0.0,
+    num_perm: int = 128,
+    bands: int = 32,
+    seed: int = 33,
+) -> dict:
+    """Mide la calidad de MinHash frente al cálculo exacto en una muestra de usuarios
+
+    Args:
+        matrix (csr_matrix): matriz binaria usuario x artículo
+        sample_size (int, optional): usuarios de la muestra. Defaults to 2000.
+        threshold (float, optional): umbral de similitud. Defaults to 0.0.
+        num_perm (int, optional): longitud de la firma. Defaults to 128.
+        bands (int, optional): número de bandas. Defaults to 32.
+        seed (int, optional): semilla. Defaults to 33.
+
+    Returns:
+        dict: parejas exactas, aproximadas, recall, precisión y error medio de la estimación
+    """
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    sample = np.sort(rng.choice(n, size=min(sample_size, n), replace=False))
+    submatrix = csr_matrix(matrix)[sample]
+    n_sample = len(sample)
+
+    def to_dict(pairs) -> dict:
+        result = {}
+        for rows, cols, similarities in pairs:
+            result.update(zip((rows * n_sample + cols).tolist(), similarities.tolist()))
+        return result
+
+    exact = to_dict(jaccard_pairs(submatrix, threshold))
+    approx = to_dict(minhash_pairs(submatrix, threshold, num_perm, bands, seed))
+    found = exact.keys() & approx.keys()
+
+    return {
+        "exact_pairs": len(exact),
+        "approx_pairs": len(approx),
+        "recall": len(found) / len(exact) if exact else 1.0,
+        "precision": len(found) / len(approx) if approx else 1.0,
+        "mean_abs_error": (
+            float(np.mean([abs(exact[k] - approx[k]) for k in found])) if found else 0.0
+        ),
+    }
+
+
+class TopKNeighbours:
+    """Guarda los k vecinos más similares de cada usuario con un heap acotado por usuario
+
+    Una pareja se conserva si está entre los k vecinos de alguno de los dos usuarios.
+    """
+
+    def __init__(self, n_users: int, k: int) -> None:
+        self.k = k
+        self.heaps = [[] for _ in range(n_users)]
+
+    def add(self, rows: np.ndarray, cols: np.ndarray, similarities: np.ndarray) -> None:
+        """Añade un bloque de parejas (i, j, similitud)"""
+        users = np.concatenate((rows, cols))
+        others = np.concatenate((cols, rows))
+        values = np.concatenate((similarities, similarities))
+
+        # Dentro del bloque solo pueden entrar en el heap los k mejores de cada usuario
+        order = np.lexsort((-values, users))
+        users, others, values = users[order], others[order], values[order]
+        group_starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, len(users)])
+        rank = np.arange(len(users)) - np.repeat(group_starts, group_sizes)
+        keep = rank < self.k
+
+        for user, other, value in zip(
+            users[keep].tolist(), others[keep].tolist(), values[keep].tolist()
+        ):
+            heap = self.heaps[user]
+            if len(heap) < self.k:
+                heapq.heappush(heap, (value, other))
+            elif value > heap[0][0]:
+                heapq.heapreplace(heap, (value, other))
+
+    def pairs(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Devuelve las parejas conservadas, una sola vez cada una (i < j)"""
+        n = len(self.heaps)
+        rows, cols, values = [], [], []
+        for user, heap in enumerate(self.heaps):
+            for value, other in heap:
+                rows.append(min(user, other))
+                cols.append(max(user, other))
+                values.append(value)
+
+        rows = np.array(rows, dtype=np.int64)
+        cols = np.array(cols, dtype=np.int64)
+        keys, first = np.unique(rows * n + cols, return_index=True)
+        return keys // n, keys % n, np.array(values, dtype=np.float64)[first]
+
+
+def top_k_pairs(
+    pairs: Iterable[tuple[np.ndarray, np.ndarray, np.ndarray]], n_users: int, k: int
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Reduce las parejas a los k vecinos más similares de cada usuario
+
+    Args:
+        pairs (Iterable): bloques de (i, j, similitud) como los de jaccard_pairs
+        n_users (int): número de usuarios
+        k (int): vecinos que se conservan por usuario
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: índices de fila i, j y su similitud
+    """
+    neighbours = TopKNeighbours(n_users, k)
+    for rows, cols, similarities in pairs:
+        neighbours.add(rows, cols, similarities)
+    yield neighbours.pairs()
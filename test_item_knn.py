@@ -0,0 +1,102 @@
+import sys
+import types
+
+import numpy as np
+import pytest
+
+# queries consulta MongoDB al importarse y el modelo solo usa sus funciones en el main
+sys.modules.setdefault(
+    "queries",
+    types.SimpleNamespace(obtener_tuplas_items=None, get_product_types=None),
+)
+
+from item_knn import ItemKNN  # noqa: E402
+from recommender import to_csr  # noqa: E402
+
+
+def random_ratings(rng, n, m, per_reviewer):
+    """Matriz de ratings con per_reviewer artículos distintos por reviewer"""
+    rows = np.repeat(np.arange(n), per_reviewer)
+    cols = np.concatenate(
+        [rng.choice(m, per_reviewer, replace=False) for _ in range(n)]
+    )
+    return to_csr(rows, cols, rng.integers(1, 6, len(rows)), (n, m))
+
+
+def change_reviewers(rng, X, changed, new_reviewers, new_items, per_reviewer):
+    """Cambia todos los ratings de unos reviewers y añade reviewers y artículos al final
+
+    Los reviewers cambiados con per_reviewer 0 se quedan sin ratings.
+    """
+    n, m = X.shape
+    n2, m2 = n + new_reviewers, m + new_items
+    X = X.tocoo()
+    keep = ~np.isin(X.row, changed)
+    rows, cols, data = [X.row[keep]], [X.col[keep]], [X.data[keep]]
+    for row in np.concatenate((changed, np.arange(n, n2))):
+        size = per_reviewer if row < n else max(per_reviewer, 5)
+        rows.append(np.full(size, row))
+        cols.append(rng.choice(m2, size, replace=False))
+        data.append(rng.integers(1, 6, size))
+    X2 = to_csr(
+        np.concatenate(rows), np.concatenate(cols), np.concatenate(data), (n2, m2)
+    )
+    return X2, np.concatenate((changed, np.arange(n, n2)))
+
+
+def assert_same_model(updated, fitted):
+    assert updated.similarities.shape == fitted.similarities.shape
+    assert abs(updated.similarities.tocsr() - fitted.similarities.tocsr()).max() == 0
+    np.testing.assert_array_equal(updated.neighbor_index, fitted.neighbor_index)
+    np.testing.assert_array_equal(updated.neighbor_weights, fitted.neighbor_weights)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("block_size", [37, 1000])
+def test_update_matches_fit(seed, block_size):
+    """update(X2, cambiados) deja las mismas similitudes e índice que fit(X2)"""
+    rng = np.random.default_rng(seed)
+    X = random_ratings(rng, 300, 120, 10)
+    changed = rng.choice(300, 25, replace=False)
+    X2, changed_rows = change_reviewers(rng, X, changed, 10, 4, 8)
+
+    model = ItemKNN(k=8, min_overlap=2, block_size=block_size)
+    model.fit(X)
+    model.update(X2, changed_rows)
+
+    fitted = ItemKNN(k=8, min_overlap=2, block_size=block_size)
+    fitted.fit(X2)
+    assert_same_model(model, fitted)
+
+
+def test_update_with_removed_ratings():
+    """Los vecinos que dejan de serlo salen de los top-k de los artículos no afectados"""
+    rng = np.random.default_rng(3)
+    X = random_ratings(rng, 200, 60, 12)
+    changed = rng.choice(200, 40, replace=False)
+    X2, changed_rows = change_reviewers(rng, X, changed, 0, 0, 0)
+
+    model = ItemKNN(k=5, min_overlap=2)
+    model.fit(X)
+    model.update(X2, changed_rows)
+
+    fitted = ItemKNN(k=5, min_overlap=2)
+    fitted.fit(X2)
+    assert_same_model(model, fitted)
+
+
+def test_consecutive_updates():
+    """Varias actualizaciones seguidas siguen coincidiendo con entrenar desde cero"""
+    rng = np.random.default_rng(4)
+    X = random_ratings(rng, 250, 100, 10)
+    model = ItemKNN(k=6, min_overlap=2, block_size=50)
+    model.fit(X)
+
+    for _ in range(3):
+        changed = rng.choice(X.shape[0], 15, replace=False)
+        X, changed_rows = change_reviewers(rng, X, changed, 5, 3, 9)
+        model.update(X, changed_rows)
+
+    fitted = ItemKNN(k=6, min_overlap=2, block_size=50)
+    fitted.fit(X)
+    assert_same_model(model, fitted)
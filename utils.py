@@ -1,4 +1,8 @@
 import configparser
+import itertools
+import math
+from typing import Iterable, Iterator
+from bson import ObjectId
 from pymongo import MongoClient
 from pymongo.collection import Collection
 import pymysql
@@ -13,6 +17,45 @@ def get_collection(config) -> Collection:
     return collection
 
 
+def get_ingest_watermark(collection: Collection) -> ObjectId:
+    """Devuelve el _id de la última review insertada, o None si no hay reviews
+
+    El driver genera el ObjectId al insertar y empieza por los segundos de la inserción,
+    así que marca cuándo se cargó la review (reviewTime es el día en que se escribió y
+    una carga puede traer reviews de días anteriores).
+
+    Args:
+        collection (Collection): colección de MongoDB
+
+    Returns:
+        ObjectId: la marca de la última carga
+    """
+    doc = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    return doc["_id"] if doc is not None else None
+
+
+def ingested_between(watermark: ObjectId, new_watermark: ObjectId) -> dict:
+    """Filtro de las reviews cargadas después de watermark y hasta new_watermark
+
+    Se vuelve a mirar el segundo de watermark, porque los ObjectId de distintos clientes
+    dentro del mismo segundo no tienen por qué estar en orden; volver a procesar una
+    review no cambia el resultado.
+
+    Args:
+        watermark (ObjectId): marca de la ejecución anterior (None para todas)
+        new_watermark (ObjectId): marca de esta ejecución (get_ingest_watermark)
+
+    Returns:
+        dict: filtro de MongoDB sobre _id
+    """
+    if new_watermark is None:
+        return {"_id": {"$exists": False}}
+    match = {"$lte": new_watermark}
+    if watermark is not None:
+        match["$gte"] = ObjectId.from_datetime(watermark.generation_time)
+    return {"_id": match}
+
+
 def read_config() -> configparser.ConfigParser:
     config = configparser.ConfigParser()
     config.read("configuracion.ini")
@@ -28,3 +71,61 @@ def connect_to_sql() -> pymysql.Connection:
         database=config["SQL"]["database"],
     )
     return connection
+
+
+def percentile(values: list, q: float) -> float:
+    """Calcula el percentil q de una lista de valores (método del rango más cercano)
+
+    Args:
+        values (list): lista de valores
+        q (float): percentil deseado, entre 0 y 100
+
+    Returns:
+        float: el valor del percentil, o nan si la lista está vacía
+    """
+    if len(values) == 0:
+        return float("nan")
+    ordered = sorted(values)
+    rank = math.ceil(q / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+class IdMap:
+    """Asigna un índice entero consecutivo a cada identificador (interning)"""
+
+    def __init__(self, ids: list = ()) -> None:
+        self.index = {}
+        self.ids = []
+        for id in ids:
+            self.add(id)
+
+    def add(self, id) -> int:
+        """Devuelve el índice del identificador, añadiéndolo si no existía"""
+        idx = self.index.get(id)
+        if idx is None:
+            idx = len(self.ids)
+            self.index[id] = idx
+            self.ids.append(id)
+        return idx
+
+    def get(self, id, default=None):
+        return self.index.get(id, default)
+
+    def __getitem__(self, id) -> int:
+        return self.index[id]
+
+    def __contains__(self, id) -> bool:
+        return id in self.index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def iter_chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    """Devuelve los elementos de un iterable (por ejemplo, un cursor) en listas de size elementos"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk